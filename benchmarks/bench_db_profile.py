@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Benchmark of the sqlite pragma profiles (see wind.database.DB_PROFILES):
+time to add a number of daily input files, and to query the result the
+way the speeds, average and export commands do.
+
+Run from the top of the tree:
+
+    python benchmarks/bench_db_profile.py [--files N] [--records N] [--dir D]
+
+--dir is where the temporary database and input files are written, which
+should be on the disk of interest, since commit costs depend on it.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wind.database import Database, DB_PROFILES
+from wind.filter import Filter
+from wind.analysis import selected_value_counts, averages
+
+def write_files(directory, files, records):
+    paths = []
+    for f in range(files):
+        day = 1 + f % 28
+        month = 1 + (f // 28) % 12
+        path = os.path.join(directory, 'D16%02d%02d_%d.CSV' % (month, day, f))
+        with open(path, 'w') as out:
+            out.write('Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V\n')
+            for i in range(records):
+                second = i * 86400 // records
+                out.write('BB,%02d-%02d-2016,%02d:%02d:%02d,%d,%d,%s,%.2f,4.72\n' % (
+                          day, month, second // 3600, (second // 60) % 60, second % 60,
+                          (i * 7) % 30, (i * 11) % 30, ['N', 'E', 'S', 'W'][i % 4], (i % 100) / 100.0))
+        paths.append(path)
+    return paths
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def run(profile, directory, paths):
+    dbpath = os.path.join(directory, 'bench_%s.db' % profile)
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(dbpath + suffix):
+            os.remove(dbpath + suffix)
+    db = Database(dbpath, profile=profile)
+    results = [('add', timed(lambda: db.add(paths)))]
+    c = db._conn.cursor()
+    # a file filter so the events are read, not the rollup
+    filt = Filter(c, file_filter=paths[len(paths) // 2])
+    results.append(('speeds (one file)', timed(lambda: selected_value_counts(c, filt, 1, True))))
+    filt = Filter(c)
+    results.append(('average (all)', timed(lambda: averages(selected_value_counts(c, filt, 1, False)))))
+    results.append(('export (all)', timed(lambda: sum(1 for e in filt.iter_events()))))
+    db._conn.close()
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='sqlite pragma profile benchmark')
+    parser.add_argument('--files', type=int, default=50, help='Number of input files')
+    parser.add_argument('--records', type=int, default=2000, help='Number of records per file')
+    parser.add_argument('--dir', type=str, default=None, help='Directory for temporary files')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        paths = write_files(directory, args.files, args.records)
+        results = dict()
+        for profile in sorted(DB_PROFILES.keys()):
+            results[profile] = run(profile, directory, paths)
+        profiles = sorted(results.keys())
+        print('%-20s %s' % ('', ' '.join('%10s' % p for p in profiles)))
+        for idx, (name, t) in enumerate(results[profiles[0]]):
+            print('%-20s %s' % (name, ' '.join('%9.3fs' % results[p][idx][1] for p in profiles)))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for adding and querying data, at several scales.
+
+For each scale (number of records), synthetic data is generated (see
+generate_data.py), added to a new database, and then queried.  Each step
+runs in its own process, so its peak RSS can be reported:
+
+    add            Database.add_file for every file, excluding process_file
+    process        Database.process_file, called by add_file
+    select_events  Filter.select_events for one day
+    speeds         winda.py speeds
+    average        winda.py average
+    export         winda.py export
+
+The results are written as JSON, with the time, throughput (records or
+events per second) and peak RSS of each step, so runs can be compared to
+track regressions.  Run from the top of the tree:
+
+    python benchmarks/bench_suite.py [--scales 1k,100k,10M] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, TOP)
+
+SCALE_SUFFIXES = {'k': 1000, 'M': 1000000}
+
+def parse_scale(s):
+    if s[-1] in SCALE_SUFFIXES:
+        return int(s[:-1]) * SCALE_SUFFIXES[s[-1]]
+    return int(s)
+
+def run_step(command, capture=True):
+    """
+    Run command, returning (seconds, peak RSS in KB, stdout).  If capture 
+    is False stdout is discarded, and None is returned for it.  os.wait4
+    gives the resource usage of just this child.
+    """
+    start = time.time()
+    output = None
+    if capture:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        output = proc.stdout.read()
+    else:
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(command, stdout=devnull)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    if status != 0:
+        raise Exception('benchmark step failed: %s' % ' '.join(command))
+    return seconds, rusage.ru_maxrss, output
+
+def step_add(database_path, data_dir, profile):
+    """Add the files in data_dir, printing JSON of the time spent in add and process."""
+    from wind.database import Database
+    # the generated data has bad records, don't time logging them
+    logging.getLogger().setLevel(logging.CRITICAL)
+    db = Database(database_path, profile=profile)
+    c = db._conn.cursor()
+    for ref in ['BB', 'CC', 'DD', 'EE']:
+        c.execute("""INSERT OR REPLACE INTO calibration VALUES (?, 1.42, 1.42, 100, 1.0, 1500)""", (ref,))
+    timings = {'process': 0.0}
+    process_file = db.process_file
+    def timed_process_file(file_id):
+        start = time.time()
+        process_file(file_id)
+        timings['process'] += time.time() - start
+    db.process_file = timed_process_file
+    paths = sorted(os.path.join(data_dir, f) for f in os.listdir(data_dir))
+    start = time.time()
+    for path in paths:
+        db.add_file(path)
+    total = time.time() - start
+    c.execute("""SELECT SUM(records) FROM input_file""")
+    records = c.fetchall()[0][0]
+    c.execute("""SELECT COUNT(1) FROM event""")
+    events = c.fetchall()[0][0]
+    print(json.dumps({'add': total - timings['process'], 'process': timings['process'],
+                      'records': records, 'events': events}))
+
+def step_select_events(database_path, profile):
+    """Select the events of the first day, printing JSON of the time and number of events."""
+    from datetime import datetime
+    from wind.database import Database
+    from wind.filter import Filter
+    db = Database(database_path, profile=profile)
+    c = db._conn.cursor()
+    c.execute("""SELECT MIN(event_end) FROM event""")
+    day = datetime.utcfromtimestamp(c.fetchall()[0][0]).date()
+    start = time.time()
+    events = Filter(c, date_filter=day).select_events()
+    print(json.dumps({'select_events': time.time() - start, 'events': len(events)}))
+
+def run_scale(records, directory, profile):
+    from generate_data import generate_files
+    data_dir = os.path.join(directory, 'data')
+    os.mkdir(data_dir)
+    database_path = os.path.join(directory, 'bench.db')
+    generate_files(data_dir, records)
+    python = [sys.executable]
+    this = os.path.abspath(__file__)
+    winda = [os.path.join(TOP, 'winda.py'), '--database', database_path, '--db-profile', profile]
+    results = dict()
+
+    seconds, rss, output = run_step(python + [this, '--step', 'add', '--database', database_path,
+                                              '--data', data_dir, '--db-profile', profile])
+    add = json.loads(output.decode())
+    results['add'] = {'seconds': add['add'], 'peak_rss_kb': rss,
+                      'rows_per_s': add['records'] / add['add']}
+    results['process'] = {'seconds': add['process'], 'peak_rss_kb': rss,
+                          'rows_per_s': add['records'] / add['process']}
+    events = add['events']
+
+    seconds, rss, output = run_step(python + [this, '--step', 'select_events', '--database', database_path,
+                                              '--db-profile', profile])
+    select = json.loads(output.decode())
+    results['select_events'] = {'seconds': select['select_events'], 'peak_rss_kb': rss,
+                                'rows_per_s': select['events'] / max(select['select_events'], 1e-9)}
+
+    for name, command in [('speeds', ['speeds', '--direction-split']),
+                          ('average', ['average', '--direction-split']),
+                          ('export', ['export'])]:
+        seconds, rss, output = run_step(python + winda + command, capture=False)
+        results[name] = {'seconds': seconds, 'peak_rss_kb': rss, 'rows_per_s': events / seconds}
+    shutil.rmtree(data_dir)
+    os.remove(database_path)
+    return {'records': add['records'], 'events': events, 'steps': results}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Add and query benchmark suite')
+    parser.add_argument('--scales', type=str, default='1k,100k,10M',
+                        help='Comma separated numbers of records, e.g. 1k,100k,10M')
+    parser.add_argument('--output', type=str, default=None, help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--dir', type=str, default=None, help='Directory for temporary files')
+    parser.add_argument('--db-profile', dest='db_profile', type=str, default='safe', help='Database profile')
+    # used internally to run each step in its own process
+    parser.add_argument('--step', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--database', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--data', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step == 'add':
+        step_add(args.database, args.data, args.db_profile)
+    elif args.step == 'select_events':
+        step_select_events(args.database, args.db_profile)
+    else:
+        report = {'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'db_profile': args.db_profile,
+                  'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'scales': []}
+        for scale in args.scales.split(','):
+            directory = tempfile.mkdtemp(dir=args.dir)
+            try:
+                sys.stderr.write('running scale %s\n' % scale)
+                report['scales'].append(run_scale(parse_scale(scale), directory, args.db_profile))
+            finally:
+                shutil.rmtree(directory)
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
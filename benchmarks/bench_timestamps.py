@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the per-record timestamp conversion used while adding
+files: str2isodatestr (regular expression detection on every call) versus
+TimestampParser (layout detected once per file, then sliced).
+
+Run from the top of the tree:
+
+    python benchmarks/bench_timestamps.py [--records N]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wind.database import str2isodatestr, TimestampParser
+
+def make_records(n):
+    records = []
+    for i in range(n):
+        records.append(('%02d-01-2016' % (1 + (i // 86400) % 28),
+                        '%02d:%02d:%02d' % ((i // 3600) % 24, (i // 60) % 60, i % 60)))
+    return records
+
+def run_str2isodatestr(records):
+    for dt, tm in records:
+        str2isodatestr('%sT%s' % (dt, tm), '%Y-%m-%d %H:%M:%S')
+
+def run_timestamp_parser(records):
+    parser = TimestampParser()
+    for dt, tm in records:
+        parser.isodatestr(dt, tm)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Timestamp conversion microbenchmark')
+    parser.add_argument('--records', type=int, default=100000, help='Number of records per run')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs (best is reported)')
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    results = []
+    for name, func in [('str2isodatestr', run_str2isodatestr),
+                       ('TimestampParser', run_timestamp_parser)]:
+        best = min(timeit.repeat(lambda: func(records), number=1, repeat=args.repeat))
+        per_record = best / args.records * 1e6
+        results.append(per_record)
+        print('%-20s %10.3f us/record %12.0f records/s' % (name, per_record, args.records / best))
+    print('%-20s %10.1fx' % ('speedup', results[0] / results[1]))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Generate synthetic logger data: one CSV file per ref per day, as written
+by the wind loggers, for benchmarks.
+
+Files use a variety of the header spellings in the field_mapping table,
+and can include bad records (which cannot be added) and records repeating
+the previous timestamp (which are added, but do not produce events).
+
+Run from the top of the tree:
+
+    python benchmarks/generate_data.py DIR [--records N] [--refs BB,CC] ...
+"""
+
+import os
+import random
+from datetime import date, timedelta
+
+# Header lines accepted by the default field_mapping table
+HEADER_VARIANTS = [
+    'Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V',
+    'ref,date,time,wind_1,wind_2,dir,irradiance,batt_v',
+    'Reference, Date, Time, Wind Ticks 1, Wind Ticks 2, Direction, Irr, Battery Volts',
+    'Ref,Dt,Tm,Anemometer 1,Anemometer 2,Dir,Irradiance V,Batt',
+]
+
+DIRECTIONS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+
+def generate_files(directory, records, refs=('BB', 'CC'), interval=5, start=date(2016, 1, 1),
+                   bad_fraction=0.001, duplicate_fraction=0.001, seed=1):
+    """
+    Write about records records to CSV files in directory, and return a
+    list of the paths written.
+
+    Each ref logs a record every interval seconds, so there are
+    86400 / interval records in a full day's file.  Files for each ref are
+    written day by day from start until there are enough records.
+    bad_fraction of the records are bad, and duplicate_fraction repeat
+    the timestamp of the previous record.
+    """
+    rng = random.Random(seed)
+    per_day = 86400 // interval
+    paths = []
+    written = 0
+    day = start
+    while written < records:
+        for ref_idx, ref in enumerate(refs):
+            count = min(per_day, records - written)
+            if count <= 0:
+                break
+            path = os.path.join(directory, '%s_D%s.CSV' % (ref, day.strftime('%y%m%d')))
+            header = HEADER_VARIANTS[len(paths) % len(HEADER_VARIANTS)]
+            write_file(path, header, ref, day, count, interval, rng, bad_fraction, duplicate_fraction)
+            paths.append(path)
+            written += count
+        day += timedelta(days=1)
+    return paths
+
+def write_file(path, header, ref, day, count, interval, rng, bad_fraction, duplicate_fraction):
+    dt = day.strftime('%d-%m-%Y')
+    # wind varies slowly, with gusts
+    wind = rng.uniform(0, 20)
+    direction = rng.randrange(len(DIRECTIONS))
+    lines = [header]
+    second = 0
+    for i in range(count):
+        if i > 0 and rng.random() >= duplicate_fraction:
+            second += interval
+        wind = min(max(wind + rng.gauss(0, 1), 0), 60)
+        if rng.random() < 0.01:
+            direction = (direction + rng.choice([-1, 1])) % len(DIRECTIONS)
+        tm = '%02d:%02d:%02d' % (second // 3600, (second // 60) % 60, second % 60)
+        irradiance = max(0.0, 5.0 - abs(second - 43200) / 8640.0)
+        r = rng.random()
+        if r < bad_fraction / 2:
+            # truncated record
+            lines.append('%s,%s,%s,%d' % (ref, dt, tm, int(wind * interval)))
+        elif r < bad_fraction:
+            lines.append('%s,%s,%s,%d,%d,%s,%.2f,%.2f' % (
+                         ref, '99-99-9999', tm, int(wind * interval), int(wind * interval * 0.9),
+                         DIRECTIONS[direction], irradiance, 4.7))
+        else:
+            lines.append('%s,%s,%s,%d,%d,%s,%.2f,%.2f' % (
+                         ref, dt, tm, int(wind * interval), int(wind * interval * 0.9),
+                         DIRECTIONS[direction], irradiance, rng.uniform(4.5, 4.8)))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate synthetic wind logger CSV files')
+    parser.add_argument('directory', help='Directory to write files to')
+    parser.add_argument('--records', type=int, default=100000, help='Total number of records')
+    parser.add_argument('--refs', type=str, default='BB,CC', help='Comma separated refs')
+    parser.add_argument('--interval', type=int, default=5, help='Seconds between records')
+    parser.add_argument('--bad', type=float, default=0.001, help='Fraction of bad records')
+    parser.add_argument('--duplicates', type=float, default=0.001, help='Fraction of duplicate timestamps')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+    paths = generate_files(args.directory, args.records, refs=args.refs.split(','),
+                           interval=args.interval, bad_fraction=args.bad,
+                           duplicate_fraction=args.duplicates, seed=args.seed)
+    print('wrote %d files' % len(paths))
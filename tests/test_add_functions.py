@@ -1,7 +1,9 @@
 import unittest
 import os
 import tempfile
-from wind.database import Database
+import wind.database
+from wind.database import Database, epoch2iso, iso2epoch
+from wind.inputfile import TAIL_WINDOW
 
 class TestAddFunctions(unittest.TestCase):
     @classmethod
@@ -46,7 +48,7 @@ BB,12-01-2016,19:34:17,1,2,SW,0.50,4.72
         c = self._db._conn.cursor()
         # Test raw data entry was OK
         c.execute("""
-                  SELECT     ref, dt, tm, wind_1, wind_2, 
+                  SELECT     ref, ts, wind_1, wind_2, 
                              direction, irradiance, batt_v, processed 
                   FROM       raw_data WHERE file_id = ?
                   """, (self.get_input_file_id(),))
@@ -55,14 +57,13 @@ BB,12-01-2016,19:34:17,1,2,SW,0.50,4.72
         self.assertEqual(len(data), 5)
         # Spot check some values
         self.assertEqual(data[0][0], 'BB')
-        self.assertEqual(data[1][1], '12-01-2016')
-        self.assertEqual(data[2][2], '19:34:15')
-        self.assertEqual(data[3][3], 1)
-        self.assertEqual(data[4][4], 2)
-        self.assertEqual(data[3][5], 'S')
-        self.assertEqual(data[2][6], 0.3)
-        self.assertEqual(data[1][7], 4.72)
-        self.assertEqual(data[1][8], 1) # not record 0 will not be flagged as processed
+        self.assertEqual(epoch2iso(data[1][1]), '2016-01-12 19:34:11')
+        self.assertEqual(data[3][2], 1)
+        self.assertEqual(data[4][3], 2)
+        self.assertEqual(data[3][4], 'S')
+        self.assertEqual(data[2][5], 0.3)
+        self.assertEqual(data[1][6], 4.72)
+        self.assertEqual(data[1][7], 1) # not record 0 will not be flagged as processed
 
     def test_process_data(self):
         c = self._db._conn.cursor()
@@ -77,8 +78,8 @@ BB,12-01-2016,19:34:17,1,2,SW,0.50,4.72
         self.assertEqual(len(events), 4)
         # Check the first event, field by field
         self.assertEqual(events[0][0], 'BB')
-        self.assertEqual(events[0][2], '2016-01-12 19:34:10')
-        self.assertEqual(events[0][3], '2016-01-12 19:34:11')
+        self.assertEqual(epoch2iso(events[0][2]), '2016-01-12 19:34:10')
+        self.assertEqual(epoch2iso(events[0][3]), '2016-01-12 19:34:11')
         self.assertEqual(events[0][4], 1.0)    # duration
         self.assertEqual(events[0][5], 1.0)    # anemometer_hz_1
         self.assertEqual(events[0][6], 2.0)    # anemometer_hz_2
@@ -89,8 +90,8 @@ BB,12-01-2016,19:34:17,1,2,SW,0.50,4.72
         self.assertEqual(events[0][11], 0.2)  # irradiance_wm2
         # Check the last record, field by field
         self.assertEqual(events[3][0], 'BB')
-        self.assertEqual(events[3][2], '2016-01-12 19:34:16')
-        self.assertEqual(events[3][3], '2016-01-12 19:34:17')
+        self.assertEqual(epoch2iso(events[3][2]), '2016-01-12 19:34:16')
+        self.assertEqual(epoch2iso(events[3][3]), '2016-01-12 19:34:17')
         self.assertEqual(events[3][4], 1.0)    # duration
         self.assertEqual(events[3][5], 1.0)    # anemometer_hz_1
         self.assertEqual(events[3][6], 2.0)    # anemometer_hz_2
@@ -127,6 +128,342 @@ BB,12-01-2016,10:04:00,1,2,E,0.30,4.90
         os.remove(dbpath)
         os.remove(testfile.name)
 
+    def test_bad_records_counted_as_errors(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        dbpath = tmpfile.name
+        del(tmpfile)
+        # small chunk size so the records span several batches
+        db = Database(dbpath, chunk_size=2)
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,1,2,N,0.20,4.72
+BB,NOT A DATE,10:02:00,1,2,E,0.30,4.70
+BB,12-01-2016,10:03:00,1,2
+BB,12-01-2016,10:04:00,1,2,E,0.30,4.90
+""")
+        testfile.close()
+        db.add([testfile.name])
+        c = db._conn.cursor()
+        c.execute("""SELECT records, errors FROM input_file""")
+        self.assertEqual(c.fetchall(), [(5, 2)])
+        c.execute("""SELECT COUNT(1) FROM raw_data""")
+        self.assertEqual(c.fetchall()[0][0], 3)
+        del(db)
+        os.remove(dbpath)
+        os.remove(testfile.name)
+
+    def test_parallel_add_matches_serial_add(self):
+        paths = []
+        for day in ['12', '13', '14']:
+            testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+            testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,%s-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,%s-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,BAD-DATE,10:02:00,1,2,E,0.30,4.70
+BB,%s-01-2016,10:03:00,5,6,E,0.30,4.90
+""" % (day, day, day))
+            testfile.close()
+            paths.append(testfile.name)
+        results = []
+        for jobs in [1, 3]:
+            tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+            dbpath = tmpfile.name
+            del(tmpfile)
+            db = Database(dbpath)
+            db.add(paths, jobs=jobs)
+            c = db._conn.cursor()
+            c.execute("""SELECT id, path, records, errors FROM input_file ORDER BY id""")
+            files = c.fetchall()
+            c.execute("""SELECT file_id, ts, wind_1, wind_2 FROM raw_data ORDER BY file_id, ts""")
+            raw_data = c.fetchall()
+            c.execute("""SELECT file_id, event_start, event_end, windspeed_ms_1 FROM event ORDER BY id""")
+            events = c.fetchall()
+            results.append((files, raw_data, events))
+            del(db)
+            os.remove(dbpath)
+        for path in paths:
+            os.remove(path)
+        self.assertEqual([(f[1], f[2], f[3]) for f in results[0][0]], [(p, 4, 1) for p in paths])
+        self.assertEqual(results[0], results[1])
+
+    def test_parallel_add_keeps_input_order(self):
+        contents = """Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,%s-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,%s-01-2016,10:01:00,3,4,N,0.20,4.72
+"""
+        paths = []
+        for day in ['12', '13', '14']:
+            testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+            testfile.close()
+            paths.append(testfile.name)
+        results = []
+        for jobs in [1, 3]:
+            tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+            dbpath = tmpfile.name
+            del(tmpfile)
+            db = Database(dbpath)
+            # the second file is added first, then changed
+            with open(paths[1], 'w') as f:
+                f.write(contents % ('01', '01'))
+            db.add([paths[1]])
+            for day, path in zip(['12', '13', '14'], paths):
+                with open(path, 'w') as f:
+                    f.write(contents % (day, day))
+            db.add(paths + [paths[0]], jobs=jobs)
+            c = db._conn.cursor()
+            c.execute("""SELECT id, path, records FROM input_file ORDER BY id""")
+            results.append(c.fetchall())
+            del(db)
+            os.remove(dbpath)
+        for path in paths:
+            os.remove(path)
+        self.assertEqual([f[1] for f in results[0]], paths)
+        self.assertEqual(results[0], results[1])
+
+    def test_update_file_adds_appended_records(self):
+        lines = """Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,12-01-2016,10:02:00,1000000,2,E,0.30,4.70
+BB,12-01-2016,10:03:00,5,6,E,0.30,4.90
+BB,12-01-2016,10:04:00,7,8,S,0.40,4.90
+""".splitlines(True)
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write(''.join(lines))
+        testfile.close()
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        dbpath = tmpfile.name
+        del(tmpfile)
+        db = Database(dbpath)
+        db.add([testfile.name])
+        c = db._conn.cursor()
+        c.execute("""SELECT event_start, event_end, windspeed_ms_1 FROM event ORDER BY id""")
+        expected = c.fetchall()
+        c.execute("""SELECT ts, processed FROM raw_data ORDER BY rowid""")
+        expected_processed = c.fetchall()
+        c.execute("""SELECT ref, events, raw_data, unprocessed FROM ref_statistics""")
+        expected_statistics = c.fetchall()
+        del(db)
+        os.remove(dbpath)
+
+        db = Database(dbpath)
+        # write the file a piece at a time, ending part way through a line
+        with open(testfile.name, 'w') as f:
+            f.write(''.join(lines[:3]) + lines[3][:10])
+        self.assertEqual(db.update_file(testfile.name), 2)
+        self.assertEqual(db.update_file(testfile.name), 0)
+        with open(testfile.name, 'a') as f:
+            f.write(lines[3][10:] + lines[4])
+        self.assertEqual(db.update_file(testfile.name), 2)
+        with open(testfile.name, 'a') as f:
+            f.write(''.join(lines[5:]))
+        self.assertEqual(db.update_file(testfile.name), 2)
+        c = db._conn.cursor()
+        c.execute("""SELECT event_start, event_end, windspeed_ms_1 FROM event ORDER BY id""")
+        self.assertEqual(c.fetchall(), expected)
+        # records which did not make an event are left unprocessed, as when
+        # the file is added at once
+        c.execute("""SELECT ts, processed FROM raw_data ORDER BY rowid""")
+        self.assertEqual(c.fetchall(), expected_processed)
+        self.assertEqual([p for ts, p in expected_processed], [0, 1, 0, 0, 1, 1])
+        c.execute("""SELECT ref, events, raw_data, unprocessed FROM ref_statistics""")
+        self.assertEqual(c.fetchall(), expected_statistics)
+        self.assertEqual(expected_statistics, [('BB', 3, 6, 3)])
+        c.execute("""SELECT records, errors, bytes_read FROM input_file""")
+        self.assertEqual(c.fetchall(), [(6, 0, os.path.getsize(testfile.name))])
+        # adding the file again does nothing
+        self.assertEqual(db.add_file(testfile.name), 0)
+        del(db)
+        os.remove(dbpath)
+        os.remove(testfile.name)
+
+    def test_file_change_reads_only_the_tail(self):
+        lines = ['Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V\n']
+        for i in range(5000):
+            lines.append('BB,12-01-2016,%02d:%02d:%02d,1,2,W,0.10,4.72\n' % (i // 3600, (i // 60) % 60, i % 60))
+        data = ''.join(lines)
+        self.assertTrue(len(data) > 2 * TAIL_WINDOW)
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write(data)
+        testfile.close()
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        dbpath = tmpfile.name
+        del(tmpfile)
+        db = Database(dbpath)
+        self.assertEqual(db.add_file(testfile.name), 5000)
+        with open(testfile.name, 'a') as f:
+            f.write('BB,12-01-2016,02:00:00,1,2,W,0.10,4.72\n')
+        # the whole of what was read before is not read again
+        full_digest = wind.database.file_digest
+        wind.database.file_digest = None
+        try:
+            self.assertEqual(db.file_change(testfile.name, db.get_input_file(testfile.name)), 'appended')
+            self.assertEqual(db.update_file(testfile.name), 1)
+            # a change in the last bytes read before is found
+            with open(testfile.name, 'w') as f:
+                f.write(data[:-20] + 'BB,12-01-2016,09:09:09,1,2,W,0.10,4.72\n')
+            self.assertEqual(db.file_change(testfile.name, db.get_input_file(testfile.name)), 'changed')
+        finally:
+            wind.database.file_digest = full_digest
+        del(db)
+        os.remove(dbpath)
+        os.remove(testfile.name)
+
+    def test_add_changed_files(self):
+        data = """Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,12-01-2016,10:02:00,5,6,E,0.30,4.70
+"""
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write(data)
+        testfile.close()
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        dbpath = tmpfile.name
+        del(tmpfile)
+        db = Database(dbpath)
+        c = db._conn.cursor()
+        self.assertEqual(db.add_file(testfile.name), 3)
+        # unchanged
+        self.assertEqual(db.add_file(testfile.name), 0)
+        # appended to, only the new records are read
+        with open(testfile.name, 'a') as f:
+            f.write("""BB,12-01-2016,10:03:00,7,8,S,0.40,4.70\n""")
+        self.assertEqual(db.add_file(testfile.name), 1)
+        c.execute("""SELECT id, records FROM input_file""")
+        self.assertEqual(c.fetchall(), [(1, 4)])
+        c.execute("""SELECT COUNT(1) FROM raw_data""")
+        self.assertEqual(c.fetchall()[0][0], 4)
+        c.execute("""SELECT event_end, windspeed_ms_1 FROM event ORDER BY event_end""")
+        self.assertEqual([epoch2iso(e[0])[-8:] for e in c.fetchall()], ['10:01:00', '10:02:00', '10:03:00'])
+        # changed, the file is added again
+        with open(testfile.name, 'w') as f:
+            f.write(data.replace('10:01:00,3,4', '10:01:00,9,9'))
+        db.add([testfile.name], jobs=2)
+        c.execute("""SELECT id, records FROM input_file""")
+        self.assertEqual(c.fetchall(), [(2, 3)])
+        c.execute("""SELECT event_end, wind_direction FROM event ORDER BY event_end""")
+        self.assertEqual([epoch2iso(e[0])[-8:] for e in c.fetchall()], ['10:01:00', '10:02:00'])
+        c.execute("""SELECT SUM(count) FROM windspeed_rollup WHERE anemometer = 1""")
+        self.assertEqual(c.fetchall()[0][0], 2)
+        self.assertStatisticsMatch(c)
+        # a file with no records is not kept, or counted
+        with open(testfile.name, 'w') as f:
+            f.write(data.splitlines(True)[0])
+        db.add_file(testfile.name)
+        self.assertStatisticsMatch(c)
+        self.assertEqual(db.info()['Number of files added'], 0)
+        del(db)
+        os.remove(dbpath)
+        os.remove(testfile.name)
+
+    def test_remove_data(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        dbpath = tmpfile.name
+        del(tmpfile)
+        db = Database(dbpath)
+        c = db._conn.cursor()
+        paths = []
+        for day in ['12', '13']:
+            testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+            testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,%s-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,%s-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,%s-01-2016,10:02:00,5,6,E,0.30,4.70
+""" % (day, day, day))
+            testfile.close()
+            paths.append(testfile.name)
+        db.add(paths)
+        # a chunk size of 1 so each row is deleted by its own statement
+        result = db.remove_data('event_end < ?', [iso2epoch('2016-01-12 10:01:30')],
+                                'ts < ?', [iso2epoch('2016-01-12 10:01:30')], chunk_size=1)
+        self.assertEqual(result, (1, 2, []))
+        result = db.remove_data('event_end < ?', [iso2epoch('2016-01-13 00:00:00')],
+                                'ts < ?', [iso2epoch('2016-01-13 00:00:00')], chunk_size=1)
+        self.assertEqual(result, (1, 1, [paths[0]]))
+        c.execute("""SELECT path FROM input_file""")
+        self.assertEqual(c.fetchall(), [(paths[1],)])
+        c.execute("""SELECT day, SUM(count) FROM windspeed_rollup WHERE anemometer = 1 GROUP BY day""")
+        self.assertEqual(c.fetchall(), [(iso2epoch('2016-01-13 00:00:00') // 86400, 2)])
+        self.assertStatisticsMatch(c)
+        info = db.info()
+        self.assertEqual(info['Number of files added'], 1)
+        self.assertEqual(info['Number of records'], 2)
+        self.assertEqual(info['Number of raw_data records'], 3)
+        self.assertEqual(info['Refs'], {'BB': {'events': 2, 'raw_data': 3, 'unprocessed': 1}})
+        self.assertEqual(info['First event'], '2016-01-13 10:01:00')
+        del(db)
+        os.remove(dbpath)
+        for path in paths:
+            os.remove(path)
+
+    def test_recalibrate(self):
+        data = """Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,30,40,N,0.20,4.72
+BB,12-01-2016,10:02:00,60,120,E,0.30,4.70
+BB,12-01-2016,10:03:00,90,60,S,0.40,4.70
+"""
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write(data)
+        testfile.close()
+        paths = []
+        databases = []
+        for i in range(2):
+            tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+            paths.append(tmpfile.name)
+            del(tmpfile)
+            databases.append(Database(paths[-1]))
+        old, new = databases
+        old.add([testfile.name])
+        events = """SELECT event_start, event_end, windspeed_ms_1, windspeed_ms_2, irradiance_wm2
+                    FROM event ORDER BY event_end"""
+        for calibration in [(2.0, 3.0, 100, 10.0, 1500),
+                            # the 10:02 windspeed 2 is now spurious
+                            (2.0, 3.0, 5.0, 10.0, 1500)]:
+            # new has the file added again with the calibration
+            new.reset()
+            for db in databases:
+                c = db._conn.cursor()
+                c.execute("""INSERT OR REPLACE INTO calibration VALUES ('BB', ?, ?, ?, ?, ?)""", calibration)
+            new.add([testfile.name])
+            updated, files = old.recalibrate('BB')
+            self.assertEqual(updated, 3)
+            self.assertEqual(files, 0 if calibration[2] == 100 else 1)
+            old_c, new_c = old._conn.cursor(), new._conn.cursor()
+            old_c.execute(events)
+            new_c.execute(events)
+            self.assertEqual(old_c.fetchall(), new_c.fetchall())
+            old_c.execute("""SELECT * FROM windspeed_rollup ORDER BY 1, 2, 3, 4, 5""")
+            new_c.execute("""SELECT * FROM windspeed_rollup ORDER BY 1, 2, 3, 4, 5""")
+            self.assertEqual(old_c.fetchall(), new_c.fetchall())
+            self.assertStatisticsMatch(old_c)
+        old_c.execute(events)
+        self.assertEqual([epoch2iso(e[1])[-8:] for e in old_c.fetchall()], ['10:01:00', '10:03:00'])
+        del(old, new, databases, db, c, old_c, new_c)
+        for path in paths:
+            os.remove(path)
+        os.remove(testfile.name)
+
+    def assertStatisticsMatch(self, c):
+        """Check ref_statistics and the input_files count against counts of the tables."""
+        c.execute("""SELECT ref, events, raw_data, unprocessed FROM ref_statistics ORDER BY ref""")
+        statistics = c.fetchall()
+        c.execute("""
+                  SELECT     ref, (SELECT COUNT(1) FROM event e WHERE e.ref = r.ref),
+                             COUNT(1), SUM(processed = 0)
+                  FROM       raw_data r
+                  GROUP BY   ref
+                  ORDER BY   ref
+                  """)
+        self.assertEqual(statistics, c.fetchall())
+        c.execute("""SELECT value FROM database_state WHERE name = 'input_files'""")
+        files = c.fetchall()
+        c.execute("""SELECT COUNT(1) FROM input_file""")
+        self.assertEqual(files, c.fetchall())
+
     def get_input_file_id(self):
         c = self._db._conn.cursor()
         c.execute("""SELECT id FROM input_file WHERE path = ?""", (self._testfile.name,))
@@ -0,0 +1,49 @@
+import unittest
+import sqlite3
+from datetime import datetime
+from wind.analysis import windspeed_ranges, histogram, date_partitions
+
+class TestAnalysis(unittest.TestCase):
+    def test_windspeed_ranges(self):
+        self.assertEqual(windspeed_ranges(0, 1.5, 0.5), [(0, 0.5), (0.5, 1.0), (1.0, 1.5)])
+        self.assertEqual(len(windspeed_ranges(0, 40, 0.01)), 4000)
+        with self.assertRaises(Exception):
+            windspeed_ranges(0, 1, 0)
+
+    def test_date_partitions(self):
+        lower, upper = datetime(2016, 1, 10, 12, 0, 0), datetime(2016, 1, 14, 6, 0, 0)
+        self.assertEqual(date_partitions(lower, upper, 2),
+                         [(lower, datetime(2016, 1, 11, 23, 59, 59)),
+                          (datetime(2016, 1, 12, 0, 0, 0), upper)])
+        # no more partitions than days, and each follows on from the last
+        partitions = date_partitions(lower, upper, 16)
+        self.assertEqual(len(partitions), 5)
+        self.assertEqual(partitions[0][0], lower)
+        self.assertEqual(partitions[-1][1], upper)
+        for (a, b), (c, d) in zip(partitions, partitions[1:]):
+            self.assertEqual((c - b).total_seconds(), 1)
+        self.assertEqual(date_partitions(lower, lower, 4), [(lower, lower)])
+
+    def test_histogram_matches_range_join(self):
+        # Values on or near range boundaries, where the accumulated floating
+        # point boundaries matter
+        values = [0.0, 0.1, 0.2, 0.3, 0.30000000000000004, 0.7, 0.7999999999999999, 
+                  0.8, 0.9, 0.95, 1.0, 1.05, -0.1, 2.5, None]
+        ranges = windspeed_ranges(0.0, 1.0, 0.1)
+        conn = sqlite3.connect(':memory:')
+        c = conn.cursor()
+        c.execute("""CREATE TABLE event (wind_direction VARCHAR(2), w FLOAT)""")
+        c.execute("""CREATE TABLE windspeed_range (a FLOAT UNIQUE, b FLOAT UNIQUE)""")
+        c.executemany("""INSERT INTO windspeed_range VALUES (?, ?)""", ranges)
+        for i, v in enumerate(values):
+            c.execute("""INSERT INTO event VALUES (?, ?)""", (['N', 'S'][i % 2], v))
+        c.execute("""
+                  SELECT     e.wind_direction, r.a, r.b, COUNT(1)
+                  FROM       event e, windspeed_range r
+                  WHERE      e.w >= r.a AND e.w < r.b
+                  GROUP BY   e.wind_direction, r.a, r.b
+                  """)
+        expected = c.fetchall()
+        c.execute("""SELECT wind_direction, w, COUNT(1) FROM event GROUP BY 1, 2""")
+        self.assertEqual(histogram(c.fetchall(), ranges), expected)
+        conn.close()
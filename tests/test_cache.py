@@ -0,0 +1,104 @@
+import unittest
+import os
+import tempfile
+import datetime
+from wind.database import Database
+from wind.filter import Filter
+from wind.cache import QueryCache, CapturingStream, filter_key
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        self.path = tmpfile.name
+        del(tmpfile)
+        self.database = Database(self.path)
+        testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+""")
+        testfile.close()
+        self.testfile = testfile.name
+        self.filt = Filter(self.database._conn.cursor())
+
+    def tearDown(self):
+        del(self.database)
+        os.remove(self.path)
+        os.remove(self.testfile)
+
+    def test_get_put(self):
+        cache = QueryCache(self.database)
+        key = cache.key('speeds', self.filt, increment=0.5, split=False)
+        self.assertEqual(key, cache.key('speeds', self.filt, split=False, increment=0.5))
+        self.assertNotEqual(key, cache.key('speeds', self.filt, increment=0.5, split=True))
+        self.assertNotEqual(key, cache.key('average', self.filt, increment=0.5, split=False))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, 'speeds', 'a,b\n1,2\n')
+        self.assertEqual(cache.get(key), 'a,b\n1,2\n')
+        self.assertEqual(QueryCache(self.database).get(key), 'a,b\n1,2\n')
+
+    def test_data_version(self):
+        cache = QueryCache(self.database)
+        key = cache.key('speeds', self.filt)
+        cache.put(key, 'speeds', 'result')
+        version = self.database.data_version()
+        self.database.add_file(self.testfile)
+        self.assertGreater(self.database.data_version(), version)
+        cache = QueryCache(self.database)
+        new_key = cache.key('speeds', self.filt)
+        self.assertNotEqual(key, new_key)
+        self.assertIsNone(cache.get(new_key))
+        # results for older versions are removed when a result is stored
+        cache.put(new_key, 'speeds', 'new result')
+        c = self.database._conn.cursor()
+        c.execute("""SELECT key FROM query_cache""")
+        self.assertEqual(c.fetchall(), [(new_key,)])
+
+    def test_data_changed_during_query(self):
+        cache = QueryCache(self.database)
+        key = cache.key('speeds', self.filt)
+        # the data changes while the result is being calculated
+        self.database.add_file(self.testfile)
+        cache.put(key, 'speeds', 'result')
+        self.assertIsNone(cache.get(key))
+        c = self.database._conn.cursor()
+        c.execute("""SELECT COUNT(1) FROM query_cache""")
+        self.assertEqual(c.fetchall()[0][0], 0)
+
+    def test_eviction(self):
+        cache = QueryCache(self.database, max_entries=2, max_bytes=10)
+        keys = [cache.key('average', self.filt, anemometer=i) for i in range(4)]
+        cache.put(keys[0], 'average', '0')
+        cache.put(keys[1], 'average', '1')
+        cache.get(keys[0])
+        cache.put(keys[2], 'average', '2')
+        # keys[1] was the least recently used
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[0]), '0')
+        self.assertEqual(cache.get(keys[2]), '2')
+        # too large to store
+        cache.put(keys[3], 'average', '3' * 11)
+        self.assertIsNone(cache.get(keys[3]))
+        # evicts both others to stay within max_bytes
+        cache.put(keys[3], 'average', '3' * 10)
+        self.assertEqual(cache.get(keys[3]), '3' * 10)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[2]))
+
+    def test_filter_key(self):
+        c = self.database._conn.cursor()
+        self.assertEqual(filter_key(Filter(c, date_filter=datetime.date(2016, 1, 12))),
+                         filter_key(Filter(c, from_filter=datetime.datetime(2016, 1, 12),
+                                              to_filter=datetime.datetime(2016, 1, 12, 23, 59, 59))))
+        self.assertNotEqual(filter_key(Filter(c, date_filter=datetime.date(2016, 1, 12))),
+                            filter_key(Filter(c, date_filter=datetime.date(2016, 1, 13))))
+
+    def test_capturing_stream(self):
+        out = tempfile.TemporaryFile()
+        capture = CapturingStream(out, 5)
+        capture.write('abc')
+        self.assertEqual(capture.captured(), 'abc')
+        capture.write('def')
+        self.assertIsNone(capture.captured())
+        out.seek(0)
+        self.assertEqual(out.read(), 'abcdef')
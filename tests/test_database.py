@@ -2,7 +2,16 @@ import unittest
 import os
 import tempfile
 import datetime
-from wind.database import Database, str2datetime, str2isodatestr
+import calendar
+import sqlite3
+from wind.filter import Filter
+from wind.database import Database, SCHEMA_VERSION, str2datetime, str2isodatestr, TimestampParser, epoch_seconds, iso2epoch, epoch2iso
+
+class Version_1_00_Database(Database):
+    migrations = []
+
+class Version_1_06_Database(Database):
+    migrations = [m for m in Database.migrations if m[1] <= '1_06']
 
 class TestDatabase(unittest.TestCase):
     def setUp(self):
@@ -35,6 +44,42 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(Exception):
             str2isodatestr(None, '%Y%m%d%H%M%S')
 
+    def test_timestamp_parser(self):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        for dt, tm in [('01/02/2003', '12:13:14'), 
+                       ('01-02-2003', '2:13:14'),
+                       ('01-02-03', '12:13:14'),
+                       ('01-02-99', '12:13:14'),
+                       ('2003-02-01', '12:13:14'),
+                       ('20030201', '12:13:14')]:
+            parser = TimestampParser()
+            # The first call detects the layout, the second uses the fast path
+            for i in range(2):
+                self.assertEqual(parser.isodatestr(dt, tm),
+                                 str2isodatestr('%sT%s' % (dt, tm), fmt))
+        # A change of layout part way through a file is still handled
+        parser = TimestampParser()
+        self.assertEqual(parser.isodatestr('01-02-2003', '12:13:14'), '2003-02-01 12:13:14')
+        self.assertEqual(parser.isodatestr('2003-02-02', '12:13:14'), '2003-02-02 12:13:14')
+        self.assertEqual(parser.isodatestr('03-02-2003', '12:13:14'), '2003-02-03 12:13:14')
+        # ... and bad values raise exceptions just like str2isodatestr
+        for dt, tm in [('31-02-2003', '12:13:14'), 
+                       ('01-02-2003', '25:13:14'), 
+                       ('01-x2-2003', '12:13:14'), 
+                       ('01-02-2003', '12:13'), 
+                       ('', '')]:
+            with self.assertRaises(Exception):
+                parser.isodatestr(dt, tm)
+
+    def test_epoch_seconds(self):
+        for ts in [datetime.datetime(1970, 1, 1, 0, 0, 0),
+                   datetime.datetime(2000, 2, 29, 23, 59, 59),
+                   datetime.datetime(2016, 1, 12, 19, 34, 10),
+                   datetime.datetime(2100, 3, 1, 1, 2, 3)]:
+            expected = calendar.timegm(ts.timetuple())
+            self.assertEqual(epoch_seconds(ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second), expected)
+            self.assertEqual(iso2epoch(ts.strftime('%Y-%m-%d %H:%M:%S')), expected)
+
     def test_create_database_creation(self):
         d, path = self.make_me_a_new_database()
         self.assertTrue(os.path.exists(path))
@@ -71,7 +116,114 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(info['Number of files added'], 0)
         self.assertEqual(info['Number of records'], 0)
 
+    def test_schema_upgrade(self):
+        d, path = self.make_me_a_new_database()
+        self.assertEqual(d.schema_version(), SCHEMA_VERSION)
+        c = d._conn.cursor()
+        filt = Filter(c, date_filter=datetime.date(2016, 1, 12))
+        self.assertTrue('event__event_end' in self.query_plan(c, 'event', filt.event_criteria()))
+        del(d)
+        os.remove(path)
+        # Make a version 1_00 database, from before the indexes
+        d = Version_1_00_Database(path)
+        self.assertEqual(d.schema_version(), '1_00')
+        del(d)
+        conn = sqlite3.connect(path)
+        c = conn.cursor()
+        self.assertFalse('event__event_end' in self.query_plan(c, 'event', filt.event_criteria()))
+        self.assertFalse('raw_data__file_id' in self.query_plan(c, 'raw_data', ('file_id = ? AND processed = 0', [1])))
+        conn.close()
+        # Re-opening upgrades the database in place
+        d = Database(path)
+        self.assertEqual(d.schema_version(), SCHEMA_VERSION)
+        c = d._conn.cursor()
+        self.assertTrue('event__event_end' in self.query_plan(c, 'event', filt.event_criteria()))
+        self.assertTrue('event__file_id' in self.query_plan(c, 'event', ('file_id = ?', [1])))
+        self.assertTrue('raw_data__file_id' in self.query_plan(c, 'raw_data', ('file_id = ? AND processed = 0', [1])))
+        del(d)
+        os.remove(path)
+
+    def test_schema_upgrade_to_epoch_timestamps(self):
+        d, path = self.make_me_a_new_database()
+        del(d)
+        os.remove(path)
+        d = Version_1_06_Database(path)
+        self.assertEqual(d.schema_version(), '1_06')
+        c = d._conn.cursor()
+        c.execute("""INSERT INTO input_file (path) VALUES ('f.csv')""")
+        c.executemany("""
+                      INSERT INTO raw_data (file_id, ref, dt, tm, wind_1, wind_2, direction, 
+                                            irradiance, batt_v, processed, ts)
+                      VALUES (1, 'BB', '12-01-2016', ?, 1, 2, 'N', 0.1, 4.7, 1, ?)
+                      """, [('23:59:00', '2016-01-12 23:59:00'), ('00:01:00', '2016-01-13 00:01:00')])
+        c.execute("""
+                  INSERT INTO event (ref, file_id, event_start, event_end, windspeed_ms_1, wind_direction)
+                  VALUES ('BB', 1, '2016-01-12 23:59:00', '2016-01-13 00:01:00', 1.5, 'N')
+                  """)
+        c.executemany("""INSERT INTO windspeed_rollup VALUES ('2016-01-13', 'BB', 'N', ?, ?, 1)""",
+                      [(1, 1.5), (2, None)])
+        del(c, d)
+        # Re-opening converts the timestamps to epoch seconds
+        d = Database(path)
+        self.assertEqual(d.schema_version(), SCHEMA_VERSION)
+        c = d._conn.cursor()
+        c.execute("""SELECT rowid, ts, ts / 86400 FROM raw_data ORDER BY rowid""")
+        day = iso2epoch('2016-01-13 00:00:00') // 86400
+        self.assertEqual(c.fetchall(), [(1, iso2epoch('2016-01-12 23:59:00'), day - 1),
+                                        (2, iso2epoch('2016-01-13 00:01:00'), day)])
+        c.execute("""SELECT id, event_start, event_end, event_end / 86400 FROM event""")
+        self.assertEqual(c.fetchall(), [(1, iso2epoch('2016-01-12 23:59:00'), iso2epoch('2016-01-13 00:01:00'), day)])
+        c.execute("""SELECT day, anemometer, windspeed, count FROM windspeed_rollup ORDER BY anemometer""")
+        self.assertEqual(c.fetchall(), [(day, 1, 1.5, 1), (day, 2, None, 1)])
+        self.assertEqual(d.info()['Last event'], '2016-01-13 00:01:00')
+        filt = Filter(c, date_filter=datetime.date(2016, 1, 13))
+        self.assertEqual(filt.count_selected_events(), 1)
+        self.assertEqual(filt.count_selected_raw_data(), 1)
+        self.assertTrue('raw_data__ts' in self.query_plan(c, 'raw_data', filt.raw_data_criteria()))
+        # new events carry on from the old ids
+        c.execute("""INSERT INTO event (ref, file_id, event_start, event_end) VALUES ('BB', 1, 0, 1)""")
+        self.assertEqual(c.lastrowid, 2)
+        del(c, d)
+        os.remove(path)
+
+    def test_epoch2iso(self):
+        self.assertEqual(epoch2iso(iso2epoch('2016-01-12 19:34:10')), '2016-01-12 19:34:10')
+        self.assertEqual(epoch2iso(None), None)
+        parser = TimestampParser()
+        for dt, tm in [('12-01-2016', '19:34:10'), ('12-01-2016', '9:34:10'), ('2016-01-13', '00:00:00')]:
+            self.assertEqual(parser.epoch(dt, tm), iso2epoch(parser.isodatestr(dt, tm)))
+
+    def test_db_profile(self):
+        d, path = self.make_me_a_new_database()
+        del(d)
+        d = Database(path, profile='fast')
+        c = d._conn.cursor()
+        c.execute("""PRAGMA journal_mode""")
+        self.assertEqual(c.fetchall()[0][0], 'wal')
+        # journal_mode is stored in the database, safe leaves it alone, so
+        # can be opened while a fast connection is open
+        d2 = Database(path, profile='safe')
+        c = d2._conn.cursor()
+        c.execute("""PRAGMA journal_mode""")
+        self.assertEqual(c.fetchall()[0][0], 'wal')
+        c.execute("""PRAGMA synchronous""")
+        self.assertEqual(c.fetchall()[0][0], 2)
+        del(c, d, d2)
+        d = Database(path, profile='rollback')
+        c = d._conn.cursor()
+        c.execute("""PRAGMA journal_mode""")
+        self.assertEqual(c.fetchall()[0][0], 'delete')
+        del(c, d)
+        with self.assertRaises(Exception):
+            Database(path, profile='reckless')
+        os.remove(path)
+
     # Utility functions
+    def query_plan(self, cursor, table, criteria):
+        where, params = criteria
+        cursor.execute("""EXPLAIN QUERY PLAN SELECT * FROM %s WHERE %s""" % (table, where), params)
+        return ' '.join([str(r[-1]) for r in cursor.fetchall()])
+
     def make_me_a_new_database(self):
         tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
         path = tmpfile.name
@@ -0,0 +1,57 @@
+import unittest
+import random
+from wind.database import iso2epoch
+from wind.events import derive_events_python, derive_events_numpy, numpy
+
+calibration = {'BB': {'ref': 'BB',
+                      'anemometer_1_factor': 1.42,
+                      'anemometer_2_factor': 1.42,
+                      'max_windspeed_ms': 100,
+                      'irradiance_factor': 1.0,
+                      'max_irradiance': 1500},
+               'NOMAX': {'ref': 'NOMAX',
+                         'anemometer_1_factor': 1.0,
+                         'anemometer_2_factor': 1.0,
+                         'max_windspeed_ms': None,
+                         'irradiance_factor': 1.0,
+                         'max_irradiance': 1500}}
+
+def make_row(ts, ref='BB', wind_1=1, wind_2=2, direction='N', irradiance=0.5):
+    return (ts, iso2epoch(ts), ref, wind_1, wind_2, direction, irradiance)
+
+class TestEvents(unittest.TestCase):
+    def test_python_events(self):
+        rows = [make_row('2016-01-12 10:00:00'),
+                make_row('2016-01-12 10:01:00', wind_1=1000000),
+                make_row('2016-01-12 10:02:00'),
+                make_row('2016-01-12 10:02:00'),
+                make_row('2016-01-12 10:03:00', ref='XX'),
+                make_row('2016-01-12 10:04:00', wind_2='bad'),
+                make_row('2016-01-12 10:05:00', ref='NOMAX'),
+                make_row('2016-01-12 10:06:00', irradiance=2000),
+                make_row('2016-01-12 10:07:00', wind_1=60)]
+        events, accepted = derive_events_python(rows, calibration)
+        self.assertEqual(accepted, [2, 8])
+        # The rejected record at 10:01 does not start an event
+        self.assertEqual(events[0][1:4], ('2016-01-12 10:00:00', '2016-01-12 10:02:00', 120.0))
+        self.assertEqual(events[1][1:4], ('2016-01-12 10:02:00', '2016-01-12 10:07:00', 300.0))
+        self.assertEqual(events[1][4], 0.2)
+        self.assertEqual(events[1][7], 60 / 300.0 * 1.42)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        rng = random.Random(42)
+        for trial in range(20):
+            rows = []
+            epoch = 0
+            for i in range(rng.randint(0, 300)):
+                epoch += rng.choice([0, 1, 1, 1, 2, 60])
+                rows.append(('ts%d' % i, epoch, 
+                             rng.choice(['BB', 'BB', 'BB', 'XX', 'NOMAX']),
+                             rng.choice([0, 1, 5, 100, 3000, 'bad']),
+                             rng.choice([0, 1, 5, 100, 3000]),
+                             rng.choice(['N', 'S']),
+                             rng.choice([0.1, 0.5, 2000, None])))
+            for start in [None, ('start', -1)]:
+                self.assertEqual(derive_events_numpy(rows, calibration, start),
+                                 derive_events_python(rows, calibration, start))
@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+import datetime
+from wind.database import Database
+from wind.filter import Filter
+from wind.analysis import selected_value_counts, parallel_value_counts
+from wind.eventstore import event_store_path, numpy
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        self.path = tmpfile.name
+        del(tmpfile)
+        self.database = Database(self.path)
+        self.testfiles = []
+        for day, direction in [('12', 'N'), ('13', 'SW'), ('14', 'NE')]:
+            testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+            testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,%s-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,%s-01-2016,10:01:00,3,4,%s,0.20,4.72
+BB,%s-01-2016,10:02:00,5,6,E,0.30,4.70
+BB,%s-01-2016,10:02:30,5,6,N,0.30,4.70
+""" % (day, day, direction, day, day))
+            testfile.close()
+            self.testfiles.append(testfile.name)
+
+    def tearDown(self):
+        del(self.database)
+        os.remove(self.path)
+        shutil.rmtree(event_store_path(self.path))
+        for path in self.testfiles:
+            os.remove(path)
+
+    def assertStoreMatches(self):
+        c = self.database._conn.cursor()
+        store = self.database.current_event_store()
+        self.assertNotEqual(store, None)
+        for filt in [Filter(c),
+                     Filter(c, date_filter=datetime.date(2016, 1, 13)),
+                     Filter(c, from_filter=datetime.datetime(2016, 1, 12, 10, 2, 0)),
+                     Filter(c, to_filter=datetime.datetime(2016, 1, 13, 10, 1, 0)),
+                     Filter(c, file_filter=self.testfiles[0])]:
+            for anemometer in [1, 2]:
+                for split in [False, True]:
+                    self.assertEqual(
+                        sorted(selected_value_counts(c, filt, anemometer, split, store=store)),
+                        sorted(selected_value_counts(c, filt, anemometer, split)))
+            self.assertEqual(
+                sorted(selected_value_counts(c, filt, 1, True, lowest=0.02, highest=0.1, store=store)),
+                sorted(selected_value_counts(c, filt, 1, True, lowest=0.02, highest=0.1)))
+
+    def test_event_store(self):
+        self.database.add(self.testfiles[:2])
+        self.assertEqual(self.database.convert_event_store(), 6)
+        self.assertEqual(self.database.event_store.days(), ['2016-01-12', '2016-01-13'])
+        self.assertStoreMatches()
+        # re-opening the database uses the store, which is kept up to date
+        del(self.database)
+        self.database = Database(self.path)
+        self.database.add(self.testfiles[2:])
+        self.assertStoreMatches()
+        c = self.database._conn.cursor()
+        c.execute("""SELECT id FROM input_file WHERE path = ?""", (self.testfiles[1],))
+        self.database.remove_file(c.fetchall()[0][0])
+        self.assertEqual(self.database.event_store.days(), ['2016-01-12', '2016-01-14'])
+        self.assertStoreMatches()
+        c.execute("""UPDATE calibration SET anemometer_1_factor = 2.0, max_windspeed_ms = 0.1""")
+        self.database.recalibrate()
+        self.assertStoreMatches()
+
+    def test_event_store_writers(self):
+        self.database.add(self.testfiles[:1])
+        # a second database opened before the store was made, which adds
+        # a direction at the same time as the first
+        other = Database(self.path)
+        self.database.convert_event_store()
+        other.add(self.testfiles[1:2])
+        self.database.add(self.testfiles[2:])
+        del(other)
+        self.assertEqual(sorted(self.database.event_store._dictionaries['direction']), ['E', 'N', 'NE', 'SW'])
+        self.assertStoreMatches()
+        # a change which did not reach the store (as if the process was
+        # killed) leaves it out of date, and the event table is read
+        store = self.database.event_store
+        store.set_version(store.version() - 1)
+        self.assertEqual(self.database.current_event_store(), None)
+        c = self.database._conn.cursor()
+        c.execute("""SELECT id FROM input_file WHERE path = ?""", (self.testfiles[1],))
+        self.database.remove_file(c.fetchall()[0][0])
+        self.assertEqual(self.database.current_event_store(), None)
+        self.assertEqual(store.days(), ['2016-01-12', '2016-01-13', '2016-01-14'])
+        self.assertEqual(self.database.convert_event_store(), 6)
+        self.assertStoreMatches()
+
+    def test_parallel_value_counts(self):
+        self.database.add(self.testfiles)
+        self.database.convert_event_store()
+        c = self.database._conn.cursor()
+        for store in [None, self.database.current_event_store()]:
+            for filt in [Filter(c),
+                         Filter(c, date_filter=datetime.date(2016, 1, 13)),
+                         Filter(c, from_filter=datetime.datetime(2000, 1, 1, 0, 0, 0)),
+                         Filter(c, from_filter=datetime.datetime(2016, 1, 12, 10, 2, 0),
+                                to_filter=datetime.datetime(2020, 1, 1, 0, 0, 0)),
+                         Filter(c, to_filter=datetime.datetime(2016, 1, 13, 10, 1, 0)),
+                         Filter(c, file_filter=self.testfiles[1]),
+                         Filter(c, from_filter=datetime.datetime(2017, 1, 1, 0, 0, 0))]:
+                for split in [False, True]:
+                    self.assertEqual(
+                        sorted(parallel_value_counts(self.path, c, filt, 1, split, 3, store=store)),
+                        sorted(selected_value_counts(c, filt, 1, split)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+from datetime import datetime
+from wind.database import Database, iso2epoch
+from wind.export import export_events, numpy, pyarrow, EXPORT_COLUMNS
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        self.path = tmpfile.name
+        del(tmpfile)
+        self.database = Database(self.path)
+        self.testfile = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        self.testfile.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+BB,12-01-2016,10:02:00,5,6,E,0.30,4.70
+""")
+        self.testfile.close()
+        self.database.add([self.testfile.name])
+
+    def tearDown(self):
+        del(self.database)
+        os.remove(self.path)
+        os.remove(self.testfile.name)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_export_npz(self):
+        c = self.database._conn.cursor()
+        output = tempfile.NamedTemporaryFile(suffix='.npz', delete=False)
+        output.close()
+        try:
+            # a batch size of 1 so the batches are joined
+            export_events(c, 'event_end > ?', [iso2epoch('2016-01-12 10:00:00')], 'npz', output.name, size=1)
+            result = numpy.load(output.name)
+            self.assertEqual(result['event_end'].dtype, numpy.dtype('datetime64[s]'))
+            self.assertEqual([str(t) for t in result['event_end']], ['2016-01-12T10:01:00', '2016-01-12T10:02:00'])
+            self.assertEqual(list(result['ref']), ['BB', 'BB'])
+            self.assertEqual(list(result['wind_direction']), ['N', 'E'])
+            c.execute("""SELECT windspeed_ms_1 FROM event ORDER BY event_end""")
+            self.assertEqual(list(result['windspeed_ms_1']), [r[0] for r in c.fetchall()])
+            result.close()
+            # no events is still a file of empty columns
+            export_events(c, 'event_end > ?', [iso2epoch('2017-01-01 00:00:00')], 'npz', output.name)
+            result = numpy.load(output.name)
+            self.assertEqual(len(result['event_start']), 0)
+            self.assertEqual(result['event_start'].dtype, numpy.dtype('datetime64[s]'))
+            result.close()
+        finally:
+            os.remove(output.name)
+
+    def check_arrow_round_trip(self, fmt, read_table):
+        c = self.database._conn.cursor()
+        output = tempfile.NamedTemporaryFile(suffix='.' + fmt, delete=False)
+        output.close()
+        try:
+            # a batch size of 1 so there are several batches
+            export_events(c, 'event_end > ?', [iso2epoch('2016-01-12 10:00:00')], fmt, output.name, size=1)
+            result = read_table(output.name)
+            self.assertEqual(result.num_rows, 2)
+            types = dict(zip(result.schema.names, result.schema.types))
+            self.assertEqual(types['event_end'], pyarrow.timestamp('s'))
+            self.assertEqual(types['windspeed_ms_1'], pyarrow.float64())
+            self.assertEqual(result.column('event_end').to_pylist(),
+                             [datetime(2016, 1, 12, 10, 1), datetime(2016, 1, 12, 10, 2)])
+            self.assertEqual(result.column('ref').to_pylist(), ['BB', 'BB'])
+            self.assertEqual(result.column('wind_direction').to_pylist(), ['N', 'E'])
+            c.execute("""SELECT windspeed_ms_1 FROM event ORDER BY event_end""")
+            self.assertEqual(result.column('windspeed_ms_1').to_pylist(), [r[0] for r in c.fetchall()])
+            # no events is still a file with the columns
+            export_events(c, 'event_end > ?', [iso2epoch('2017-01-01 00:00:00')], fmt, output.name)
+            result = read_table(output.name)
+            self.assertEqual(result.num_rows, 0)
+            self.assertEqual(result.schema.names, [name for name, sql, column_type in EXPORT_COLUMNS])
+        finally:
+            os.remove(output.name)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_export_parquet(self):
+        self.check_arrow_round_trip('parquet', lambda path: pyarrow.parquet.read_table(path))
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_export_arrow(self):
+        self.check_arrow_round_trip('arrow', lambda path: pyarrow.ipc.open_file(path).read_all())
+
+if __name__ == '__main__':
+    unittest.main()
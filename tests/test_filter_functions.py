@@ -1,10 +1,15 @@
 import unittest
 import os
 import tempfile
-from wind.database import Database
+from wind.database import Database, iso2epoch
 from wind.filter import Filter
+from wind.analysis import windspeed_value_counts, selected_value_counts
 import datetime
 
+def day(s):
+    """Return the day number of a 'YYYY-MM-DD' string."""
+    return iso2epoch(s + ' 00:00:00') // 86400
+
 class TestFilterFunctions(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -43,6 +48,15 @@ BB,13-01-2016,19:34:17,1,2,SW,0.50,4.72
         events = filt.select_events()
         self.assertEqual(len(events), 9)
 
+    def test_iter_events(self):
+        c = self._db._conn.cursor()
+        filt = Filter(c, date_filter=datetime.date(2016, 1, 13))
+        events = filt.iter_events()
+        # The filter's cursor can still be used while iterating
+        self.assertEqual(filt.count_selected_raw_data(), 5)
+        self.assertEqual(list(events), filt.select_events())
+        self.assertEqual(len(list(filt.iter_raw_data())), 5)
+
     def test_file_filter(self):
         c = self._db._conn.cursor()
         filt = Filter(c, file_filter=self._testfile.name)
@@ -114,3 +128,47 @@ BB,13-01-2016,19:34:17,1,2,SW,0.50,4.72
         self.assertEqual(len(events), 2)
         self.assertEqual(len(raw_data), 2)
 
+
+    def test_rollup_split(self):
+        c = self._db._conn.cursor()
+        self.assertEqual(Filter(c, file_filter=self._testfile.name).rollup_split(), None)
+        self.assertEqual(Filter(c).rollup_split(), (None, None, '0', []))
+        filt = Filter(c, date_filter=datetime.date(2016, 1, 12))
+        self.assertEqual(filt.rollup_split()[:2], (day('2016-01-12'), day('2016-01-12')))
+        filt = Filter(c, from_filter=datetime.datetime(2016, 1, 12, 19, 34, 16))
+        self.assertEqual(filt.rollup_split()[:2], (day('2016-01-13'), None))
+        filt = Filter(c, to_filter=datetime.datetime(2016, 1, 13, 23, 59, 59))
+        self.assertEqual(filt.rollup_split()[:2], (None, day('2016-01-13')))
+        filt = Filter(c, from_filter=datetime.datetime(2016, 1, 12, 19, 34, 16),
+                      to_filter=datetime.datetime(2016, 1, 13, 19, 34, 15))
+        self.assertEqual(filt.rollup_split(), None)
+
+    def test_rollup_matches_events(self):
+        c = self._db._conn.cursor()
+        filters = [dict(),
+                   dict(date_filter=datetime.date(2016, 1, 13)),
+                   dict(from_filter=datetime.datetime(2016, 1, 12, 19, 34, 16)),
+                   dict(from_filter=datetime.datetime(2016, 1, 12), 
+                        to_filter=datetime.datetime(2016, 1, 13, 19, 34, 15)),
+                   dict(to_filter=datetime.datetime(2016, 1, 12, 19, 34, 16))]
+        for kwargs in filters:
+            filt = Filter(c, **kwargs)
+            where, params = filt.event_criteria()
+            for anemometer in [1, 2]:
+                for split in [False, True]:
+                    expected = windspeed_value_counts(c, where, params, 
+                                                      'windspeed_ms_%d' % anemometer, split)
+                    self.assertEqual(sorted(selected_value_counts(c, filt, anemometer, split)), 
+                                     sorted(expected))
+        # The rollup is maintained when events are removed
+        where, params = Filter(c, to_filter=datetime.datetime(2016, 1, 13, 19, 34, 11)).event_criteria()
+        days = self._db.event_days(c, where, params)
+        self.assertEqual(sorted(days), [day('2016-01-12'), day('2016-01-13')])
+        c.execute('begin')
+        c.execute("""DELETE FROM event WHERE %s""" % where, params)
+        self._db.refresh_rollup(c, days)
+        filt = Filter(c)
+        self.assertEqual(sorted(selected_value_counts(c, filt, 1, True)), 
+                         sorted(windspeed_value_counts(c, '1', [], 'windspeed_ms_1', True)))
+        self.assertEqual(sum(vc[2] for vc in selected_value_counts(c, filt, 1, False)), 3)
+        self._db._conn.rollback()
@@ -33,6 +33,33 @@ BB,12-01-2016,19:34:16,5,10,W,5.67,4.72
         self.assertEqual(input_file[0]['irradiance'], 1.23)
         self.assertEqual(input_file[0]['batt_v'], 4.72)
 
+    def test_iterate_records(self):
+        input_file = InputFile(self.testfile.name, self.database)
+        records = iter(input_file)
+        self.assertEqual(next(records)['wind_1'], 1)
+        self.assertEqual(next(records)['wind_1'], 2)
+        self.assertEqual([r['wind_2'] for r in records], [8, 9, 10])
+        # Each iteration re-reads the file from the start
+        self.assertEqual(len(list(input_file)), 5)
+
+    def test_parse_plan_shared(self):
+        first = InputFile(self.testfile.name, self.database)
+        second = InputFile(self.testfile.name, self.database)
+        self.assertEqual(list(first), list(second))
+        self.assertTrue(first._plan is second._plan)
+        self.assertEqual(first._plan[3], (3, 'wind_1', int))
+        self.assertEqual(len(self.database._parse_plans), 1)
+
+    def test_read_line_bad_values(self):
+        input_file = InputFile(self.testfile.name, self.database)
+        list(input_file)
+        record = input_file.read_line('BB,12-01-2016,19:34:10,X,6')
+        # a value which cannot be cast is kept as text, missing values are left out
+        self.assertEqual(record, {'ref': 'BB', 'dt': '12-01-2016', 'tm': '19:34:10', 
+                                  'wind_1': 'X', 'wind_2': 6})
+        # counted, to be logged once per file
+        self.assertEqual(input_file.cast_failures, {'wind_1': 1})
+
     # Utility functions
     def make_me_a_new_database(self):
         tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
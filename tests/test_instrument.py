@@ -0,0 +1,54 @@
+import unittest
+from wind import instrument
+
+class TestInstrument(unittest.TestCase):
+    def tearDown(self):
+        instrument.enabled = False
+        instrument.reset()
+
+    def test_disabled(self):
+        with instrument.phase('a'):
+            pass
+        self.assertEqual(list(instrument.timed_iter('b', [1, 2])), [1, 2])
+        instrument.count('c', 3)
+        self.assertEqual(instrument.report(), {'phases': {}, 'counters': {}})
+
+    def test_enabled(self):
+        instrument.enable()
+        with instrument.phase('a'):
+            pass
+        with instrument.phase('a'):
+            pass
+        self.assertEqual(list(instrument.timed_iter('b', [1, 2, 3])), [1, 2, 3])
+        instrument.count('c', 3)
+        instrument.count('c')
+        report = instrument.report()
+        self.assertEqual(report['phases']['a']['calls'], 2)
+        self.assertEqual(report['phases']['b']['calls'], 3)
+        self.assertEqual(report['counters'], {'c': 4})
+        self.assertTrue('PHASE' in instrument.format_report())
+
+    def test_merge_worker_report(self):
+        instrument.enable()
+        instrument.count('c', 2)
+        parent = instrument.report()
+        # a forked worker inherits the parent's records, and discards them
+        instrument.start_worker(True)
+        with instrument.phase('a'):
+            pass
+        instrument.count('c', 3)
+        worker = instrument.report()
+        self.assertEqual(worker['counters'], {'c': 3})
+        instrument.reset()
+        instrument.merge(parent)
+        instrument.merge(worker)
+        instrument.merge(worker)
+        report = instrument.report()
+        self.assertEqual(report['phases']['a']['calls'], 2)
+        self.assertEqual(report['counters'], {'c': 8})
+        instrument.start_worker(False)
+        instrument.count('c')
+        self.assertEqual(instrument.report()['counters'], {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import os
+import shutil
+import tempfile
+from wind.database import Database
+from wind.watch import Watcher
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.sqlite3')
+        self.path = tmpfile.name
+        del(tmpfile)
+        self.database = Database(self.path)
+
+    def tearDown(self):
+        del(self.database)
+        os.remove(self.path)
+        shutil.rmtree(self.directory)
+
+    def test_scan(self):
+        watcher = Watcher(self.database, self.directory)
+        self.assertEqual(watcher.scan(), 0)
+        path = os.path.join(self.directory, 'D160112.CSV')
+        with open(path, 'w') as f:
+            f.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+BB,12-01-2016,10:01:00,3,4,N,0.20,4.72
+""")
+        with open(os.path.join(self.directory, 'notes.txt'), 'w') as f:
+            f.write('not an input file\n')
+        self.assertEqual(watcher.scan(), 2)
+        self.assertEqual(watcher.scan(), 0)
+        with open(path, 'a') as f:
+            f.write("""BB,12-01-2016,10:02:00,5,6,E,0.30,4.70\n""")
+        self.assertEqual(watcher.scan(), 1)
+        c = self.database._conn.cursor()
+        c.execute("""SELECT datetime(event_start, 'unixepoch'), datetime(event_end, 'unixepoch') FROM event ORDER BY id""")
+        self.assertEqual(c.fetchall(), [('2016-01-12 10:00:00', '2016-01-12 10:01:00'),
+                                        ('2016-01-12 10:01:00', '2016-01-12 10:02:00')])
+
+    def test_scan_survives_errors(self):
+        watcher = Watcher(self.database, self.directory)
+        path = os.path.join(self.directory, 'D160112.CSV')
+        with open(path, 'w') as f:
+            f.write("""Ref, Date, Time, Wind 1, Wind 2, Direction, Irradiance Wm-2, Batt V
+BB,12-01-2016,10:00:00,1,2,W,0.10,4.72
+""")
+        update_file = self.database.update_file
+        def fail(path):
+            raise IOError('file vanished')
+        self.database.update_file = fail
+        self.assertEqual(watcher.scan(), 0)
+        # the file is tried again on the next scan, although it has not changed
+        self.database.update_file = update_file
+        self.assertEqual(watcher.scan(), 1)
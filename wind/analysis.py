@@ -0,0 +1,265 @@
+"""
+Provide windspeed analysis functions (speeds transform and averages).
+
+Both are calculated from value counts: the number of events with each
+distinct windspeed (and wind direction).  See selected_value_counts.
+Value counts for separate sets of events can be merged exactly, so they
+can also be calculated for partitions of a date range in parallel (see
+parallel_value_counts).
+"""
+
+import os
+import logging
+import math
+import sqlite3
+import multiprocessing
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+from wind import instrument
+from wind.filter import Filter
+from wind.eventstore import EventStore, event_store_path
+
+log = logging
+
+def windspeed_ranges(lowest, highest, increment):
+    """
+    Return a list of (a, b) windspeed ranges covering lowest to highest.
+
+    Each range is a <= windspeed < b.  The boundaries are accumulated by
+    repeatedly adding increment, so they are exactly the values the
+    speeds transform has always used.
+    """
+    if increment <= 0.0:
+        raise Exception('--increment must be greater than 0.0')
+    ranges = []
+    a = lowest
+    while a < highest:
+        b = a + increment
+        ranges.append((a, b))
+        a = b
+    return ranges
+
+def windspeed_value_counts(cursor, where, params, wind_field, split, lowest=None, highest=None):
+    """
+    Return a list of (direction, windspeed, count) for the selected events.
+
+    There is one entry per distinct windspeed (and direction if split is
+    True, else direction is None), so this is a single pass over the
+    selected events whose result does not depend on how finely the
+    windspeeds are later binned.  where and params are as returned by
+    Filter.event_criteria().  If lowest/highest are given, windspeeds
+    outside lowest <= windspeed < highest are not counted.
+    """
+    clauses, range_params = [where], list(params)
+    if lowest is not None:
+        clauses.append('%s >= ?' % wind_field)
+        range_params.append(lowest)
+    if highest is not None:
+        clauses.append('%s < ?' % wind_field)
+        range_params.append(highest)
+    direction = 'wind_direction' if split else 'NULL'
+    cursor.execute("""
+                   SELECT          %s, %s, COUNT(1)
+                   FROM            event
+                   WHERE           %s
+                   GROUP BY        1, 2
+                   """ % (direction, wind_field, ' AND '.join(clauses)), range_params)
+    return cursor.fetchall()
+
+def rollup_value_counts(cursor, first_day, last_day, anemometer, split, lowest=None, highest=None):
+    """
+    Return a list of (direction, windspeed, count) like windspeed_value_counts
+    for the events of whole days first_day to last_day (day numbers, None
+    meaning unbounded), read from the windspeed_rollup table.
+    """
+    clauses, params = ['anemometer = ?'], [anemometer]
+    if first_day is not None:
+        clauses.append('day >= ?')
+        params.append(first_day)
+    if last_day is not None:
+        clauses.append('day <= ?')
+        params.append(last_day)
+    if lowest is not None:
+        clauses.append('windspeed >= ?')
+        params.append(lowest)
+    if highest is not None:
+        clauses.append('windspeed < ?')
+        params.append(highest)
+    direction = 'direction' if split else 'NULL'
+    cursor.execute("""
+                   SELECT          %s, windspeed, SUM(count)
+                   FROM            windspeed_rollup
+                   WHERE           %s
+                   GROUP BY        1, 2
+                   """ % (direction, ' AND '.join(clauses)), params)
+    return cursor.fetchall()
+
+def merge_value_counts(value_counts):
+    """Return value_counts with the counts for the same direction and windspeed added up."""
+    merged = dict()
+    for direction, windspeed, count in value_counts:
+        key = (direction, windspeed)
+        merged[key] = merged.get(key, 0) + count
+    return [(direction, windspeed, count) for (direction, windspeed), count in merged.items()]
+
+def selected_value_counts(cursor, filt, anemometer, split, lowest=None, highest=None, store=None):
+    """
+    Return a list of (direction, windspeed, count) like windspeed_value_counts
+    for the events selected by Filter filt.  Whole days are read from the 
+    windspeed_rollup table, and only events in part-selected days (or all
+    events if there is a file filter) are read from the event table.  If
+    store (a wind.eventstore.EventStore) is given, everything is read from
+    it instead.
+    """
+    if store is not None:
+        return store_value_counts(cursor, filt, anemometer, split, lowest, highest, store)
+    wind_field = 'windspeed_ms_%d' % anemometer
+    rollup = filt.rollup_split()
+    if rollup is None:
+        where, params = filt.event_criteria()
+        with instrument.phase('query.events'):
+            return windspeed_value_counts(cursor, where, params, wind_field, split, lowest, highest)
+    first_day, last_day, where, params = rollup
+    log.debug('using windspeed_rollup for days %s to %s' % (first_day, last_day))
+    with instrument.phase('query.rollup'):
+        value_counts = rollup_value_counts(cursor, first_day, last_day, anemometer, split, lowest, highest)
+    instrument.count('query.rollup_value_counts', len(value_counts))
+    if where != '0':
+        with instrument.phase('query.events'):
+            value_counts.extend(windspeed_value_counts(cursor, where, params, wind_field, split, lowest, highest))
+    return merge_value_counts(value_counts)
+
+def store_value_counts(cursor, filt, anemometer, split, lowest, highest, store):
+    """selected_value_counts for the events in an EventStore."""
+    lower, upper = filt.time_bounds()
+    file_ids = None
+    if filt.file_filter is not None:
+        cursor.execute("""SELECT id FROM input_file WHERE path = ?""", (filt.file_filter,))
+        file_ids = [r[0] for r in cursor.fetchall()]
+    with instrument.phase('query.store'):
+        value_counts = store.value_counts(anemometer, split, lower, upper, file_ids, lowest, highest)
+    instrument.count('query.store_value_counts', len(value_counts))
+    return value_counts
+
+def date_partitions(lower, upper, count):
+    """
+    Split the datetimes lower to upper (inclusive) into up to count 
+    contiguous (lower, upper) ranges, which do not overlap and start and
+    end on day boundaries (except for lower and upper themselves), so
+    whole days can still be read from windspeed_rollup.
+    """
+    first, last = lower.date(), upper.date()
+    days = (last - first).days + 1
+    count = max(1, min(count, days))
+    result = []
+    for i in range(count):
+        start = datetime.combine(first + timedelta(days=days * i // count), time(0, 0, 0))
+        end = datetime.combine(first + timedelta(days=days * (i + 1) // count), time(0, 0, 0))
+        result.append((max(lower, start), min(upper, end - timedelta(seconds=1))))
+    return result
+
+def partition_value_counts(task):
+    """
+    Return selected_value_counts for one partition, in a worker process of
+    parallel_value_counts, using its own read-only connection, and the
+    worker's instrument.report() for it.
+    """
+    (database_path, file_filter, lower, upper, anemometer, split, lowest, highest, use_store,
+     profile) = task
+    instrument.start_worker(profile)
+    conn = sqlite3.connect(database_path)
+    try:
+        conn.execute("""PRAGMA query_only = ON""")
+        cursor = conn.cursor()
+        filt = Filter(cursor, file_filter=file_filter, from_filter=lower, to_filter=upper)
+        store = None
+        if use_store:
+            store = EventStore(event_store_path(database_path))
+        value_counts = selected_value_counts(cursor, filt, anemometer, split, lowest, highest, store)
+        return value_counts, instrument.report()
+    finally:
+        conn.close()
+
+def parallel_value_counts(database_path, cursor, filt, anemometer, split, jobs,
+                          lowest=None, highest=None, store=None):
+    """
+    Return the same list of (direction, windspeed, count) as
+    selected_value_counts, calculated for up to jobs partitions of the 
+    selected dates (see date_partitions) by a pool of jobs worker 
+    processes, and merged.  The dates partitioned are those of the first
+    and last selected events, so a filter wider than the data (or with an
+    unbounded end) does not leave workers with nothing to do.  If there
+    are fewer than two partitions (e.g. a single day is selected) the 
+    value counts are calculated here.
+    """
+    lower, upper = None, None
+    if jobs > 1:
+        where, params = filt.event_criteria()
+        cursor.execute("""SELECT MIN(event_end), MAX(event_end) FROM event WHERE %s""" % where, params)
+        first, last = cursor.fetchall()[0]
+        if first is not None:
+            lower, upper = datetime.utcfromtimestamp(first), datetime.utcfromtimestamp(last)
+    partitions = []
+    if lower is not None:
+        partitions = date_partitions(lower, upper, jobs)
+    if len(partitions) < 2:
+        return selected_value_counts(cursor, filt, anemometer, split, lowest, highest, store)
+    log.debug('parallel_value_counts: %d partitions from %s to %s' % (len(partitions), lower, upper))
+    tasks = [(database_path, filt.file_filter, a, b, anemometer, split, lowest, highest, store is not None,
+              instrument.enabled) for a, b in partitions]
+    pool = multiprocessing.Pool(min(jobs, len(partitions)))
+    try:
+        with instrument.phase('query.parallel'):
+            results = pool.map(partition_value_counts, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    for value_counts, report in results:
+        instrument.merge(report)
+    return merge_value_counts([vc for value_counts, report in results for vc in value_counts])
+
+def averages(value_counts):
+    """
+    Return a dict of direction: (average windspeed, count) for value_counts.
+
+    As with SQL avg() and count(1), the average is of the windspeeds which
+    are not NULL (and is None if there are none) and the count is of all 
+    events.
+    """
+    terms, counts = dict(), dict()
+    for direction, windspeed, count in value_counts:
+        counts[direction] = counts.get(direction, 0) + count
+        if windspeed is not None:
+            terms.setdefault(direction, []).append((windspeed * count, count))
+    result = dict()
+    for direction, count in counts.items():
+        average = None
+        if direction in terms:
+            average = math.fsum(t[0] for t in terms[direction]) / sum(t[1] for t in terms[direction])
+        result[direction] = (average, count)
+    return result
+
+def histogram(value_counts, ranges):
+    """
+    Bin value counts into windspeed ranges.
+
+    value_counts is a list of (direction, windspeed, count) as returned by
+    windspeed_value_counts, and ranges is as returned by windspeed_ranges.
+    Returns a list of (direction, a, b, count) for each direction and range
+    with a non-zero count, sorted by direction and range.
+    """
+    starts = [r[0] for r in ranges]
+    bins = dict()
+    for direction, windspeed, count in value_counts:
+        if windspeed is None:
+            continue
+        idx = bisect_right(starts, windspeed) - 1
+        if idx < 0 or not windspeed < ranges[idx][1]:
+            continue
+        key = (direction, idx)
+        bins[key] = bins.get(key, 0) + count
+    result = []
+    for direction, idx in sorted(bins.keys(), key=lambda k: (k[0] is not None, k[0], k[1])):
+        a, b = ranges[idx]
+        result.append((direction, a, b, bins[(direction, idx)]))
+    return result
@@ -0,0 +1,116 @@
+"""
+Cache the output of the speeds, average and export commands in the
+database, so a report which is asked for again is not calculated again.
+
+Results are keyed by the command, its normalised arguments and the
+database's data_version, which is incremented by every change to the data
+or calibration (see Database.bump_data_version), so a cached result is
+never out of date.  Results for older versions are removed when a result
+is stored, and the least recently used results are removed when there are
+more than max_entries or they take more than max_bytes in total.
+"""
+
+import json
+import time
+import hashlib
+import logging
+from wind import instrument
+from wind.filter import sqlite_datefmt
+
+log = logging
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+def filter_key(filt):
+    """
+    Return the selection of a Filter as a list, the same for any two
+    filters which select the same data, e.g. --date 20160112 and
+    --from 2016-01-12 --to '2016-01-12 23:59:59'.
+    """
+    lower, upper = filt.time_bounds()
+    return [filt.file_filter,
+            lower.strftime(sqlite_datefmt) if lower is not None else None,
+            upper.strftime(sqlite_datefmt) if upper is not None else None]
+
+class QueryCache:
+    def __init__(self, database, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self._db = database
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._data_version = database.data_version()
+
+    def key(self, command, filt, **args):
+        """Return the cache key for command with Filter filt and the other arguments args."""
+        key = [command, self._data_version, filter_key(filt), sorted(args.items())]
+        return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        c = self._db._conn.cursor()
+        c.execute("""SELECT result FROM query_cache WHERE key = ?""", (key,))
+        result = c.fetchall()
+        if len(result) == 0:
+            instrument.count('cache.misses')
+            return None
+        instrument.count('cache.hits')
+        c.execute("""UPDATE query_cache SET last_used = ? WHERE key = ?""", (time.time(), key))
+        return result[0][0]
+
+    def put(self, key, command, result):
+        """
+        Store result (text) for key, unless it is larger than max_bytes or
+        the data has changed since the key was made (so result may be of
+        either version), and evict results for other data versions and the
+        least recently used results over the limits.
+        """
+        size = len(result)
+        if size > self._max_bytes:
+            log.debug('QueryCache.put(%s) result of %d bytes is too large to cache' % (command, size))
+            return
+        c = self._db._conn.cursor()
+        c.execute('begin')
+        c.execute("""SELECT value FROM database_state WHERE name = 'data_version'""")
+        if c.fetchall()[0][0] != self._data_version:
+            log.debug('QueryCache.put(%s) the data has changed, not caching the result' % command)
+            self._db.rollback()
+            return
+        c.execute("""DELETE FROM query_cache WHERE data_version != ?""", (self._data_version,))
+        c.execute("""INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?)""",
+                  (key, command, self._data_version, result, size, time.time()))
+        c.execute("""SELECT key, size FROM query_cache ORDER BY last_used DESC""")
+        entries, total, evict = 0, 0, []
+        for k, s in c.fetchall():
+            entries += 1
+            total += s
+            if entries > self._max_entries or total > self._max_bytes:
+                evict.append((k,))
+        c.executemany("""DELETE FROM query_cache WHERE key = ?""", evict)
+        self._db.commit(c)
+        instrument.count('cache.evictions', len(evict))
+
+class CapturingStream:
+    """
+    A file-like object which writes to stream, and keeps a copy of what
+    is written until it is more than limit characters.
+    """
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._limit = limit
+        self._parts = []
+        self._size = 0
+
+    def write(self, s):
+        self._stream.write(s)
+        if self._parts is not None:
+            self._size += len(s)
+            if self._size > self._limit:
+                self._parts = None
+            else:
+                self._parts.append(s)
+
+    def captured(self):
+        """Return everything written, or None if it was more than limit."""
+        if self._parts is None:
+            return None
+        return ''.join(self._parts)
@@ -5,19 +5,50 @@ import os
 import logging
 import glob
 import re
+import multiprocessing
+import time
 from datetime import datetime
-from wind.inputfile import InputFile
+from wind import instrument
+from wind.inputfile import InputFile, file_digest, file_tail_digest, compile_parse_plan, debug_enabled
+from wind.events import derive_events
+from wind.eventstore import EventStore, event_store_path
 
 log = logging
 
+# Number of input records held in memory and inserted per batch while adding a file
+DEFAULT_CHUNK_SIZE = 1000
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def iter_result_chunks(cursor, size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield lists of up to size rows from the result of the last query 
+    executed by cursor, so that the whole result is never in memory.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if len(rows) == 0:
+            break
+        yield rows
+
+def iter_result_dicts(cursor, size=DEFAULT_CHUNK_SIZE):
+    """Yield a dict for each row of the result of the last query executed by cursor."""
+    headers = result_headers(cursor)
+    for rows in iter_result_chunks(cursor, size):
+        for row in rows:
+            yield dict(zip(headers, row))
+
 def result_as_dict_array(cursor):
-    result = []
-    for row in cursor.fetchall():
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        result.append(d)
-    return result
+    return list(iter_result_dicts(cursor))
 
 def result_headers(cursor):
     result = []
@@ -25,36 +56,26 @@ def result_headers(cursor):
         result.append(col[0])
     return result
 
-def str2datetime(s):
-    fmt = None
-    s = s.replace('/', '-')
-    s = s.replace(' ', 'T')
-
+# Date/time layouts understood by str2datetime, as (pattern, strptime format),
+# after '/' has been replaced with '-' and ' ' with 'T'
+date_layouts = [
     # e.g. '14/08/2014T12:13:14'
-    m = re.match('^(\d\d)-(\d\d)-(\d\d\d\d)T(\d\d?):(\d\d):(\d\d)$', s)
-    if m:
-        fmt = '%d-%m-%YT%H:%M:%S'
-
+    (re.compile(r'^(\d\d)-(\d\d)-(\d\d\d\d)T(\d\d?):(\d\d):(\d\d)$'), '%d-%m-%YT%H:%M:%S'),
     # e.g. '14/08/14T12:13:14'
-    m = re.match('^(\d\d)-(\d\d)-(\d\d)T(\d\d?):(\d\d):(\d\d)$', s)
-    if m:
-        fmt = '%d-%m-%yT%H:%M:%S'
-
+    (re.compile(r'^(\d\d)-(\d\d)-(\d\d)T(\d\d?):(\d\d):(\d\d)$'), '%d-%m-%yT%H:%M:%S'),
     # e.g. '2014-08-14T12:13:14'
-    m = re.match('^(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d?):(\d\d):(\d\d)$', s)
-    if m:
-        fmt = '%Y-%m-%dT%H:%M:%S'
-
+    (re.compile(r'^(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d?):(\d\d):(\d\d)$'), '%Y-%m-%dT%H:%M:%S'),
     # e.g. '20140814T12:13:14'
-    m = re.match('^(\d\d\d\d)(\d\d)(\d\d)T(\d\d?):(\d\d):(\d\d)$', s)
-    if m:
-        fmt = '%Y%m%dT%H:%M:%S'
-
-    if fmt:
-        #log.debug('str2datetime(%s) interpretting as %s' % (s, fmt))
-        return datetime.strptime(s, fmt)
-    else:
-        raise Exception('str2datetime: Could not determine date format for: %s' % s)
+    (re.compile(r'^(\d\d\d\d)(\d\d)(\d\d)T(\d\d?):(\d\d):(\d\d)$'), '%Y%m%dT%H:%M:%S'),
+]
+
+def str2datetime(s):
+    s = s.replace('/', '-')
+    s = s.replace(' ', 'T')
+    for pattern, fmt in date_layouts:
+        if pattern.match(s):
+            return datetime.strptime(s, fmt)
+    raise Exception('str2datetime: Could not determine date format for: %s' % s)
     
 def str2isodatestr(s, fmt):
     dt = str2datetime(s)
@@ -62,20 +83,315 @@ def str2isodatestr(s, fmt):
         return dt.strftime(fmt)
     raise Exception('str2isodatestr: bad datetime returned type: %s' % type(dt))
 
+def epoch_seconds(year, month, day, hour=0, minute=0, second=0):
+    """Return seconds since 1970-01-01 00:00:00 using integer arithmetic only."""
+    # days from civil, see http://howardhinnant.github.io/date_algorithms.html
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+def iso2epoch(s):
+    """Convert a 'YYYY-MM-DD HH:MM:SS' string to epoch seconds."""
+    return epoch_seconds(int(s[0:4]), int(s[5:7]), int(s[8:10]), 
+                         int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+def datetime2epoch(dt):
+    """Convert a datetime (or date, as its midnight) to epoch seconds."""
+    return epoch_seconds(dt.year, dt.month, dt.day, 
+                         getattr(dt, 'hour', 0), getattr(dt, 'minute', 0), getattr(dt, 'second', 0))
+
+def epoch2iso(seconds):
+    """
+    Convert epoch seconds (as stored in raw_data.ts and the event 
+    timestamps) to a 'YYYY-MM-DD HH:MM:SS' string.  None stays None.
+    """
+    if seconds is None:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+def epoch2day(seconds):
+    """Return the day number (days since 1970-01-01) of epoch seconds, as windspeed_rollup.day."""
+    return seconds // 86400
+
+def _ymd_dmy4(dt):
+    if len(dt) != 10 or dt[2] not in '-/' or dt[5] not in '-/':
+        raise ValueError(dt)
+    return dt[6:10], dt[3:5], dt[0:2]
+
+def _ymd_dmy2(dt):
+    if len(dt) != 8 or dt[2] not in '-/' or dt[5] not in '-/':
+        raise ValueError(dt)
+    # same pivot as strptime's %y
+    year = dt[6:8]
+    return ('20' if year < '69' else '19') + year, dt[3:5], dt[0:2]
+
+def _ymd_ymd(dt):
+    if len(dt) != 10 or dt[4] not in '-/' or dt[7] not in '-/':
+        raise ValueError(dt)
+    return dt[0:4], dt[5:7], dt[8:10]
+
+def _ymd_ymd_compact(dt):
+    if len(dt) != 8:
+        raise ValueError(dt)
+    return dt[0:4], dt[4:6], dt[6:8]
+
+class TimestampParser:
+    """
+    Convert the date and time strings of input records to ISO timestamps
+    or epoch seconds.
+
+    The date layout is detected (using the same patterns as str2datetime) 
+    from the first record and cached, so later records are converted by
+    slicing rather than by regular expression matching and strptime.  A
+    record which does not fit the cached layout falls back to 
+    str2datetime, so the result is always the same as:
+
+        str2isodatestr('%sT%s' % (dt, tm), '%Y-%m-%d %H:%M:%S')
+
+    or its epoch seconds.  Use one TimestampParser per input file.
+    """
+    layout_functions = [_ymd_dmy4, _ymd_dmy2, _ymd_ymd, _ymd_ymd_compact]
+
+    def __init__(self):
+        self._ymd = None
+        self._last_dt = None
+        self._last_date = None
+        self._last_day_start = None
+
+    def isodatestr(self, dt, tm):
+        try:
+            return self.fast_isodatestr(dt, tm)
+        except Exception:
+            s = '%sT%s' % (dt, tm)
+            result = str2isodatestr(s, '%Y-%m-%d %H:%M:%S')
+            self.detect_layout(s)
+            return result
+
+    def epoch(self, dt, tm):
+        try:
+            return self.fast_epoch(dt, tm)
+        except Exception:
+            s = '%sT%s' % (dt, tm)
+            result = datetime2epoch(str2datetime(s))
+            self.detect_layout(s)
+            return result
+
+    def fast_isodatestr(self, dt, tm):
+        self.convert_date(dt)
+        hour, minute, second = self.split_time(tm)
+        return '%s %s:%s:%s' % (self._last_date, hour, minute, second)
+
+    def fast_epoch(self, dt, tm):
+        self.convert_date(dt)
+        hour, minute, second = self.split_time(tm)
+        return self._last_day_start + int(hour) * 3600 + int(minute) * 60 + int(second)
+
+    def convert_date(self, dt):
+        # Records in a file are mostly from the same day, so remember the
+        # last date converted
+        if dt != self._last_dt:
+            year, month, day = self._ymd(dt)
+            if not (year + month + day).isdigit():
+                raise ValueError(dt)
+            # Constructing a date validates the range of each field
+            datetime(int(year), int(month), int(day))
+            self._last_dt, self._last_date = dt, '%s-%s-%s' % (year, month, day)
+            self._last_day_start = epoch_seconds(int(year), int(month), int(day))
+
+    def split_time(self, tm):
+        hour, minute, second = tm.split(':')
+        if len(hour) == 1:
+            hour = '0' + hour
+        if len(hour) != 2 or len(minute) != 2 or len(second) != 2:
+            raise ValueError(tm)
+        # Two digit strings compare the same way as their values
+        if not (hour + minute + second).isdigit() or hour > '23' or minute > '59' or second > '59':
+            raise ValueError(tm)
+        return hour, minute, second
+
+    def detect_layout(self, s):
+        s = s.replace('/', '-').replace(' ', 'T')
+        for idx, (pattern, fmt) in enumerate(date_layouts):
+            if pattern.match(s):
+                self._ymd = TimestampParser.layout_functions[idx]
+                log.debug('TimestampParser using date layout %s' % fmt)
+                return
+
+def raw_data_values(record, parser):
+    """
+    Return a tuple of raw_data column values for an input record.
+
+    The order matches the raw_data columns ref, wind_1, wind_2, direction,
+    irradiance, batt_v, ts, where ts is the record's date and time in 
+    epoch seconds.  parser is the TimestampParser for the input file.  
+    Raises an exception if the record is incomplete or its date/time 
+    cannot be interpreted.
+    """
+    return (record['ref'],
+            record['wind_1'],
+            record['wind_2'],
+            record['direction'],
+            record['irradiance'],
+            record['batt_v'],
+            parser.epoch(record['dt'], record['tm']))
+
+def check_records(records, path=None):
+    """
+    Generator which yields raw_data_values() for each input record.
+
+    Records which fail checks yield None, so that callers can count them 
+    as errors before anything is written to the database.  The number of
+    records which failed for each reason is logged once, at the end, 
+    rather than for each record (unless debugging).  path is the input
+    file name for the message, defaulting to the path of records if it is
+    an InputFile.
+    """
+    if path is None:
+        path = getattr(records, '_path', None)
+    debug = debug_enabled(log)
+    parser = TimestampParser()
+    # reason -> number of records
+    failures = dict()
+    # time spent checking records and converting their timestamps, which
+    # is only measured if instrumentation is enabled
+    timing = instrument.enabled
+    clock = time.time
+    check_time, record_count = 0.0, 0
+    for record in records:
+        if timing:
+            start = clock()
+        try:
+            values = raw_data_values(record, parser)
+        except Exception as e:
+            if isinstance(e, KeyError):
+                reason = 'no %s' % e.args[0]
+            else:
+                reason = 'bad date/time'
+            failures[reason] = failures.get(reason, 0) + 1
+            if debug:
+                log.debug('Database.add_file, failed to add record: %s, exception: %s', record, e)
+            values = None
+        if timing:
+            check_time += clock() - start
+            record_count += 1
+        yield values
+    if timing:
+        instrument.add_time('add.check', check_time, record_count)
+        instrument.count('add.records', record_count)
+        instrument.count('add.errors', sum(failures.values()))
+    if len(failures) > 0:
+        log.warning('Database.add_file, %s: failed to add %d records (%s)' % (
+                    path, sum(failures.values()), 
+                    ', '.join('%s: %d' % (r, failures[r]) for r in sorted(failures.keys()))))
+
+def parse_input_file(task):
+    """
+    Read and check every record in an input file.
+
+    This is the worker function for Database.add_files_parallel, so it
+    does not touch the database.  task is a tuple (path, field_map, 
+    profile) where field_map is as returned by InputFile.read_field_map and
+    profile is instrument.enabled in the parent.  Returns a tuple (path, 
+    rows, manifest, report) where rows is a list as described for 
+    check_records, manifest is as returned by InputFile.manifest() and 
+    report is the worker's instrument.report() for the file.
+    """
+    path, field_map, profile = task
+    instrument.start_worker(profile)
+    input_file = InputFile(path, None, field_map=field_map)
+    rows = list(check_records(instrument.timed_iter('add.parse', input_file), path))
+    return path, rows, input_file.manifest(), instrument.report()
+
+# sqlite pragmas applied to each connection, by --db-profile.  'safe'
+# syncs on every commit, as sqlite does by default.  'fast' uses a write
+# ahead log, which is only synced at checkpoints (a power cut may lose the
+# last commits, but not corrupt the database), a 64MB page cache, memory
+# mapped reads and in memory temporary tables.  journal_mode is persistent,
+# and can only be changed while no other connection is open, so 'safe'
+# leaves it as it is; 'rollback' switches a database back to sqlite's
+# rollback journal.
+DB_PROFILES = {
+    'safe': [('synchronous', 'FULL')],
+    'rollback': [('journal_mode', 'DELETE'),
+                 ('synchronous', 'FULL')],
+    'fast': [('journal_mode', 'WAL'),
+             ('synchronous', 'NORMAL'),
+             ('cache_size', -64 * 1024),
+             ('mmap_size', 256 * 1024 * 1024),
+             ('temp_store', 'MEMORY')],
+}
+DEFAULT_DB_PROFILE = 'safe'
+
+# Number of rowids covered by each DELETE statement of Database.remove_data
+DEFAULT_DELETE_CHUNK_SIZE = 50000
+
+# The current schema version, see Database.upgrade_schema
+SCHEMA_VERSION = '2_03'
+
 class Database:
-    def __init__(self, path):
+    # Schema migrations as (from_version, to_version, method name), in order
+    migrations = [
+        ('1_00', '1_01', 'migrate_1_00_to_1_01'),
+        ('1_01', '1_02', 'migrate_1_01_to_1_02'),
+        ('1_02', '1_03', 'migrate_1_02_to_1_03'),
+        ('1_03', '1_04', 'migrate_1_03_to_1_04'),
+        ('1_04', '1_05', 'migrate_1_04_to_1_05'),
+        ('1_05', '1_06', 'migrate_1_05_to_1_06'),
+        ('1_06', '2_00', 'migrate_1_06_to_2_00'),
+        ('2_00', '2_01', 'migrate_2_00_to_2_01'),
+        ('2_01', '2_02', 'migrate_2_01_to_2_02'),
+        ('2_02', '2_03', 'migrate_2_02_to_2_03'),
+    ]
+    # Versions whose migration rebuilds tables, after which the database is
+    # vacuumed to return the space they used to the file system
+    vacuum_versions = ['2_00']
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, profile=DEFAULT_DB_PROFILE):
         """ 
         Open an existing database or, if no database exists at 
         the specified path, create a new one with the appropriate 
         schema.
+
+        chunk_size is the maximum number of input records held in
+        memory at a time when adding files, which is also the number of
+        rows written to raw_data by each executemany batch.
+
+        profile is the name of the set of sqlite pragmas in DB_PROFILES 
+        applied to the connection.
         """
         log.debug('Constructing Database object for path: %s' % path)
         self._path = path
+        self._chunk_size = chunk_size
+        # field_mapping and the parse plans compiled from it, see get_parse_plan
+        self._field_map = None
+        self._parse_plans = dict()
         self._conn = sqlite3.connect(self._path)
         # Make it so we can do a single transaction with multiple executes...
         self._conn.isolation_level = None
+        self.apply_profile(profile)
         if not self.schema_exists():
             self.create_schema()
+        else:
+            self.upgrade_schema()
+        # the columnar copy of the event table, if `winda convert` has made 
+        # one, see open_event_store
+        self.event_store = None
+        self.open_event_store()
+
+    def apply_profile(self, profile):
+        """Apply the pragmas of DB_PROFILES[profile] to the connection."""
+        if profile not in DB_PROFILES:
+            raise Exception('Unknown database profile %s, should be one of: %s' % (
+                            profile, ', '.join(sorted(DB_PROFILES.keys()))))
+        c = self._conn.cursor()
+        for pragma, value in DB_PROFILES[profile]:
+            c.execute("""PRAGMA %s = %s""" % (pragma, value))
+            log.debug('Database PRAGMA %s = %s -> %s' % (pragma, value, c.fetchall()))
 
     def __exit__(self, exc_type, exc_value, traceback):
         # Commit changes to the database
@@ -96,6 +412,13 @@ class Database:
             log.debug('Database._conn.commit() exception [ignoring]: %s' % e)
             pass
 
+    def rollback(self):
+        """Roll back any transaction left open, e.g. by an exception part way through a change."""
+        try:
+            self._conn.execute("rollback")
+        except Exception as e:
+            log.debug('Database.rollback() exception [ignoring]: %s' % e)
+
     def schema_exists(self):
         """
         Test if a winda schema exists in the database at the path for this object.
@@ -110,8 +433,453 @@ class Database:
         else:
             return True
 
+    def schema_version(self):
+        """
+        Return the schema version of the database, e.g. '1_00'.
+
+        The version is recorded by the name of the winda_schema_v_* table.
+        """
+        c = self._conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'winda_schema_v_%';")
+        return c.fetchall()[0][0][len('winda_schema_v_'):]
+
+    def upgrade_schema(self):
+        """
+        Upgrade the schema to SCHEMA_VERSION, applying each migration in 
+        self.migrations in turn.  Each migration is done in its own
+        transaction, along with renaming the winda_schema_v_* table.
+        """
+        version = self.schema_version()
+        c = self._conn.cursor()
+        vacuum = False
+        for from_version, to_version, migration in self.migrations:
+            if version != from_version:
+                continue
+            log.info('Upgrading database %s schema from version %s to %s' % (
+                        self._path, from_version, to_version))
+            c.execute('begin')
+            getattr(self, migration)(c)
+            c.execute("""ALTER TABLE winda_schema_v_%s RENAME TO winda_schema_v_%s""" % (
+                        from_version, to_version))
+            c.execute('commit')
+            version = to_version
+            vacuum = vacuum or to_version in self.vacuum_versions
+        if vacuum:
+            log.info('Vacuuming database %s' % self._path)
+            c.execute('VACUUM')
+        if version != SCHEMA_VERSION:
+            log.warning('Database %s has unknown schema version %s' % (self._path, version))
+
+    def migrate_1_00_to_1_01(self, c):
+        """Add indexes for the date filters and the by-file lookups."""
+        log.debug('creating index on event.event_end...')
+        c.execute("""CREATE INDEX IF NOT EXISTS event__event_end ON event(event_end)""")
+        log.debug('creating index on event.file_id...')
+        c.execute("""CREATE INDEX IF NOT EXISTS event__file_id ON event(file_id)""")
+        # Also covers process_file's search for unprocessed records
+        log.debug('creating index on raw_data.file_id...')
+        c.execute("""CREATE INDEX IF NOT EXISTS raw_data__file_id ON raw_data(file_id, processed, ts)""")
+
+    def migrate_1_01_to_1_02(self, c):
+        """
+        Add the windspeed_rollup table.
+
+        This holds, for each day, ref, wind direction and anemometer, the
+        number of events with each distinct windspeed.  The windspeeds are
+        ticks / elapsed seconds * factor, so there are few distinct values
+        and binning them gives exactly the same results as binning the
+        events.  The speeds and average commands use it for whole days
+        instead of scanning event.  It is populated from any existing 
+        events.
+        """
+        log.debug('creating table windspeed_rollup...')
+        c.execute("""
+                  CREATE TABLE windspeed_rollup (
+                      day CHAR(10),
+                      ref VARCHAR(12),
+                      direction VARCHAR(2),
+                      anemometer INTEGER,
+                      windspeed FLOAT,
+                      count INTEGER
+                  )
+                  """)
+        c.execute("""CREATE INDEX windspeed_rollup__day ON windspeed_rollup(day, anemometer)""")
+        log.debug('populating windspeed_rollup...')
+        for anemometer in [1, 2]:
+            c.execute("""
+                      INSERT INTO windspeed_rollup
+                      SELECT      substr(event_end, 1, 10), ref, wind_direction, ?,
+                                  windspeed_ms_%d, COUNT(1)
+                      FROM        event
+                      GROUP BY    1, 2, 3, 5
+                      """ % anemometer, (anemometer,))
+
+    def migrate_1_02_to_1_03(self, c):
+        """
+        Add input_file.bytes_read, the length of the part of the file which 
+        has been added, so that data appended to a file can be added (see
+        update_file).  It is NULL for files added before this version, which
+        are treated as complete.
+        """
+        log.debug('adding column input_file.bytes_read...')
+        c.execute("""ALTER TABLE input_file ADD COLUMN bytes_read INTEGER""")
+
+    def migrate_1_03_to_1_04(self, c):
+        """
+        Add the input_file size, mtime and sha1 columns.  These describe the
+        file as it was when it was added (the sha1 is of the first 
+        bytes_read bytes), so add can skip files which have not changed
+        without reading them.  They are NULL for files added before this
+        version.
+        """
+        log.debug('adding columns input_file.size, mtime and sha1...')
+        c.execute("""ALTER TABLE input_file ADD COLUMN size INTEGER""")
+        c.execute("""ALTER TABLE input_file ADD COLUMN mtime FLOAT""")
+        c.execute("""ALTER TABLE input_file ADD COLUMN sha1 CHAR(40)""")
+
+    def migrate_1_04_to_1_05(self, c):
+        """
+        Add the ref_statistics table, which holds the number of events,
+        raw_data records and unprocessed raw_data records for each ref.
+        It is kept up to date as data is added, processed and removed (see
+        update_statistics), so info does not have to count rows.  It is
+        populated from any existing data.
+        """
+        log.debug('creating table ref_statistics...')
+        c.execute("""
+                  CREATE TABLE ref_statistics (
+                      ref VARCHAR(12) PRIMARY KEY,
+                      events INTEGER,
+                      raw_data INTEGER,
+                      unprocessed INTEGER
+                  )
+                  """)
+        log.debug('populating ref_statistics...')
+        c.execute("""
+                  INSERT INTO ref_statistics
+                  SELECT      ref, 0, COUNT(1), SUM(processed = 0)
+                  FROM        raw_data
+                  GROUP BY    ref
+                  """)
+        c.execute("""SELECT ref, COUNT(1) FROM event GROUP BY ref""")
+        for ref, events in c.fetchall():
+            self.update_statistics(c, ref, events=events)
+
+    def migrate_1_05_to_1_06(self, c):
+        """
+        Add the database_state table, holding the data_version counter 
+        (see bump_data_version), and the query_cache table of command
+        results (see wind.cache).
+        """
+        log.debug('creating table database_state...')
+        c.execute("""
+                  CREATE TABLE database_state (
+                      name VARCHAR(32) PRIMARY KEY,
+                      value INTEGER
+                  )
+                  """)
+        c.execute("""INSERT INTO database_state VALUES ('data_version', 0)""")
+        log.debug('creating table query_cache...')
+        c.execute("""
+                  CREATE TABLE query_cache (
+                      key CHAR(40) PRIMARY KEY,
+                      command VARCHAR(16),
+                      data_version INTEGER,
+                      result TEXT,
+                      size INTEGER,
+                      last_used FLOAT
+                  )
+                  """)
+
+    def migrate_1_06_to_2_00(self, c):
+        """
+        Store timestamps as epoch seconds.
+
+        raw_data.ts and event.event_start/event_end become INTEGER epoch
+        seconds (UTC, like sqlite's strftime('%s')) instead of text, and 
+        raw_data's dt and tm columns, which held the record's date and time
+        as they were in the input file, are dropped.  This saves about 60
+        bytes a row, and the filters compare integers.  windspeed_rollup.day
+        becomes the number of days since 1970-01-01 (see epoch2day).
+        raw_data rowids and event ids are kept.  Use epoch2iso to show a 
+        timestamp.
+        """
+        log.debug('rebuilding table raw_data...')
+        c.execute("""
+                  CREATE TABLE raw_data_v2 (
+                      file_id INTEGER,
+                      ref VARCHAR(12),
+                      wind_1 INTEGER,
+                      wind_2 INTEGER,
+                      direction VARCHAR(2),
+                      irradiance FLOAT,
+                      batt_v FLOAT,
+                      processed BOOLEAN,
+                      ts INTEGER,
+                      FOREIGN KEY(file_id) REFERENCES input_file(id)
+                  )
+                  """)
+        c.execute("""
+                  INSERT INTO raw_data_v2 (
+                      rowid, file_id, ref, wind_1, wind_2, direction, irradiance, batt_v, processed, ts
+                  )
+                  SELECT      rowid, file_id, ref, wind_1, wind_2, direction, irradiance, batt_v, processed,
+                              CAST(strftime('%s', ts) AS INTEGER)
+                  FROM        raw_data
+                  ORDER BY    rowid
+                  """)
+        c.execute("""DROP TABLE raw_data""")
+        c.execute("""ALTER TABLE raw_data_v2 RENAME TO raw_data""")
+        c.execute("""CREATE INDEX raw_data__ts ON raw_data(ts)""")
+        c.execute("""CREATE INDEX raw_data__file_id ON raw_data(file_id, processed, ts)""")
+        log.debug('rebuilding table event...')
+        c.execute("""
+                  CREATE TABLE event_v2 (
+                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      ref VARCHAR(12),
+                      file_id INTEGER,
+                      event_start INTEGER,
+                      event_end INTEGER,
+                      event_duration FLOAT,
+                      anemometer_hz_1 FLOAT,
+                      anemometer_hz_2 FLOAT,
+                      irradiance_v FLOAT,
+                      windspeed_ms_1 FLOAT,
+                      windspeed_ms_2 FLOAT,
+                      wind_direction VARCHAR(2),
+                      irradiance_wm2 FLOAT,
+                      FOREIGN KEY(ref) REFERENCES calibrations(ref),
+                      FOREIGN KEY(file_id) REFERENCES input_file(id)
+                  )
+                  """)
+        c.execute("""
+                  INSERT INTO event_v2 (
+                      id, ref, file_id, event_start, event_end, event_duration, anemometer_hz_1, 
+                      anemometer_hz_2, irradiance_v, windspeed_ms_1, windspeed_ms_2, wind_direction, 
+                      irradiance_wm2
+                  )
+                  SELECT      id, ref, file_id, CAST(strftime('%s', event_start) AS INTEGER),
+                              CAST(strftime('%s', event_end) AS INTEGER), event_duration, anemometer_hz_1,
+                              anemometer_hz_2, irradiance_v, windspeed_ms_1, windspeed_ms_2, wind_direction,
+                              irradiance_wm2
+                  FROM        event
+                  ORDER BY    id
+                  """)
+        c.execute("""DROP TABLE event""")
+        c.execute("""ALTER TABLE event_v2 RENAME TO event""")
+        c.execute("""CREATE INDEX event__event_end ON event(event_end)""")
+        c.execute("""CREATE INDEX event__file_id ON event(file_id)""")
+        log.debug('rebuilding table windspeed_rollup...')
+        c.execute("""
+                  CREATE TABLE windspeed_rollup_v2 (
+                      day INTEGER,
+                      ref VARCHAR(12),
+                      direction VARCHAR(2),
+                      anemometer INTEGER,
+                      windspeed FLOAT,
+                      count INTEGER
+                  )
+                  """)
+        c.execute("""
+                  INSERT INTO windspeed_rollup_v2
+                  SELECT      CAST(strftime('%s', day) AS INTEGER) / 86400, ref, direction, anemometer,
+                              windspeed, count
+                  FROM        windspeed_rollup
+                  """)
+        c.execute("""DROP TABLE windspeed_rollup""")
+        c.execute("""ALTER TABLE windspeed_rollup_v2 RENAME TO windspeed_rollup""")
+        c.execute("""CREATE INDEX windspeed_rollup__day ON windspeed_rollup(day, anemometer)""")
+
+    def migrate_2_00_to_2_01(self, c):
+        """
+        Add input_file.tail_sha1, the sha1 of the last TAIL_WINDOW bytes
+        read from the file (see wind.inputfile.file_tail_digest), which
+        replaces sha1 (of every byte read) for checking that a file has 
+        only been appended to, so the check does not read the whole file.
+        sha1 is only used for files added before this version, until 
+        they are next read.
+        """
+        log.debug('adding column input_file.tail_sha1...')
+        c.execute("""ALTER TABLE input_file ADD COLUMN tail_sha1 CHAR(40)""")
+
+    def migrate_2_01_to_2_02(self, c):
+        """
+        Add the event_version counter to database_state (see 
+        bump_event_version), which the event store records to show which 
+        changes to the event table it has.
+        """
+        c.execute("""INSERT INTO database_state VALUES ('event_version', 0)""")
+
+    def migrate_2_02_to_2_03(self, c):
+        """
+        Add the input_files count to database_state (see update_file_count),
+        so info does not have to count the input_file table.
+        """
+        c.execute("""INSERT INTO database_state SELECT 'input_files', COUNT(1) FROM input_file""")
+
+    def data_version(self):
+        """Return the data_version counter, which changes whenever the data or calibration does."""
+        c = self._conn.cursor()
+        c.execute("""SELECT value FROM database_state WHERE name = 'data_version'""")
+        return c.fetchall()[0][0]
+
+    def bump_data_version(self, c):
+        """
+        Increment data_version, so results cached for the previous version
+        are not used.  This should be called using cursor c in the same
+        transaction as the change.
+        """
+        c.execute("""UPDATE database_state SET value = value + 1 WHERE name = 'data_version'""")
+
+    def event_version(self):
+        """Return the event_version counter, which changes whenever the event table does."""
+        c = self._conn.cursor()
+        c.execute("""SELECT value FROM database_state WHERE name = 'event_version'""")
+        return c.fetchall()[0][0]
+
+    def bump_event_version(self, c):
+        """
+        Increment event_version, and return the new version, which should 
+        be passed to update_event_store once the change is committed.  This
+        should be called using cursor c in the same transaction as the 
+        change to the event table.
+        """
+        c.execute("""UPDATE database_state SET value = value + 1 WHERE name = 'event_version'""")
+        c.execute("""SELECT value FROM database_state WHERE name = 'event_version'""")
+        return c.fetchall()[0][0]
+
+    def update_statistics(self, c, ref, events=0, raw_data=0, unprocessed=0):
+        """
+        Add to the counts in ref_statistics for ref.  This should be called
+        using cursor c in the same transaction as the change counted.
+        """
+        if events == 0 and raw_data == 0 and unprocessed == 0:
+            return
+        c.execute("""INSERT OR IGNORE INTO ref_statistics VALUES (?, 0, 0, 0)""", (ref,))
+        c.execute("""
+                  UPDATE     ref_statistics
+                  SET        events = events + ?,
+                             raw_data = raw_data + ?,
+                             unprocessed = unprocessed + ?
+                  WHERE      ref = ?
+                  """, (events, raw_data, unprocessed, ref))
+
+    def update_file_count(self, c, n):
+        """
+        Add n to the input_files count in database_state.  This should be
+        called using cursor c in the same transaction as the change to 
+        input_file.
+        """
+        c.execute("""UPDATE database_state SET value = value + ? WHERE name = 'input_files'""", (n,))
+
+    def refresh_rollup(self, c, days):
+        """
+        Rebuild the windspeed_rollup rows for days (an iterable of day 
+        numbers, see epoch2day) from the event table.  This should be 
+        called using cursor c in the same transaction as the change to event.
+        """
+        for day in sorted(set(days)):
+            c.execute("""DELETE FROM windspeed_rollup WHERE day = ?""", (day,))
+            for anemometer in [1, 2]:
+                c.execute("""
+                          INSERT INTO windspeed_rollup
+                          SELECT      ?, ref, wind_direction, ?,
+                                      windspeed_ms_%d, COUNT(1)
+                          FROM        event
+                          WHERE       event_end >= ?
+                          AND         event_end < ?
+                          GROUP BY    2, 3, 5
+                          """ % anemometer, 
+                          (day, anemometer, day * 86400, (day + 1) * 86400))
+
+    def open_event_store(self):
+        """
+        Return the event store, opening it if `winda convert` has made one
+        (perhaps since this database was opened), or None if there is none.
+        """
+        if self.event_store is None and os.path.isdir(event_store_path(self._path)):
+            self.event_store = EventStore(event_store_path(self._path))
+        return self.event_store
+
+    def current_event_store(self):
+        """
+        Return the event store if there is one and it is up to date with 
+        the event table, for reading events from.  Otherwise return None,
+        so the event table is read instead.
+        """
+        store = self.open_event_store()
+        if store is not None and store.version() != self.event_version():
+            log.warning('The event store %s is out of date, reading the event table instead: '
+                        'run winda convert to rebuild it' % event_store_path(self._path))
+            return None
+        return store
+
+    def update_event_store(self, version, update):
+        """
+        Call update(store) to apply a change to the event table, committed
+        as event_version version (see bump_event_version), to the event 
+        store, if there is one.  The store is only changed if it was up to
+        date before the change, so a store which has missed a change (e.g.
+        the process changing it was killed, or another process's change is 
+        not in it yet) stays out of date until it is rebuilt.
+        """
+        store = self.open_event_store()
+        if store is None:
+            return
+        with store.lock():
+            store_version = store.version()
+            if store_version == version:
+                # e.g. rebuilt by winda convert since the change was committed
+                return
+            if store_version != version - 1:
+                log.warning('The event store %s is out of date, run winda convert to rebuild it' % 
+                            event_store_path(self._path))
+                return
+            update(store)
+            store.set_version(version)
+
+    def refresh_event_store(self, days, version):
+        """
+        Rewrite the days (an iterable of day numbers) of the event
+        store, if there is one, from the event table.  This should be 
+        called after the change to event, made as event_version version, 
+        has been committed.
+        """
+        with instrument.phase('eventstore.refresh'):
+            self.update_event_store(version, lambda store: store.refresh_days(self._conn.cursor(), days))
+
+    def convert_event_store(self):
+        """
+        Create the event store (see wind.eventstore) from the event table,
+        or rebuild it if it exists.  From then on it is kept up to date as
+        events change.  Returns the number of events in it.
+        """
+        if self.open_event_store() is None:
+            self.event_store = EventStore(event_store_path(self._path))
+        c = self._conn.cursor()
+        # read the events and their version in one transaction, so they match
+        c.execute('begin')
+        try:
+            with self.event_store.lock():
+                version = self.event_version()
+                count = self.event_store.rebuild(c)
+                self.event_store.set_version(version)
+        finally:
+            self.commit(c)
+        return count
+
+    def event_days(self, c, where, params):
+        """Return a list of the day numbers of the events matching where/params."""
+        c.execute("""SELECT DISTINCT event_end / 86400 FROM event WHERE %s""" % where, params)
+        return [r[0] for r in c.fetchall()]
+
     def create_schema(self):
-        """Create a new, empty database at the specified path."""
+        """
+        Create a new, empty database at the specified path.
+
+        The version 1_00 schema is created and then upgraded to the current
+        SCHEMA_VERSION.
+        """
         log.debug('create_schema -> %s' % self._path)
         c = self._conn.cursor()
         log.debug('creating table calibration...')
@@ -300,6 +1068,7 @@ class Database:
         
         log.debug('creating table winda_schema_v_1_00...')
         c.execute("""CREATE TABLE winda_schema_v_1_00 (id INT UNIQUE)""")
+        self.upgrade_schema()
 
     def info(self):
         """Return a dict with some helpful information about the database."""
@@ -307,16 +1076,36 @@ class Database:
         d['Database file'] = self._path
         d['Size'] = os.path.getsize(self._path)
         c = self._conn.cursor()
-        c.execute("""SELECT DISTINCT id from input_file""")
-        d['Number of files added'] = len(c.fetchall())
-        c.execute("""SELECT 1 FROM event""")
-        d['Number of records'] = len(c.fetchall())
+        c.execute("""SELECT value FROM database_state WHERE name = 'input_files'""")
+        d['Number of files added'] = c.fetchall()[0][0]
+        c.execute("""SELECT ref, events, raw_data, unprocessed FROM ref_statistics ORDER BY ref""")
+        d['Refs'] = dict((r[0], {'events': r[1], 'raw_data': r[2], 'unprocessed': r[3]}) for r in c.fetchall())
+        d['Number of records'] = sum(r['events'] for r in d['Refs'].values())
+        d['Number of raw_data records'] = sum(r['raw_data'] for r in d['Refs'].values())
+        d['Unprocessed raw_data records'] = sum(r['unprocessed'] for r in d['Refs'].values())
+        # MIN and MAX are single lookups in the event_end index
+        c.execute("""SELECT MIN(event_end) FROM event""")
+        d['First event'] = epoch2iso(c.fetchall()[0][0])
+        c.execute("""SELECT MAX(event_end) FROM event""")
+        d['Last event'] = epoch2iso(c.fetchall()[0][0])
         return d
 
-    def add(self, patterns):
-        """Add a list of glob patterns or files to the datbase."""
-        for pattern in patterns:
-            self.add_pattern(pattern)
+    def add(self, patterns, jobs=1):
+        """
+        Add a list of glob patterns or files to the datbase.
+
+        If jobs is greater than 1, files are read and checked in a pool of
+        that many worker processes, while this process remains the only
+        writer to the database.  The result is the same as a serial add.
+        """
+        if jobs > 1:
+            paths = []
+            for pattern in patterns:
+                paths.extend(glob.glob(pattern))
+            self.add_files_parallel(paths, jobs)
+        else:
+            for pattern in patterns:
+                self.add_pattern(pattern)
         
     def add_pattern(self, pattern):
         """Add a single glob pattern of files to the datbase."""
@@ -325,19 +1114,375 @@ class Database:
             self.add_file(path)
 
     def add_file(self, path):
-        """Add a single CSV file to the raw_data table."""
+        """
+        Add a single CSV file to the raw_data table.
+
+        A file which has already been added is only read again if it has
+        changed since (see update_file).  Returns the number of records read.
+        """
         log.debug('Database.add_file(%s)' % path)
-        infile = InputFile(path, self)
+        return self.update_file(path, complete_lines=False)
+
+    def add_files_parallel(self, paths, jobs):
+        """
+        Add a list of files, parsing them in a pool of jobs worker processes.
+
+        Files are stored in the order given, each in its own transaction,
+        so input_file ids match those of a serial add.  Files are handed to
+        the pool a few at a time to bound the number of parsed files waiting
+        to be written.  Files which have already been added are checked for
+        changes in their turn, without using the pool.
+        """
+        log.debug('Database.add_files_parallel(%d files, jobs=%d)' % (len(paths), jobs))
+        field_map = self.get_field_map()
+        pool = multiprocessing.Pool(jobs)
+        seen = set()
+        try:
+            for window in iter_chunks(paths, jobs * 2):
+                # a path given twice is added at its first place, and
+                # checked for changes at the second, as in a serial add
+                new = []
+                for path in window:
+                    new.append(path not in seen and self.get_input_file(path) is None)
+                    seen.add(path)
+                tasks = [(path, field_map, instrument.enabled) for path, is_new in zip(window, new) if is_new]
+                parsed = pool.imap(parse_input_file, tasks)
+                for path, is_new in zip(window, new):
+                    if is_new:
+                        path, rows, manifest, report = next(parsed)
+                        instrument.merge(report)
+                        self.store_file(path, rows, lambda: manifest)
+                    else:
+                        self.add_file(path)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_input_file(self, path):
+        """Return the input_file record for path as a dict, or None if it has not been added."""
+        c = self._conn.cursor()
+        c.execute("""SELECT * FROM input_file WHERE path = ?""", (path,))
+        result = result_as_dict_array(c)
+        if len(result) == 0:
+            return None
+        return result[0]
+
+    def file_change(self, path, input_file):
+        """
+        Compare path with its input_file record, returning one of:
+
+          'unknown'    it was added by a version which did not record this
+          'unchanged'  same size and modification time as when it was added
+          'appended'   it ends with the bytes which were read before
+          'changed'    anything else
+
+        Only the last TAIL_WINDOW bytes which were read before are read
+        again to check for 'appended' (the whole of what was read for files
+        added before schema 2_01, which have no tail_sha1), and an 
+        'unchanged' file is not read at all.
+        """
+        if input_file['size'] is None:
+            return 'unknown'
+        st = os.stat(path)
+        if st.st_size == input_file['size'] and st.st_mtime == input_file['mtime']:
+            return 'unchanged'
+        if st.st_size >= input_file['bytes_read']:
+            if input_file['tail_sha1'] is not None:
+                if file_tail_digest(path, input_file['bytes_read']) == input_file['tail_sha1']:
+                    return 'appended'
+            elif file_digest(path, input_file['bytes_read']).hexdigest() == input_file['sha1']:
+                return 'appended'
+        return 'changed'
+
+    def update_file(self, path, complete_lines=True):
+        """
+        Add the records of path which have not been added yet.
+
+        A new file is added.  For a file which has already been added, if
+        records have been appended only they are read and processed, and if
+        it has otherwise changed it is removed and added again.  If 
+        complete_lines is True, records on a line which is not complete 
+        (does not end with a newline yet) are left until it is.  Returns
+        the number of records read.
+        """
+        input_file = self.get_input_file(path)
+        if input_file is not None:
+            change = self.file_change(path, input_file)
+            if change == 'unknown':
+                log.error('perhaps the file %s has already been added to the database?' % path)
+                return 0
+            elif change == 'unchanged':
+                log.info('%s has not changed since it was added, skipping it' % path)
+                return 0
+            elif change == 'appended':
+                return self.append_file(path, input_file)
+            log.warning('%s has changed since it was added, adding it again' % path)
+            self.remove_file(input_file['id'])
+        reader = InputFile(path, self, offset=0 if complete_lines else None)
+        self.store_file(path, check_records(instrument.timed_iter('add.parse', reader), path), reader.manifest)
+        input_file = self.get_input_file(path)
+        return input_file['records'] if input_file is not None else 0
+
+    def append_file(self, path, input_file):
+        """
+        Add and process the complete records appended to path, after the
+        input_file['bytes_read'] bytes which were added before.  Returns
+        the number of records read.
+        """
+        log.debug('Database.append_file(%s) reading from offset %d' % (path, input_file['bytes_read']))
+        reader = InputFile(path, self, offset=input_file['bytes_read'])
+        c = self._conn.cursor()
+        c.execute('begin')
+        rows = check_records(instrument.timed_iter('add.parse', reader), path)
+        record_count, error_count = self.write_rows(c, input_file['id'], rows)
+        log.info('%s: %d records appended, %d accepted, %d rejected' % (path, record_count,
+                 record_count - error_count, error_count))
+        manifest = reader.manifest()
+        c.execute("""
+                  UPDATE     input_file 
+                  SET        records = records + ?, 
+                             errors = errors + ?, 
+                             bytes_read = ?,
+                             size = ?,
+                             mtime = ?,
+                             sha1 = NULL,
+                             tail_sha1 = ?
+                  WHERE      id = ?
+                  """, (record_count, error_count, manifest['bytes_read'], manifest['size'],
+                        manifest['mtime'], manifest['tail_sha1'], input_file['id']))
+        self.commit(c)
+        if record_count > 0:
+            self.process_file(input_file['id'])
+        return record_count
+
+    def remove_file(self, file_id):
+        """Remove an input file and its raw_data and events."""
+        c = self._conn.cursor()
+        c.execute('begin')
+        days = self.delete_file_events(c, file_id)
+        c.execute("""SELECT ref, COUNT(1), SUM(processed = 0) FROM raw_data WHERE file_id = ? GROUP BY ref""",
+                  (file_id,))
+        for ref, count, unprocessed in c.fetchall():
+            self.update_statistics(c, ref, raw_data=-count, unprocessed=-unprocessed)
+        c.execute("""DELETE FROM raw_data WHERE file_id = ?""", (file_id,))
+        c.execute("""DELETE FROM input_file WHERE id = ?""", (file_id,))
+        self.update_file_count(c, -1)
+        c.execute("""DELETE FROM ref_statistics WHERE events = 0 AND raw_data = 0""")
+        self.refresh_rollup(c, days)
+        self.bump_data_version(c)
+        version = self.bump_event_version(c)
+        self.commit(c)
+        self.refresh_event_store(days, version)
+
+    def delete_file_events(self, c, file_id):
+        """
+        Delete the events of an input file using cursor c, inside a
+        transaction, and return a list of the days they were on for
+        refresh_rollup.
+        """
+        days = self.event_days(c, 'file_id = ?', [file_id])
+        c.execute("""SELECT ref, COUNT(1) FROM event WHERE file_id = ? GROUP BY ref""", (file_id,))
+        for ref, count in c.fetchall():
+            self.update_statistics(c, ref, events=-count)
+        c.execute("""DELETE FROM event WHERE file_id = ?""", (file_id,))
+        return days
+
+    def recalibrate(self, ref=None, full=False):
+        """
+        Apply the current calibration of ref (or of every calibrated ref if
+        ref is None) to the events which have already been derived.
+
+        The windspeeds and irradiance of the events are recalculated in 
+        place from their anemometer_hz_1/2 and irradiance_v.  An event which
+        is now over the limits would not have been accepted, and changes
+        the start of the event after it, so the input files with such
+        events are processed again from raw_data.  So are the files with
+        records of ref but no events for it, e.g. because there was no
+        calibration for ref when they were added.  If full is True every
+        file with records of ref is processed again, which also accepts
+        records rejected under limits which have since been raised.
+
+        Returns a tuple (events recalculated, files processed again).
+        """
+        calibration = self.get_calibration()
+        refs = sorted(calibration.keys()) if ref is None else [ref]
         c = self._conn.cursor()
+        updated, reprocess, days = 0, set(), []
+        c.execute('begin')
+        try:
+            for r in refs:
+                if r not in calibration:
+                    log.error('There is no calibration for ref %s, use calibrate to add it' % r)
+                    continue
+                cal = calibration[r]
+                with instrument.phase('recalibrate.update'):
+                    days.extend(self.event_days(c, 'ref = ?', [r]))
+                    c.execute("""
+                              UPDATE     event
+                              SET        windspeed_ms_1 = anemometer_hz_1 * ?,
+                                         windspeed_ms_2 = anemometer_hz_2 * ?,
+                                         irradiance_wm2 = irradiance_v * ?
+                              WHERE      ref = ?
+                              """, (cal['anemometer_1_factor'], cal['anemometer_2_factor'],
+                                    cal['irradiance_factor'], r))
+                    updated += c.rowcount
+                if full:
+                    c.execute("""SELECT DISTINCT file_id FROM raw_data WHERE ref = ?""", (r,))
+                    reprocess.update(f[0] for f in c.fetchall())
+                    continue
+                # NOT (... <= ...) so NULLs, which could not be calculated, count as over
+                c.execute("""
+                          SELECT     DISTINCT file_id
+                          FROM       event
+                          WHERE      ref = ?
+                          AND        NOT (windspeed_ms_1 <= ? AND windspeed_ms_2 <= ? AND irradiance_wm2 <= ?)
+                          """, (r, cal['max_windspeed_ms'], cal['max_windspeed_ms'], cal['max_irradiance']))
+                reprocess.update(f[0] for f in c.fetchall())
+                c.execute("""
+                          SELECT     id
+                          FROM       input_file f
+                          WHERE      EXISTS (
+                              SELECT       1
+                              FROM         raw_data r
+                              WHERE        r.file_id = f.id
+                              AND          r.processed = 0
+                              AND          r.ref = ?
+                          )
+                          AND        NOT EXISTS (
+                              SELECT       1
+                              FROM         event e
+                              WHERE        e.file_id = f.id
+                              AND          e.ref = ?
+                          )
+                          """, (r, r))
+                reprocess.update(f[0] for f in c.fetchall())
+            for file_id in sorted(reprocess):
+                days.extend(self.delete_file_events(c, file_id))
+                c.execute("""SELECT ref, COUNT(1) FROM raw_data WHERE file_id = ? AND processed = 1 GROUP BY ref""",
+                          (file_id,))
+                for r, count in c.fetchall():
+                    self.update_statistics(c, r, unprocessed=count)
+                c.execute("""UPDATE raw_data SET processed = 0 WHERE file_id = ? AND processed = 1""", (file_id,))
+            with instrument.phase('recalibrate.rollup'):
+                self.refresh_rollup(c, days)
+            self.bump_data_version(c)
+            version = self.bump_event_version(c)
+        except:
+            c.execute('rollback')
+            raise
+        self.commit(c)
+        self.refresh_event_store(days, version)
+        for file_id in sorted(reprocess):
+            self.process_file(file_id)
+        log.debug('Database.recalibrate(%s) recalculated %d events, processed %d files again' % (
+                    ref, updated, len(reprocess)))
+        return updated, len(reprocess)
+
+    def remove_data(self, event_where, event_params, raw_where, raw_params,
+                    chunk_size=DEFAULT_DELETE_CHUNK_SIZE):
+        """
+        Remove the events matching event_where/event_params and the raw_data
+        matching raw_where/raw_params (see Filter.event_criteria and
+        Filter.raw_data_criteria), and any input files left with neither.
+
+        Everything is done in one transaction, but each table is deleted
+        from in ranges of chunk_size rowids, so no single statement has to
+        find every matching row at once.  Only the files which had matching
+        rows are checked for being left empty.  Returns a tuple (events
+        removed, raw_data removed, list of the paths of files removed).
+        """
+        c = self._conn.cursor()
+        c.execute('begin')
+        try:
+            # in the transaction, so the days are those of the events deleted
+            days = self.event_days(c, event_where, event_params)
+            file_ids = set()
+            event_count = self.delete_chunked(c, 'event', event_where, event_params, chunk_size, file_ids)
+            raw_count = self.delete_chunked(c, 'raw_data', raw_where, raw_params, chunk_size, file_ids)
+            removed = []
+            for file_id in sorted(file_ids):
+                c.execute("""
+                          SELECT       path
+                          FROM         input_file
+                          WHERE        id = ?
+                          AND          NOT EXISTS (SELECT 1 FROM event WHERE file_id = ?)
+                          AND          NOT EXISTS (SELECT 1 FROM raw_data WHERE file_id = ?)
+                          """, (file_id, file_id, file_id))
+                result = c.fetchall()
+                if len(result) > 0:
+                    c.execute("""DELETE FROM input_file WHERE id = ?""", (file_id,))
+                    removed.append(result[0][0])
+            self.update_file_count(c, -len(removed))
+            c.execute("""DELETE FROM ref_statistics WHERE events = 0 AND raw_data = 0""")
+            self.refresh_rollup(c, days)
+            self.bump_data_version(c)
+            version = self.bump_event_version(c)
+        except:
+            c.execute('rollback')
+            raise
+        self.commit(c)
+        self.refresh_event_store(days, version)
+        return event_count, raw_count, removed
+
+    def delete_chunked(self, c, table, where, params, chunk_size, file_ids):
+        """
+        Delete the rows of table (event or raw_data) matching where/params,
+        chunk_size rowids at a time, adding the file_id of each deleted row
+        to the set file_ids and subtracting the rows from ref_statistics.
+        Returns the number of rows deleted.
+        """
+        unprocessed = 'SUM(processed = 0)' if table == 'raw_data' else '0'
+        c.execute("""
+                  SELECT     file_id, ref, MIN(rowid), MAX(rowid), COUNT(1), %s
+                  FROM       %s
+                  WHERE      %s
+                  GROUP BY   file_id, ref
+                  """ % (unprocessed, table, where), params)
+        ranges = c.fetchall()
+        count = 0
+        if len(ranges) == 0:
+            return count
+        for file_id, ref, first, last, rows, rows_unprocessed in ranges:
+            file_ids.add(file_id)
+            if table == 'event':
+                self.update_statistics(c, ref, events=-rows)
+            else:
+                self.update_statistics(c, ref, raw_data=-rows, unprocessed=-rows_unprocessed)
+        first = min(r[2] for r in ranges)
+        last = max(r[3] for r in ranges)
+        with instrument.phase('remove.%s' % table):
+            for start in range(first, last + 1, chunk_size):
+                c.execute("""DELETE FROM %s WHERE rowid >= ? AND rowid < ? AND %s""" % (table, where),
+                          [start, start + chunk_size] + list(params))
+                count += c.rowcount
+        instrument.count('remove.%s' % table, count)
+        return count
+
+    def store_file(self, path, rows, get_manifest=None):
+        """
+        Write the rows of one input file to raw_data and process them.
+
+        rows is an iterable of raw_data_values() tuples, with None in place 
+        of any record which failed checks (see check_records).  The rows are
+        written in a single transaction in batches of chunk_size.  If given,
+        get_manifest is called once rows have been consumed, and returns a
+        dict as InputFile.manifest() for the file they were read from.
+        """
+        c = self._conn.cursor()
+        c.execute('begin')
         try:
             c.execute("""INSERT INTO input_file (path, import_date, records, errors)
                          VALUES (?, ?, NULL, NULL)""", (path, datetime.now()))
+            self.update_file_count(c, 1)
         except sqlite3.IntegrityError as e:
+            self.rollback()
             log.error('%s : perhaps the file %s has already been added to the database?' % (e, path))
             return False
         except Exception as e:
+            self.rollback()
             log.error('Unexpected exception: %s / %s' % (type(e), e))
             return False
+        self.commit(c)
         try:
             c.execute("""SELECT id FROM input_file WHERE path = ?""", (path,))
             result = c.fetchall()
@@ -347,106 +1492,122 @@ class Database:
             raise
 
         c.execute('begin')
-        record_count, error_count = 0, 0
-        for record in infile:
-            record_count += 1
-            try:
-                c.execute("""
-                          INSERT OR IGNORE INTO raw_data (
-                              file_id,
-                              ref,
-                              dt,
-                              tm,
-                              wind_1,
-                              wind_2,
-                              direction,
-                              irradiance,
-                              batt_v,
-                              processed,
-                              ts
-                          )
-                          VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ? )
-                          """, (
-                                file_id, 
-                                record['ref'],
-                                record['dt'],
-                                record['tm'],
-                                record['wind_1'],
-                                record['wind_2'],
-                                record['direction'],
-                                record['irradiance'],
-                                record['batt_v'],
-                                str2isodatestr('%sT%s' % (record['dt'], record['tm']),
-                                               '%Y-%m-%d %H:%M:%S')
-                               ))
-            except Exception as e:
-                log.warning('Database.add_file, failed to add record: %s, exception: %s' % (record, e))
-                error_count += 1
+        record_count, error_count = self.write_rows(c, file_id, rows)
+        log.info('%s: %d records parsed, %d accepted, %d rejected' % (path, record_count,
+                 record_count - error_count, error_count))
         if record_count == 0:
             log.warning('Database.add_file: no records were added')
             c.execute('DELETE FROM input_file WHERE path = ?', (path,))
+            self.update_file_count(c, -1)
             self.commit(c)
         else:
             # Update input_file record to reflect 
-            c.execute("""UPDATE input_file SET records = ?, errors = ? WHERE path = ?""", (record_count, error_count, path))
+            manifest = dict.fromkeys(['bytes_read', 'size', 'mtime', 'tail_sha1'])
+            if get_manifest is not None:
+                manifest = get_manifest()
+            c.execute("""
+                      UPDATE     input_file 
+                      SET        records = ?, 
+                                 errors = ?, 
+                                 bytes_read = ?,
+                                 size = ?,
+                                 mtime = ?,
+                                 tail_sha1 = ?
+                      WHERE      path = ?
+                      """, (record_count, error_count, manifest['bytes_read'], manifest['size'],
+                            manifest['mtime'], manifest['tail_sha1'], path))
             self.commit(c)
             self.process_file(file_id)
 
+    def write_rows(self, c, file_id, rows):
+        """
+        Insert rows (as for store_file) into raw_data for file_id using 
+        cursor c, in batches of chunk_size.  Returns a tuple of the number 
+        of records and the number of those which were errors.
+        """
+        record_count, error_count = 0, 0
+        c.execute("""SELECT MAX(rowid) FROM raw_data""")
+        last_rowid = c.fetchall()[0][0] or 0
+        for chunk in iter_chunks(rows, self._chunk_size):
+            batch = []
+            for row in chunk:
+                record_count += 1
+                if row is None:
+                    error_count += 1
+                else:
+                    batch.append((file_id,) + row)
+            with instrument.phase('add.insert'):
+                c.executemany("""
+                              INSERT OR IGNORE INTO raw_data (
+                                  file_id,
+                                  ref,
+                                  wind_1,
+                                  wind_2,
+                                  direction,
+                                  irradiance,
+                                  batt_v,
+                                  ts,
+                                  processed
+                              )
+                              VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, 0 )
+                              """, batch)
+        # the rows just inserted are the ones after the previous last rowid
+        c.execute("""SELECT ref, COUNT(1) FROM raw_data WHERE rowid > ? GROUP BY ref""", (last_rowid,))
+        for ref, count in c.fetchall():
+            self.update_statistics(c, ref, raw_data=count, unprocessed=count)
+        self.bump_data_version(c)
+        return record_count, error_count
+
     def process_file(self, file_id):
-        q = self._conn.cursor()
+        """
+        Derive events from the unprocessed raw_data records of an input file.
+
+        Events are calculated for the whole file at once (see wind.events),
+        then written with a single bulk insert, and the raw_data records 
+        which produced them are flagged as processed with a single update.
+
+        If the file already has events (because records were appended to
+        it, see update_file) only records after the last event are used, 
+        and the first of them ends an event starting at the last event.
+        """
         calibration = self.get_calibration()
-        q.execute("""
-                  SELECT     ts, ref, wind_1, wind_2, 
-                             direction, irradiance, batt_v, rowid
-                  FROM       raw_data 
-                  WHERE      file_id = ?
-                  AND        processed = 0
-                  ORDER BY ts ASC
-                  """, (file_id,))
-        prev_ts = None
         c = self._conn.cursor()
         c.execute('begin')
-        for r in q.fetchall():
-            try:
-                if prev_ts is None:
-                    prev_ts = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S")
-                    continue
-                ts = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S")
-                delta_t = ts - prev_ts
-                if delta_t.seconds == 0:
-                    # no time since previous record - SKIP
-                    log.warning('Database.process_file(%s) multiple records for time: %s, SKIPPING after first' % (
-                                    file_id, ts))
-                    continue
-                elapsed = float(delta_t.seconds)
-                wind_1_hz = r[2] / elapsed
-                wind_2_hz = r[3] / elapsed
-                windspeed_ms_1 = wind_1_hz * calibration[r[1]]['anemometer_1_factor']
-                windspeed_ms_2 = wind_2_hz * calibration[r[1]]['anemometer_2_factor']
-                irradiance_wm2 = r[5] * calibration[r[1]]['irradiance_factor']
-                if windspeed_ms_1 > calibration[r[1]]['max_windspeed_ms']:
-                    raise Exception('Spurious windspeed 1 (%.3f > %.3f)' % (windspeed_ms_1, calibration[r[1]]['max_windspeed_ms']))
-                if windspeed_ms_2 > calibration[r[1]]['max_windspeed_ms']:
-                    raise Exception('Spurious windspeed 2 (%.3f > %.3f)' % (windspeed_ms_2, calibration[r[1]]['max_windspeed_ms']))
-                if irradiance_wm2 > calibration[r[1]]['max_irradiance']:
-                    raise Exception('Spurious irradiance_wm2 (%.3f > %.3f)' % (irradiance_wm2, calibration[r[1]]['max_irradiance']))
-                subs = (r[1], 
-                        file_id, 
-                        prev_ts, 
-                        ts, 
-                        elapsed, 
-                        wind_1_hz,
-                        wind_2_hz,
-                        r[5],
-                        windspeed_ms_1,
-                        windspeed_ms_2,
-                        r[4],
-                        irradiance_wm2
-                        )
-                c.execute("""
+        c.execute("""SELECT MAX(event_end) FROM event WHERE file_id = ?""", (file_id,))
+        last_event_end = c.fetchall()[0][0]
+        c.execute("""SELECT MAX(id) FROM event""")
+        last_event_id = c.fetchall()[0][0] or 0
+        start, after, params = None, '', [file_id]
+        if last_event_end is not None:
+            start = (last_event_end, last_event_end)
+            after = 'AND        ts > ?'
+            params.append(last_event_end)
+        # ts is epoch seconds, so it is both the value stored in the events
+        # and the time derive_events uses
+        with instrument.phase('process.select'):
+            c.execute("""
+                      SELECT     ts, ts, ref, wind_1, wind_2, direction, irradiance, rowid
+                      FROM       raw_data 
+                      WHERE      file_id = ?
+                      AND        processed = 0
+                      %s
+                      ORDER BY ts ASC
+                      """ % after, params)
+            rows = c.fetchall()
+        with instrument.phase('process.derive'):
+            events, accepted = derive_events(rows, calibration, start)
+        instrument.count('process.rows', len(rows))
+        instrument.count('process.events', len(events))
+        ref_events = dict()
+        for e in events:
+            ref_events[e[0]] = ref_events.get(e[0], 0) + 1
+        for ref, count in ref_events.items():
+            self.update_statistics(c, ref, events=count)
+        with instrument.phase('process.insert'):
+            c.executemany("""
                           INSERT INTO event (
-                              ref, 
                               file_id, 
+                              ref, 
                               event_start, 
                               event_end, 
                               event_duration, 
@@ -459,14 +1620,62 @@ class Database:
                               irradiance_wm2
                           )
                           VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )
-                          """, subs)
-                c.execute("""UPDATE raw_data SET processed = 1 WHERE rowid = ?""", (r[7],))
-                prev_ts = ts
-            except KeyError as e:
-                log.error('Failed to add event because of a missing dependency (did you add calibration for ref %s?)' % r[1])
-            except Exception as e:
-                log.exception('Failed to add event: %s / %s' % (type(e), e))
-        c.execute('commit')
+                          """, [(file_id,) + e for e in events])
+        with instrument.phase('process.rollup'):
+            self.refresh_rollup(c, [epoch2day(e[2]) for e in events])
+        # Usually almost every record is accepted, so flag everything except
+        # the records which were not, of the records selected above (the
+        # same file_id, processed and ts conditions and params)
+        with instrument.phase('process.flag'):
+            accepted = set(accepted)
+            c.execute("""CREATE TEMP TABLE IF NOT EXISTS tmp_unprocessed_rids (rid INTEGER PRIMARY KEY)""")
+            c.executemany("""INSERT INTO tmp_unprocessed_rids VALUES (?)""", 
+                          [(r[7],) for idx, r in enumerate(rows) if idx not in accepted])
+            c.execute("""
+                      SELECT     ref, COUNT(1)
+                      FROM       raw_data
+                      WHERE      file_id = ?
+                      AND        processed = 0
+                      %s
+                      AND        rowid NOT IN (SELECT rid FROM tmp_unprocessed_rids)
+                      GROUP BY   ref
+                      """ % after, params)
+            for ref, count in c.fetchall():
+                self.update_statistics(c, ref, unprocessed=-count)
+            c.execute("""
+                      UPDATE     raw_data
+                      SET        processed = 1
+                      WHERE      file_id = ?
+                      AND        processed = 0
+                      %s
+                      AND        rowid NOT IN (SELECT rid FROM tmp_unprocessed_rids)
+                      """ % after, params)
+            c.execute("""DELETE FROM tmp_unprocessed_rids""")
+        self.bump_data_version(c)
+        if len(events) > 0:
+            version = self.bump_event_version(c)
+        with instrument.phase('process.commit'):
+            c.execute('commit')
+        if len(events) > 0:
+            self.update_event_store(version, lambda store: store.add_events(c, 'id > ?', [last_event_id]))
+        log.debug('Database.process_file(%s) added %d events from %d raw_data records' % (
+                    file_id, len(events), len(rows)))
+
+    def get_field_map(self):
+        """Return the field_mapping table as returned by InputFile.read_field_map, read once."""
+        if self._field_map is None:
+            self._field_map = InputFile.read_field_map(self)
+        return self._field_map
+
+    def get_parse_plan(self, headers):
+        """
+        Return compile_parse_plan(headers, self.get_field_map()), compiled 
+        once for each distinct header line.
+        """
+        if headers not in self._parse_plans:
+            log.debug('Database.get_parse_plan compiling plan for %s' % (headers,))
+            self._parse_plans[headers] = compile_parse_plan(headers, self.get_field_map())
+        return self._parse_plans[headers]
 
     def get_calibration(self):
         """
@@ -497,12 +1706,18 @@ class Database:
 
     def reset(self):
         """Reset the database to a clean state"""
-        for table in ['event', 'raw_data', 'input_file', 'field_mapping', 'calibration', 'winda_schema_v_1_00']:
+        for table in ['event', 'raw_data', 'input_file', 'field_mapping', 'calibration', 'windspeed_rollup',
+                      'ref_statistics', 'database_state', 'query_cache', 'winda_schema_v_%s' % self.schema_version()]:
             self._conn.execute("""DROP TABLE %s""" % table)
+        self._field_map = None
+        self._parse_plans = dict()
         self.create_schema()
+        if self.open_event_store() is not None:
+            with self.event_store.lock():
+                self.event_store.clear()
+                self.event_store.set_version(self.event_version())
 
     def list_input_files(self):
         c = self._conn.cursor()
         c.execute("""SELECT * FROM input_file""")
         return result_as_dict_array(c)
-
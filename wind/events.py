@@ -0,0 +1,234 @@
+"""
+Derive events from raw_data records.
+
+An event spans the time between two consecutive accepted raw_data records
+of an input file.  The anemometer tick counts of the later record are
+divided by the elapsed time to get a frequency, and calibration factors
+are applied to get windspeeds and irradiance.  Records are not accepted
+(and so do not start the next event) if:
+
+  - they have the same time as the previous accepted record
+  - there is no calibration for their ref
+  - the calibrated windspeeds or irradiance exceed the limits in the
+    calibration, or cannot be calculated at all
+
+The columnar implementation uses NumPy if it is installed, otherwise
+a plain Python implementation with the same results is used.
+"""
+
+import time
+import logging
+import numbers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging
+
+def derive_events(rows, calibration, start=None):
+    """
+    Derive events from raw_data rows.
+
+    rows is a list of (ts, epoch, ref, wind_1, wind_2, direction, irradiance)
+    tuples sorted by epoch (any further items in the tuples are ignored).  calibration is as returned by
+    Database.get_calibration().  start is an optional (ts, epoch) tuple for
+    the last accepted record before rows, else the first row is used only
+    to start the first event.
+
+    Returns a tuple (events, accepted) where events is a list of tuples
+    (ref, event_start, event_end, event_duration, anemometer_hz_1,
+    anemometer_hz_2, irradiance_v, windspeed_ms_1, windspeed_ms_2,
+    wind_direction, irradiance_wm2), and accepted is a list of the indexes
+    in rows which produced each event.
+    """
+    if numpy is not None:
+        return derive_events_numpy(rows, calibration, start)
+    else:
+        return derive_events_python(rows, calibration, start)
+
+def format_value(v):
+    if isinstance(v, numbers.Number):
+        return '%.3f' % v
+    return str(v)
+
+def format_ts(ts):
+    """Return ts for a message, as 'YYYY-MM-DD HH:MM:SS' if it is epoch seconds."""
+    if isinstance(ts, numbers.Integral):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+    return str(ts)
+
+def log_rejected(row, prev_epoch, calibration, values=None):
+    """Log the reason a row did not produce an event."""
+    ts, epoch, ref = format_ts(row[0]), row[1], row[2]
+    if values is not None and True in [v != v for v in values]:
+        # NaN, i.e. the values could not be calculated
+        values = None
+    if epoch == prev_epoch:
+        log.warning('multiple records for time: %s, SKIPPING after first' % ts)
+    elif ref not in calibration:
+        log.error('Failed to add event because of a missing dependency (did you add calibration for ref %s?)' % ref)
+    elif values is None:
+        log.error('Failed to add event at %s: could not calculate values from %s' % (ts, str(row)))
+    else:
+        windspeed_ms_1, windspeed_ms_2, irradiance_wm2 = [float(v) for v in values]
+        cal = calibration[ref]
+        if not windspeed_ms_1 <= cal['max_windspeed_ms']:
+            log.error('Failed to add event at %s: Spurious windspeed 1 (%.3f > %s)' % (
+                        ts, windspeed_ms_1, format_value(cal['max_windspeed_ms'])))
+        elif not windspeed_ms_2 <= cal['max_windspeed_ms']:
+            log.error('Failed to add event at %s: Spurious windspeed 2 (%.3f > %s)' % (
+                        ts, windspeed_ms_2, format_value(cal['max_windspeed_ms'])))
+        else:
+            log.error('Failed to add event at %s: Spurious irradiance_wm2 (%.3f > %s)' % (
+                        ts, irradiance_wm2, format_value(cal['max_irradiance'])))
+
+def derive_events_python(rows, calibration, start=None):
+    """Row at a time implementation of derive_events."""
+    events, accepted = [], []
+    rows = iter(enumerate(rows))
+    if start is None:
+        for idx, r in rows:
+            start = (r[0], r[1])
+            break
+    if start is None:
+        return events, accepted
+    prev_ts, prev_epoch = start
+    for idx, r in rows:
+        ts, epoch, ref, wind_1, wind_2, direction, irradiance = r[:7]
+        values = None
+        try:
+            if epoch == prev_epoch:
+                raise ValueError('no time since previous record')
+            cal = calibration[ref]
+            elapsed = float(epoch - prev_epoch)
+            wind_1_hz = wind_1 / elapsed
+            wind_2_hz = wind_2 / elapsed
+            windspeed_ms_1 = wind_1_hz * cal['anemometer_1_factor']
+            windspeed_ms_2 = wind_2_hz * cal['anemometer_2_factor']
+            irradiance_wm2 = irradiance * cal['irradiance_factor']
+            values = (windspeed_ms_1, windspeed_ms_2, irradiance_wm2)
+            if not (windspeed_ms_1 <= cal['max_windspeed_ms'] and
+                    windspeed_ms_2 <= cal['max_windspeed_ms'] and
+                    irradiance_wm2 <= cal['max_irradiance']):
+                raise ValueError('spurious value')
+        except Exception:
+            log_rejected(r, prev_epoch, calibration, values)
+            continue
+        events.append((ref, prev_ts, ts, elapsed, wind_1_hz, wind_2_hz, irradiance,
+                       windspeed_ms_1, windspeed_ms_2, direction, irradiance_wm2))
+        accepted.append(idx)
+        prev_ts, prev_epoch = ts, epoch
+    return events, accepted
+
+def as_float_array(values):
+    """Return a float64 array of values, with NaN for anything non-numeric."""
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        return numpy.array([v if isinstance(v, numbers.Number) else numpy.nan
+                            for v in values], dtype=numpy.float64)
+
+def derive_events_numpy(rows, calibration, start=None):
+    """
+    Columnar implementation of derive_events.
+
+    All rows are first calculated as if the previous row had been accepted.
+    Because a row which is not accepted changes the start of the next event,
+    rows following a rejected row are then re-calculated against the last
+    accepted row until one is accepted, after which the columnar results
+    are valid again.
+    """
+    if start is None:
+        if len(rows) == 0:
+            return [], []
+        start = (rows[0][0], rows[0][1])
+        rows = rows[1:]
+        offset = 1
+    else:
+        offset = 0
+    n = len(rows)
+    if n == 0:
+        return [], []
+    ts, epochs, refs, wind_1, wind_2, directions, irradiance = list(zip(*rows))[:7]
+    epochs = numpy.array((start[1],) + epochs, dtype=numpy.int64)
+    wind_1 = as_float_array(wind_1)
+    wind_2 = as_float_array(wind_2)
+    irradiance_v = as_float_array(irradiance)
+
+    # Calibration for each row, NaN where there is none for the ref
+    ref_names = list(set(refs))
+    lookup = dict((r, i) for i, r in enumerate(ref_names))
+    ref_idx = numpy.array([lookup[r] for r in refs], dtype=int)
+    cal = dict()
+    for key in ['anemometer_1_factor', 'anemometer_2_factor', 'irradiance_factor', 'max_windspeed_ms', 'max_irradiance']:
+        table = [calibration[r][key] if r in calibration else None for r in ref_names]
+        cal[key] = as_float_array(table)[ref_idx]
+
+    def calculate(idx, prev_idx):
+        # idx are row indexes, prev_idx are indexes into epochs
+        elapsed = (epochs[idx + 1] - epochs[prev_idx]).astype(numpy.float64)
+        with numpy.errstate(all='ignore'):
+            wind_1_hz = wind_1[idx] / elapsed
+            wind_2_hz = wind_2[idx] / elapsed
+            windspeed_ms_1 = wind_1_hz * cal['anemometer_1_factor'][idx]
+            windspeed_ms_2 = wind_2_hz * cal['anemometer_2_factor'][idx]
+            irradiance_wm2 = irradiance_v[idx] * cal['irradiance_factor'][idx]
+            # NaN compares False, so anything which could not be calculated
+            # is not accepted
+            ok = ((elapsed > 0) &
+                  (windspeed_ms_1 <= cal['max_windspeed_ms'][idx]) &
+                  (windspeed_ms_2 <= cal['max_windspeed_ms'][idx]) &
+                  (irradiance_wm2 <= cal['max_irradiance'][idx]))
+        return ok, (elapsed, wind_1_hz, wind_2_hz, windspeed_ms_1, windspeed_ms_2, irradiance_wm2)
+
+    all_rows = numpy.arange(n)
+    ok, values = calculate(all_rows, all_rows)
+    bad = numpy.flatnonzero(~ok)
+
+    # prev[i] is the index into epochs of the start of row i's event
+    prev = all_rows.copy()
+    accepted = numpy.zeros(n, dtype=bool)
+    pos, last = 0, 0
+    while pos < n:
+        # rows from pos up to the next bad row follow an accepted row
+        b = bad[numpy.searchsorted(bad, pos)] if len(bad) > 0 and bad[-1] >= pos else n
+        accepted[pos:b] = True
+        if b == n:
+            break
+        last = b if b > pos else last
+        log_rejected(rows[b], epochs[b], calibration, tuple(v[b] for v in values[3:]))
+        # re-calculate following rows against the last accepted row
+        pos = b + 1
+        while pos < n:
+            one = numpy.array([pos])
+            row_ok, row_values = calculate(one, numpy.array([last]))
+            if row_ok[0]:
+                for column, row_value in zip(values, row_values):
+                    column[pos] = row_value[0]
+                prev[pos] = last
+                accepted[pos] = True
+                last = pos + 1
+                pos += 1
+                break
+            log_rejected(rows[pos], epochs[last], calibration, tuple(v[0] for v in row_values[3:]))
+            pos += 1
+        else:
+            break
+        # prev[pos-1] was just accepted so the columnar results hold from here
+        last = pos
+
+    idx = numpy.flatnonzero(accepted)
+    ts_all = (start[0],) + ts
+    picked = idx.tolist()
+    columns = [[refs[i] for i in picked],
+               [ts_all[i] for i in prev[idx].tolist()],
+               [ts[i] for i in picked]]
+    columns.extend(v[idx].tolist() for v in values[:3])
+    columns.append([irradiance[i] for i in picked])
+    columns.extend(v[idx].tolist() for v in values[3:5])
+    columns.append([directions[i] for i in picked])
+    columns.append(values[5][idx].tolist())
+    events = list(zip(*columns))
+    return events, [i + offset for i in idx.tolist()]
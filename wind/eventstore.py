@@ -0,0 +1,293 @@
+"""
+A columnar store of events, kept alongside the sqlite database, which the
+speeds and average commands can scan with NumPy instead of the event table.
+
+The store is a directory with a sub-directory per day (of event_end),
+holding one file per column of fixed width values:
+
+    file_id         int32
+    ref             uint16   index into the dictionary of refs
+    event_start     int64    epoch seconds
+    event_end       int64    epoch seconds
+    windspeed_ms_1  float64
+    windspeed_ms_2  float64
+    direction       uint8    index into the dictionary of directions
+    irradiance_wm2  float32
+
+The dictionaries are in dictionary.json.  Events are only ever appended to
+the column files, which are read with numpy.memmap, so a scan does not
+copy or decode anything.  Days whose events change in other ways (removed,
+recalibrated) are rewritten from the event table (see refresh_days).
+
+The store is derived from the event table, which stays the master copy:
+`winda convert` creates it (or rebuilds it), after which Database keeps it
+up to date.  state.json holds the database's event_version the store is
+up to date with, so a store which has missed a change (e.g. the process
+changing it was killed) is not used.  Writers hold lock() while they
+change the store.  Windspeeds are float64, like the event table, because the
+speeds transform bins them at exact boundaries, and float32 values can
+fall in a different range.  The store needs numpy.
+"""
+
+import os
+import json
+import shutil
+import logging
+import calendar
+from datetime import datetime
+from contextlib import contextmanager
+from wind import instrument
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging
+
+# Columns as (name, SQL expression, numpy dtype name)
+COLUMNS = [
+    ('file_id', 'file_id', 'int32'),
+    ('ref', 'ref', 'uint16'),
+    ('event_start', 'event_start', 'int64'),
+    ('event_end', 'event_end', 'int64'),
+    ('windspeed_ms_1', 'windspeed_ms_1', 'float64'),
+    ('windspeed_ms_2', 'windspeed_ms_2', 'float64'),
+    ('direction', 'wind_direction', 'uint8'),
+    ('irradiance_wm2', 'irradiance_wm2', 'float32'),
+]
+
+# Columns which hold indexes into a dictionary of their values
+DICTIONARY_COLUMNS = ['ref', 'direction']
+
+# Number of events read from the event table at a time
+DEFAULT_BATCH_SIZE = 65536
+
+def event_store_path(database_path):
+    """Return the path of the event store directory for a database file."""
+    return database_path + '.events'
+
+def day_name(day):
+    """Return the directory name ('YYYY-MM-DD') for a day number (days since 1970-01-01)."""
+    return datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d')
+
+def epoch(dt):
+    """Return epoch seconds for a datetime (as UTC, like sqlite's strftime('%s'))."""
+    return calendar.timegm(dt.timetuple())
+
+class EventStore:
+    def __init__(self, directory):
+        """Open the event store in directory, creating it if it does not exist."""
+        if numpy is None:
+            raise Exception('The event store %s needs numpy, which is not installed' % directory)
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._dictionary_path = os.path.join(directory, 'dictionary.json')
+        self._state_path = os.path.join(directory, 'state.json')
+        self._lock_path = os.path.join(directory, 'lock')
+        self.read_dictionaries()
+
+    def read_dictionaries(self):
+        """
+        Read the dictionaries from dictionary.json.  Codes are never
+        changed once assigned, so this only adds the values other
+        processes have added since.
+        """
+        self._dictionaries = dict((name, []) for name in DICTIONARY_COLUMNS)
+        if os.path.exists(self._dictionary_path):
+            with open(self._dictionary_path) as f:
+                self._dictionaries.update(json.load(f))
+        self._codes = dict((name, dict((v, i) for i, v in enumerate(values)))
+                           for name, values in self._dictionaries.items())
+
+    @contextmanager
+    def lock(self):
+        """
+        Context manager which holds an exclusive lock on the store, for a
+        process changing it.  The dictionaries are read again once the lock
+        is held, so new values are given codes after those of any other
+        process.  Without fcntl (on Windows) there is no lock.
+        """
+        with open(self._lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.read_dictionaries()
+                yield self
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def version(self):
+        """Return the event_version of the database the store is up to date with, or None."""
+        if not os.path.exists(self._state_path):
+            return None
+        with open(self._state_path) as f:
+            return json.load(f).get('event_version')
+
+    def set_version(self, version):
+        """Record that the store is up to date with event_version version."""
+        tmp = self._state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'event_version': version}, f)
+        os.rename(tmp, self._state_path)
+
+    def days(self):
+        """Return a sorted list of the days ('YYYY-MM-DD') with events in the store."""
+        return sorted(d for d in os.listdir(self._directory)
+                      if os.path.isdir(os.path.join(self._directory, d)))
+
+    def columns(self, day):
+        """Return a dict of name: read-only array (a memmap) of the columns for day."""
+        result = dict()
+        for name, sql, dtype in COLUMNS:
+            path = os.path.join(self._directory, day, name)
+            if os.path.getsize(path) == 0:
+                # mmap cannot map an empty file
+                result[name] = numpy.empty(0, dtype=dtype)
+            else:
+                result[name] = numpy.memmap(path, dtype=dtype, mode='r')
+        if len(set(len(a) for a in result.values())) != 1:
+            raise Exception('The event store %s is damaged for %s, run winda convert to rebuild it' % (
+                            self._directory, day))
+        return result
+
+    def encode(self, name, values):
+        """Return the dictionary codes of values for column name, adding any new values."""
+        codes = self._codes[name]
+        dictionary = self._dictionaries[name]
+        result = []
+        for v in values:
+            if v not in codes:
+                codes[v] = len(dictionary)
+                dictionary.append(v)
+            result.append(codes[v])
+        return result
+
+    def add_events(self, cursor, where, params, size=DEFAULT_BATCH_SIZE):
+        """
+        Append the events matching where/params (an SQL expression for the
+        event table and its parameters) to the store.  The caller should
+        hold lock().  Returns the number of events added.
+        """
+        cursor.execute("""
+                       SELECT          %s
+                       FROM            event
+                       WHERE           %s
+                       """ % (', '.join(c[1] for c in COLUMNS), where), params)
+        count = 0
+        dictionary_size = sum(len(d) for d in self._dictionaries.values())
+        while True:
+            rows = cursor.fetchmany(size)
+            if len(rows) == 0:
+                break
+            with instrument.phase('eventstore.append'):
+                columns = list(zip(*rows))
+                arrays = dict()
+                for values, (name, sql, dtype) in zip(columns, COLUMNS):
+                    if name in DICTIONARY_COLUMNS:
+                        values = self.encode(name, values)
+                    # NULL windspeeds and irradiance become NaN
+                    arrays[name] = numpy.array(values, dtype=numpy.float64 if dtype.startswith('float') else dtype
+                                               ).astype(dtype)
+                days = arrays['event_end'] // 86400
+                for day in numpy.unique(days).tolist():
+                    idx = numpy.flatnonzero(days == day)
+                    self.append(day_name(day), dict((name, a[idx]) for name, a in arrays.items()))
+                count += len(rows)
+        if sum(len(d) for d in self._dictionaries.values()) != dictionary_size:
+            self.write_dictionaries()
+        instrument.count('eventstore.events', count)
+        return count
+
+    def append(self, day, arrays):
+        directory = os.path.join(self._directory, day)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        for name, sql, dtype in COLUMNS:
+            with open(os.path.join(directory, name), 'ab') as f:
+                f.write(arrays[name].tobytes())
+
+    def write_dictionaries(self):
+        tmp = self._dictionary_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._dictionaries, f)
+        os.rename(tmp, self._dictionary_path)
+
+    def remove_days(self, names):
+        for name in set(names):
+            directory = os.path.join(self._directory, name)
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    def refresh_days(self, cursor, days):
+        """Rewrite the events of days (an iterable of day numbers) from the event table (holding lock())."""
+        for day in sorted(set(days)):
+            self.remove_days([day_name(day)])
+            self.add_events(cursor, 'event_end >= ? AND event_end < ?', [day * 86400, (day + 1) * 86400])
+
+    def clear(self):
+        """Remove every event from the store."""
+        self.remove_days(self.days())
+
+    def rebuild(self, cursor):
+        """Rewrite the whole store from the event table (holding lock()).  Returns the number of events."""
+        self.clear()
+        return self.add_events(cursor, '1', [])
+
+    def value_counts(self, anemometer, split, lower=None, upper=None, file_ids=None, lowest=None, highest=None):
+        """
+        Return a list of (direction, windspeed, count) like
+        wind.analysis.windspeed_value_counts, for the events with event_end
+        from lower to upper (inclusive datetimes, None meaning unbounded)
+        and, if file_ids is not None, from one of those input files.
+        """
+        # another process may have added directions since this was opened
+        self.read_dictionaries()
+        first_day = lower.strftime('%Y-%m-%d') if lower is not None else None
+        last_day = upper.strftime('%Y-%m-%d') if upper is not None else None
+        counts = dict()
+        for day in self.days():
+            if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+                continue
+            columns = self.columns(day)
+            windspeeds = columns['windspeed_ms_%d' % anemometer]
+            mask = numpy.ones(len(windspeeds), dtype=bool)
+            if lower is not None and day == first_day:
+                mask &= columns['event_end'] >= epoch(lower)
+            if upper is not None and day == last_day:
+                mask &= columns['event_end'] <= epoch(upper)
+            if file_ids is not None:
+                mask &= numpy.in1d(columns['file_id'], file_ids)
+            # as in SQL, NULL (NaN) windspeeds are outside any range
+            with numpy.errstate(invalid='ignore'):
+                if lowest is not None:
+                    mask &= windspeeds >= lowest
+                if highest is not None:
+                    mask &= windspeeds < highest
+            # count the distinct windspeeds by their bits, so NaNs are counted together
+            bits = numpy.array(windspeeds[mask]).view(numpy.uint64)
+            if split:
+                directions = columns['direction'][mask]
+                groups = [(code, bits[directions == code]) for code in numpy.unique(directions).tolist()]
+            else:
+                groups = [(None, bits)]
+            for code, values in groups:
+                values, value_counts = numpy.unique(values, return_counts=True)
+                for value, count in zip(values.tolist(), value_counts.tolist()):
+                    key = (code, value)
+                    counts[key] = counts.get(key, 0) + count
+        directions = self._dictionaries['direction']
+        result = []
+        for (code, value), count in counts.items():
+            windspeed = float(numpy.array([value], dtype=numpy.uint64).view(numpy.float64)[0])
+            if windspeed != windspeed:
+                windspeed = None
+            result.append((directions[code] if code is not None else None, windspeed, count))
+        return result
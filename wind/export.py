@@ -0,0 +1,152 @@
+"""
+Export events as typed columnar files: Parquet or Arrow IPC files using
+pyarrow, or NumPy .npz archives.
+
+Events are read from sqlite in batches of rows and each batch is turned
+into columns, so no per-row objects are built.  Timestamps are stored as
+epoch seconds, so they become timestamp / datetime64 columns without any
+text being parsed.  pyarrow and numpy are optional, and only
+needed for the formats which use them.
+"""
+
+import logging
+from wind import instrument
+from wind.database import iter_result_chunks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging
+
+FORMATS = ['csv', 'parquet', 'arrow', 'npz']
+
+# Number of events read from sqlite and converted to columns at a time
+DEFAULT_BATCH_SIZE = 65536
+
+# The exported columns as (name, SQL expression, type), where type is one
+# of 'string', 'timestamp' (epoch seconds) or 'float'.  These are the
+# columns of the CSV export.
+EXPORT_COLUMNS = [
+    ('ref', 'ref', 'string'),
+    ('event_start', 'event_start', 'timestamp'),
+    ('event_end', 'event_end', 'timestamp'),
+    ('windspeed_ms_1', 'windspeed_ms_1', 'float'),
+    ('windspeed_ms_2', 'windspeed_ms_2', 'float'),
+    ('wind_direction', 'wind_direction', 'string'),
+    ('irradiance_wm2', 'irradiance_wm2', 'float'),
+]
+
+def missing_dependency(fmt):
+    """Return the name of the module needed to export fmt which is not installed, or None."""
+    if fmt == 'npz' and numpy is None:
+        return 'numpy'
+    if fmt in ['parquet', 'arrow'] and pyarrow is None:
+        return 'pyarrow'
+    return None
+
+def select_events(cursor, where, params):
+    """Execute the query for the EXPORT_COLUMNS of the events matching where/params, in id order."""
+    cursor.execute("""
+                   SELECT          %s
+                   FROM            event e
+                   WHERE           %s
+                   ORDER BY        e.id
+                   """ % (', '.join(c[1] for c in EXPORT_COLUMNS), where), params)
+
+def iter_column_batches(cursor, size=DEFAULT_BATCH_SIZE):
+    """
+    Yield the result of the last query executed by cursor as lists of
+    columns (each a tuple of values) of up to size rows.
+    """
+    for rows in instrument.timed_iter('export.fetch', iter_result_chunks(cursor, size)):
+        instrument.count('export.rows', len(rows))
+        yield list(zip(*rows))
+
+def numpy_column(values, column_type):
+    if column_type == 'timestamp':
+        return numpy.array(values, dtype=numpy.int64).astype('datetime64[s]')
+    elif column_type == 'float':
+        # None (NULL) becomes NaN
+        return numpy.array(values, dtype=numpy.float64)
+    return numpy.array(values, dtype=numpy.unicode_)
+
+def arrow_column(values, column_type):
+    if column_type == 'timestamp':
+        return pyarrow.array(values, type=pyarrow.timestamp('s'))
+    elif column_type == 'float':
+        return pyarrow.array(values, type=pyarrow.float64())
+    return pyarrow.array(values, type=pyarrow.string())
+
+def arrow_schema():
+    types = {'string': pyarrow.string(), 'timestamp': pyarrow.timestamp('s'), 'float': pyarrow.float64()}
+    return pyarrow.schema([pyarrow.field(name, types[column_type]) for name, sql, column_type in EXPORT_COLUMNS])
+
+def write_npz(cursor, path, size=DEFAULT_BATCH_SIZE):
+    """
+    Write the result of select_events to a .npz archive with an array for
+    each column.  An archive cannot be written a batch at a time, so the
+    columns are held in memory as arrays until the end.
+    """
+    batches = [[] for c in EXPORT_COLUMNS]
+    for columns in iter_column_batches(cursor, size):
+        with instrument.phase('export.convert'):
+            for arrays, values, column in zip(batches, columns, EXPORT_COLUMNS):
+                arrays.append(numpy_column(values, column[2]))
+    with instrument.phase('output'):
+        result = dict()
+        for arrays, column in zip(batches, EXPORT_COLUMNS):
+            if len(arrays) == 0:
+                arrays = [numpy_column([], column[2])]
+            result[column[0]] = numpy.concatenate(arrays)
+        numpy.savez(path, **result)
+
+def write_arrow(cursor, path, parquet=False, size=DEFAULT_BATCH_SIZE):
+    """
+    Write the result of select_events to an Arrow IPC file or, if parquet
+    is True, a Parquet file, one record batch (or row group) per batch of
+    size rows.
+    """
+    schema = arrow_schema()
+    if parquet:
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pyarrow.ipc.new_file(path, schema)
+    try:
+        for columns in iter_column_batches(cursor, size):
+            with instrument.phase('export.convert'):
+                batch = pyarrow.RecordBatch.from_arrays(
+                    [arrow_column(values, column[2]) for values, column in zip(columns, EXPORT_COLUMNS)],
+                    schema.names)
+            with instrument.phase('output'):
+                if parquet:
+                    writer.write_table(pyarrow.Table.from_batches([batch], schema))
+                else:
+                    writer.write_batch(batch)
+    finally:
+        writer.close()
+
+def export_events(cursor, where, params, fmt, path, size=DEFAULT_BATCH_SIZE):
+    """
+    Write the events matching where/params (see Filter.event_criteria) to
+    path in one of the columnar FORMATS: parquet, arrow or npz.
+    """
+    log.debug('export_events(%s, %s)' % (fmt, path))
+    missing = missing_dependency(fmt)
+    if missing is not None:
+        raise Exception('Exporting %s files requires %s, which is not installed' % (fmt, missing))
+    select_events(cursor, where, params)
+    if fmt == 'npz':
+        write_npz(cursor, path, size)
+    elif fmt in ['parquet', 'arrow']:
+        write_arrow(cursor, path, parquet=(fmt == 'parquet'), size=size)
+    else:
+        raise Exception('Unknown export format %s, should be one of: %s' % (fmt, ', '.join(FORMATS[1:])))
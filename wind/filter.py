@@ -1,5 +1,7 @@
 import logging
-from wind.database import result_as_dict_array
+from datetime import datetime, time, timedelta
+from wind.database import result_as_dict_array, iter_result_dicts, datetime2epoch, epoch2day
+from wind import instrument
 
 log = logging
 # curiously, can't use %T because windows version doesn't recognise it...
@@ -15,214 +17,157 @@ class Filter:
         date_filter is a datetime.date object
         from_filter is a datetime.datetime object
         to_filter is a datetime.datetime object
+
+        The filters are compiled into a single parameterised WHERE clause
+        (see event_criteria and raw_data_criteria) so selecting data is one
+        query which can use the indexes on the timestamp columns, as a 
+        range of integers (epoch seconds).
         """
         self.file_filter = file_filter
         self.date_filter = date_filter
         self.from_filter = from_filter
         self.to_filter = to_filter
         self.cursor = cursor
-        self.cursor.execute("""CREATE TEMP TABLE tmp_event_rids (rid INT PRIMARY KEY)""")
-        self.cursor.execute("""INSERT INTO tmp_event_rids SELECT rowid FROM event""")
-        self.cursor.execute("""CREATE TEMP TABLE tmp_raw_data_rids (rid INT)""")
-        self.cursor.execute("""INSERT INTO tmp_raw_data_rids SELECT rowid FROM raw_data""")
         log.debug('Filter created: file=%s date=%s from=%s to=%s' % (
                     str(self.file_filter),
                     str(self.date_filter),
                     str(self.from_filter),
                     str(self.to_filter)))
 
-    def __del__(self):
-        self.cursor.execute("""DROP TABLE IF EXISTS tmp_event_rids""")
-        self.cursor.execute("""DROP TABLE IF EXISTS tmp_raw_data_rids""")
-
     def get_all(self):
         return self.file_filter is None and self.date_filter is None and self.from_filter is None and self.to_filter is None
 
+    def criteria(self, ts_column):
+        """
+        Return a tuple (where, params) for a table with a file_id column and
+        a timestamp column ts_column in epoch seconds.
+
+        where is an SQL expression which is true for rows which match all
+        the filters, and params is a list of the values for its parameters.
+        """
+        clauses, params = [], []
+        if self.file_filter is not None:
+            clauses.append('file_id IN (SELECT id FROM input_file WHERE path = ?)')
+            params.append(self.file_filter)
+        if self.date_filter is not None:
+            # a range rather than day = ? so the timestamp index can be used
+            day_start = datetime2epoch(self.date_filter)
+            clauses.append('%s >= ? AND %s < ?' % (ts_column, ts_column))
+            params.append(day_start)
+            params.append(day_start + 86400)
+        if self.from_filter is not None:
+            clauses.append('%s >= ?' % ts_column)
+            params.append(datetime2epoch(self.from_filter))
+        if self.to_filter is not None:
+            clauses.append('%s <= ?' % ts_column)
+            params.append(datetime2epoch(self.to_filter))
+        if len(clauses) == 0:
+            return '1', []
+        return ' AND '.join(clauses), params
+
+    def event_criteria(self):
+        """Return (where, params) selecting the rows of the event table matching this filter."""
+        return self.criteria('event_end')
+
+    def raw_data_criteria(self):
+        """Return (where, params) selecting the rows of the raw_data table matching this filter."""
+        return self.criteria('ts')
+
+    def time_bounds(self):
+        """
+        Return a tuple (lower, upper) of the inclusive bounds of the selected
+        timestamps as datetime objects, either of which is None if there is
+        no bound.  Timestamps are whole seconds.
+        """
+        lower, upper = None, None
+        if self.date_filter is not None:
+            lower = datetime(self.date_filter.year, self.date_filter.month, self.date_filter.day)
+            upper = lower + timedelta(days=1, seconds=-1)
+        if self.from_filter is not None and (lower is None or self.from_filter > lower):
+            lower = self.from_filter
+        if self.to_filter is not None and (upper is None or self.to_filter < upper):
+            upper = self.to_filter
+        return lower, upper
+
+    def rollup_split(self):
+        """
+        Split the selected events into whole days, which can be read from
+        the windspeed_rollup table, and the events either side of them.
+
+        Returns None if the rollup cannot be used (it has no file_id, so
+        not with a file filter, nor if no whole day is selected).  Else 
+        returns a tuple (first_day, last_day, where, params) where 
+        first_day and last_day are the first and last whole days selected 
+        as day numbers (see wind.database.epoch2day, None meaning 
+        unbounded), and where and params select the remaining events from
+        the event table as for event_criteria.
+        """
+        if self.file_filter is not None:
+            return None
+        lower, upper = self.time_bounds()
+        first_day, last_day = None, None
+        if lower is not None:
+            first_day = lower.date()
+            if lower.time() != time(0, 0, 0):
+                first_day += timedelta(days=1)
+        if upper is not None:
+            last_day = upper.date()
+            if upper.time() < time(23, 59, 59):
+                last_day -= timedelta(days=1)
+        if first_day is not None and last_day is not None and first_day > last_day:
+            return None
+        where, params = self.event_criteria()
+        edges, edge_params = [], []
+        if first_day is not None:
+            first_day = epoch2day(datetime2epoch(first_day))
+            edges.append('event_end < ?')
+            edge_params.append(first_day * 86400)
+        if last_day is not None:
+            last_day = epoch2day(datetime2epoch(last_day))
+            edges.append('event_end >= ?')
+            edge_params.append((last_day + 1) * 86400)
+        if len(edges) == 0:
+            return first_day, last_day, '0', []
+        return first_day, last_day, '(%s) AND (%s)' % (where, ' OR '.join(edges)), params + edge_params
+
     def select_events(self):
-        if self.get_all():
-            self.cursor.execute("""SELECT * FROM event""")
+        where, params = self.event_criteria()
+        with instrument.phase('filter.select_events'):
+            self.cursor.execute("""SELECT * FROM event WHERE %s""" % where, params)
             return result_as_dict_array(self.cursor)
-        log.debug('Events selected before filtering: %d' % self.count_selected_events())
-        # For each filter which is defined remove the set of records not matching the filter
-        if self.file_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_event_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          event e,
-                                             input_file i
-                               WHERE         rid = e.rowid
-                               AND           i.id = e.file_id
-                               AND           i.path = ?
-                           )
-                           """, (self.file_filter,))
-        log.debug('Events selected after file_filter(%s): %d' % (
-            self.file_filter, self.count_selected_events()))
 
-        if self.date_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_event_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          event e
-                               WHERE         rid = e.rowid
-                               AND           event_end LIKE ?
-                           )
-                           """, (self.date_filter.strftime('%Y-%m-%d%%'),))
-        log.debug('Events selected after date_filter(%s): %d' % (
-                    str(self.date_filter), self.count_selected_events()))
-
-        if self.from_filter is not None and self.to_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_event_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          event e
-                               WHERE         rid = e.rowid
-                               AND           event_end >= ?
-                               AND           event_end <= ?
-                           )
-                           """, (self.from_filter.strftime(sqlite_datefmt),
-                                 self.to_filter.strftime(sqlite_datefmt)))
-        elif self.from_filter is not None and self.to_filter is None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_event_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          event e
-                               WHERE         rid = e.rowid
-                               AND           event_end >= ?
-                           )
-                           """, (self.from_filter.strftime(sqlite_datefmt),))
-        elif self.from_filter is None and self.to_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_event_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          event e
-                               WHERE         rid = e.rowid
-                               AND           event_end <= ?
-                           )
-                           """, (self.to_filter.strftime(sqlite_datefmt),))
-        log.debug('Events selected after from_filter(%s) to_filter(%s): %d' % (
-                    str(self.from_filter), str(self.to_filter), self.count_selected_events()))
-
-        self.cursor.execute("""
-                       SELECT        *
-                       FROM          event e
-                       WHERE         EXISTS (
-                           SELECT       1
-                           FROM         tmp_event_rids t
-                           WHERE        e.rowid = t.rid
-                       )
-                       """)
-        return result_as_dict_array(self.cursor)
-            
+    def iter_events(self):
+        """
+        Yield a dict for each selected event without reading them all into 
+        memory.  A separate cursor is used, so self.cursor may be used for
+        other queries while iterating.
+        """
+        where, params = self.event_criteria()
+        cursor = self.cursor.connection.cursor()
+        cursor.execute("""SELECT * FROM event WHERE %s""" % where, params)
+        return instrument.timed_iter('filter.iter_events', iter_result_dicts(cursor))
+
     def count_selected_events(self):
-        try:
-            self.cursor.execute("""
-                           SELECT       1
-                           FROM         event e,
-                                        tmp_event_rids t
-                           WHERE        e.rowid = t.rid
-                           """)
-            return len(self.cursor.fetchall())
-        except Exception as e:
-            log.warning('Filter.count_selected_events() exception: %s / %s' % (type(e), e))
-            return 0
+        where, params = self.event_criteria()
+        with instrument.phase('filter.count_selected_events'):
+            self.cursor.execute("""SELECT COUNT(1) FROM event WHERE %s""" % where, params)
+            return self.cursor.fetchall()[0][0]
 
     def select_raw_data(self):
-        if self.get_all():
-            self.cursor.execute("""SELECT * FROM raw_data""")
+        where, params = self.raw_data_criteria()
+        with instrument.phase('filter.select_raw_data'):
+            self.cursor.execute("""SELECT * FROM raw_data WHERE %s""" % where, params)
             return result_as_dict_array(self.cursor)
-        log.debug('Raw Data selected before filtering: %d' % self.count_selected_raw_data())
-        # For each filter which is defined remove the set of records not matching the filter
-        if self.file_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_raw_data_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          raw_data r,
-                                             input_file i
-                               WHERE         rid = r.rowid
-                               AND           i.id = r.file_id
-                               AND           i.path = ?
-                           )
-                           """, (self.file_filter,))
-        log.debug('Raw Data selected after file_filter(%s): %d' % (
-            self.file_filter, self.count_selected_raw_data()))
 
-        if self.date_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_raw_data_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          raw_data r
-                               WHERE         rid = r.rowid
-                               AND           dt = ?
-                           )
-                           """, (self.date_filter.strftime('%d-%m-%Y'),))
-        log.debug('Raw Data selected after date_filter(%s): %d' % (
-                    str(self.date_filter), self.count_selected_raw_data()))
-
-        if self.from_filter is not None and self.to_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_raw_data_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          raw_data r
-                               WHERE         rid = r.rowid
-                               AND           ts >= ?
-                               AND           ts <= ?
-                           )
-                           """, (self.from_filter.strftime(sqlite_datefmt),
-                                 self.to_filter.strftime(sqlite_datefmt)))
-        elif self.from_filter is not None and self.to_filter is None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_raw_data_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          raw_data r
-                               WHERE         rid = r.rowid
-                               AND           ts >= ?
-                           )
-                           """, (self.from_filter.strftime(sqlite_datefmt),))
-        elif self.from_filter is None and self.to_filter is not None:
-            self.cursor.execute("""
-                           DELETE FROM tmp_raw_data_rids
-                           WHERE NOT EXISTS (
-                               SELECT        1
-                               FROM          raw_data r
-                               WHERE         rid = r.rowid
-                               AND           ts <= ?
-                           )
-                           """, (self.to_filter.strftime(sqlite_datefmt),))
-        log.debug('Raw Data selected after from_filter(%s) to_filter(%s): %d' % (
-                    str(self.from_filter), str(self.to_filter), self.count_selected_raw_data()))
-
-        self.cursor.execute("""
-                       SELECT        *
-                       FROM          raw_data r
-                       WHERE         EXISTS (
-                           SELECT       1
-                           FROM         tmp_raw_data_rids t
-                           WHERE        r.rowid = t.rid
-                       )
-                       """)
-        return result_as_dict_array(self.cursor)
+    def iter_raw_data(self):
+        """Yield a dict for each selected raw_data record, like iter_events."""
+        where, params = self.raw_data_criteria()
+        cursor = self.cursor.connection.cursor()
+        cursor.execute("""SELECT * FROM raw_data WHERE %s""" % where, params)
+        return instrument.timed_iter('filter.iter_raw_data', iter_result_dicts(cursor))
 
     def count_selected_raw_data(self):
-        try:
-            self.cursor.execute("""
-                           SELECT       1
-                           FROM         raw_data r,
-                                        tmp_raw_data_rids t
-                           WHERE        r.rowid = t.rid
-                           """)
-            return len(self.cursor.fetchall())
-        except Exception as e:
-            log.warning('Filter.count_selected_raw_data() exception: %s / %s' % (type(e), e))
-            return 0
-
-
-
+        where, params = self.raw_data_criteria()
+        with instrument.phase('filter.count_selected_raw_data'):
+            self.cursor.execute("""SELECT COUNT(1) FROM raw_data WHERE %s""" % where, params)
+            return self.cursor.fetchall()[0][0]
@@ -5,58 +5,201 @@ Provide input file reading functions
 import os
 import logging
 import re
+import hashlib
+from collections import deque
+from wind import instrument
 
 log = logging
 
+# Number of bytes before the end of what has been read of a file whose sha1
+# is recorded, to check that a file has only been appended to since
+TAIL_WINDOW = 64 * 1024
+
+def debug_enabled(logger):
+    """
+    Return True if debug messages sent to logger (a Logger, or the logging
+    module itself) would be output.  Check this once, outside loops over
+    records, rather than formatting a message for every record.
+    """
+    if hasattr(logger, 'isEnabledFor'):
+        return logger.isEnabledFor(logging.DEBUG)
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+# separates the fields of header lines and records
+field_separator = re.compile(r'\s*,\s*')
+
+# cast_type in the field_mapping table -> function
+cast_functions = {'int': int, 'float': float}
+
+def split_headers(line):
+    """Return a tuple of the lower case header texts of a header line."""
+    if line.strip() == '':
+        raise Exception('InputFile.interpret_headers() no header found')
+    return tuple(h.lower() for h in field_separator.split(line.strip()))
+
+def compile_parse_plan(headers, field_map):
+    """
+    Return a tuple (plan, unmapped) for input files with the header line
+    headers (as returned by split_headers).  field_map is as returned by
+    InputFile.read_field_map.
+
+    plan is a tuple of (column index, field, cast) for each column with a
+    mapping, where cast is the function to convert the text of the column
+    or None to keep it as it is.  unmapped is a list of the headers with
+    no mapping.
+    """
+    plan, unmapped = [], []
+    for idx, header in enumerate(headers):
+        if header not in field_map:
+            unmapped.append(header)
+            continue
+        field, cast_type = field_map[header]
+        cast = None
+        if cast_type is not None:
+            if cast_type in cast_functions:
+                cast = cast_functions[cast_type]
+            else:
+                log.warning('InputFile unknown cast type: %s' % cast_type)
+        plan.append((idx, field, cast))
+    return tuple(plan), unmapped
+
 class InputFile:
-    def __init__(self, path, database):
+    def __init__(self, path, database, field_map=None, offset=None):
         """ 
         Construct an InputFile object for a given input file path.
 
         An InputFile object is supposed to be transient, intended for
         use during import of data into the database only.
+
+        If field_map is given (as returned by read_field_map), it is used
+        instead of querying the database, so database may be None.  This
+        allows files to be read in worker processes.
+
+        If offset is given, only records starting at that byte offset are
+        read (the header line is always read), and only complete lines, 
+        i.e. those ending in a newline, so a file which is still being 
+        written can be read again later from bytes_read.
+
+        The last TAIL_WINDOW bytes up to bytes_read are kept as the file
+        is read, for the sha1 in manifest().  When reading from offset, the
+        bytes before offset in the window are read too, but nothing else
+        before offset is.
         """
         log.debug('Constructing InputFile object for path: %s' % path)
         self._path = path
         self._db = database
-        self._field_map = []
-        self._records = []
-        self.read_file()
- 
+        self._header_map = field_map
+        self._plan = ()
+        self._offset = offset
+        # byte offset after the last line read
+        self.bytes_read = 0
+        self._debug = False
+        # field -> number of values which could not be cast, for this file
+        self.cast_failures = dict()
+        self._tail = None
+        self._stat = None
+
+    def __iter__(self):
+        return self.read_file()
+
     def __getitem__(self, index):
-        return self._records[index]
+        """
+        Return the record at index.
+
+        Records are not held in memory, so this re-reads the file up to 
+        the requested record.  Prefer iteration where possible.
+        """
+        for idx, record in enumerate(self):
+            if idx == index:
+                return record
+        raise IndexError('InputFile index out of range: %s' % index)
 
     def read_file(self):
-        with open(self._path, 'r') as f:
+        """
+        Generator which yields one record dict per line of the input file.
+
+        The file is read lazily so memory use does not depend on file size.
+        """
+        self._plan = ()
+        self._debug = debug_enabled(log)
+        self.cast_failures = dict()
+        self._tail = TailWindow(TAIL_WINDOW)
+        with open(self._path, 'rb') as f:
+            self._stat = os.fstat(f.fileno())
+            header = f.readline()
             try:
-                self.interpret_headers(f.readline())
+                self.interpret_headers(header)
             except Exception as e:
                 log.exception('Failed to read input file %s : %s / %s' % (
                             self._path, type(e), e))
-            while True:
-                line = f.readline()
-                if line == '':
-                    break
-                else:
-                    self._records.append(self.read_line(line.strip()))
+            position = len(header)
+            if self._offset is not None and not header.endswith('\n'):
+                # the header line is not complete yet
+                return
+            self._tail.update(header)
+            if self._offset is not None and self._offset > position:
+                # the end of the window is before offset
+                start = max(position, self._offset - TAIL_WINDOW)
+                f.seek(start)
+                self._tail.update(f.read(self._offset - start))
+                position = self._offset
+            self.bytes_read = position
+            # readline rather than iterating over f, so that position is 
+            # always known
+            try:
+                for line in iter(f.readline, ''):
+                    if self._offset is not None and not line.endswith('\n'):
+                        break
+                    position += len(line)
+                    self.bytes_read = position
+                    self._tail.update(line)
+                    yield self.read_line(line.strip())
+            finally:
+                self.log_cast_failures()
+
+    def log_cast_failures(self):
+        """Log a summary of the values which could not be cast, once per file."""
+        instrument.count('add.cast_failures', sum(self.cast_failures.values()))
+        for field in sorted(self.cast_failures.keys()):
+            log.warning('InputFile %s: %d %s values could not be converted, kept as text' % (
+                        self._path, self.cast_failures[field], field))
+
+    def manifest(self):
+        """
+        Return a dict describing the file as it was read, with keys:
+        bytes_read, size and mtime (as when the file was opened) and 
+        tail_sha1, the sha1 hex digest of the TAIL_WINDOW bytes up to 
+        bytes_read (see file_tail_digest).
+        """
+        return {'bytes_read': self.bytes_read,
+                'size': self._stat.st_size,
+                'mtime': self._stat.st_mtime,
+                'tail_sha1': self._tail.hexdigest()}
 
     def interpret_headers(self, line):
         log.debug('InputFile.interpret_headers(%s)' % line)
-        if line == '':
-            raise Exception('InputFile.interpret_headers() no header found')
-        field_map = self.get_field_map()
-        for header_text in re.split(r'\s*,\s*', line.strip()):
-            destination = None
-            try:
-                destination = field_map[header_text.lower()]
-            except:
-                log.warning('InputFile.interpret_headers() No mapping found for header "%s" ignoring this column' % header_text)
-            self._field_map.append(destination)
-        log.debug('InputFile.interpret_headers() field map: %s' % self._field_map)
+        headers = split_headers(line)
+        if self._header_map is None and self._db is not None:
+            self._plan, unmapped = self._db.get_parse_plan(headers)
+        else:
+            self._plan, unmapped = compile_parse_plan(headers, self.get_field_map())
+        for header_text in unmapped:
+            log.warning('InputFile.interpret_headers() No mapping found for header "%s" ignoring this column' % header_text)
+        log.debug('InputFile.interpret_headers() parse plan: %s' % (self._plan,))
 
     def get_field_map(self):
+        if self._header_map is None:
+            self._header_map = self._db.get_field_map()
+        return self._header_map
+
+    @staticmethod
+    def read_field_map(database):
+        """
+        Return a dict of lower case header text -> (field, cast_type) from
+        the field_mapping table of database.
+        """
         field_map = dict()
-        cur = self._db._conn.cursor()
+        cur = database._conn.cursor()
         cur.execute("""
                     SELECT header, field, cast_type
                     FROM field_mapping
@@ -73,26 +216,67 @@ class InputFile:
         Return an dict of values from input record
 
         The keys in the dict should be: ref, dt, tm, wind_1, wind_2, 
-        direction, irradiance, batt_v.
+        direction, irradiance, batt_v.  A value which cannot be cast is 
+        kept as text.
         """
-        log.debug('InputFile.read_line(%s)' % line)
+        debug = self._debug
+        if debug:
+            log.debug('InputFile.read_line(%s)', line)
         ret = dict()
-        fields = re.split(r'\s*,\s*', line.strip())
-        for i in range(len(fields)):
-            try:
-                if self._field_map[i] is not None:
-                    dest = self._field_map[i][0]
-                    cast = self._field_map[i][1]
-                    ret[dest] = fields[i]
-                    if cast == 'int':
-                        ret[dest] = int(ret[dest])
-                    elif cast == 'float':
-                        ret[dest] = float(ret[dest])
-                    elif cast is not None:
-                        log.warning('InputFile.read_line unknown cast type: %s' % cast)
-                else:
-                    raise Exception('bad column %d' % i)
-            except:
-                log.warning('InputFile.read_line(), skipping value in column %d : %s' % (i, fields[i]))
-        log.debug('InputFile.read_line() -> %s' % ret)
+        fields = field_separator.split(line.strip())
+        count = len(fields)
+        for idx, dest, cast in self._plan:
+            if idx >= count:
+                break
+            value = fields[idx]
+            if cast is not None:
+                try:
+                    value = cast(value)
+                except ValueError:
+                    self.cast_failures[dest] = self.cast_failures.get(dest, 0) + 1
+                    if debug:
+                        log.debug('InputFile.read_line(), cannot convert value in column %d : %s', idx, value)
+            ret[dest] = value
+        if debug:
+            log.debug('InputFile.read_line() -> %s', ret)
         return ret
+
+class TailWindow:
+    """Keeps the last size bytes of the strings passed to update()."""
+    def __init__(self, size):
+        self._size = size
+        self._parts = deque()
+        self._length = 0
+
+    def update(self, s):
+        self._parts.append(s)
+        self._length += len(s)
+        while self._length - len(self._parts[0]) >= self._size:
+            self._length -= len(self._parts.popleft())
+
+    def hexdigest(self):
+        return hashlib.sha1(''.join(self._parts)[-self._size:]).hexdigest()
+
+def file_tail_digest(path, end, size=TAIL_WINDOW):
+    """
+    Return the sha1 hex digest of the size bytes of path before offset 
+    end (or all of them if end is less than size).  This is compared
+    with the tail_sha1 recorded when the file was read up to end, to 
+    check that it has only been appended to without reading it all.
+    """
+    start = max(0, end - size)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(end - start)).hexdigest()
+
+def file_digest(path, length, block_size=1024 * 1024):
+    """Return a hashlib sha1 object of the first length bytes of path."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while length > 0:
+            block = f.read(min(block_size, length))
+            if block == '':
+                break
+            digest.update(block)
+            length -= len(block)
+    return digest
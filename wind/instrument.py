@@ -0,0 +1,119 @@
+"""
+Timers and counters for the phases of adding and querying data.
+
+Instrumentation is off unless enable() is called (winda.py --profile), and
+while it is off the functions here do next to nothing, so they are only
+placed around whole phases (a file, a chunk, a query), never around the
+handling of a single record.  Phase times are inclusive: a phase which
+runs inside another is counted in both.
+
+Worker processes (add --jobs, speeds and average --jobs) record their own
+phases after start_worker(), and return report() to the parent to merge().
+Their phase times are summed over the workers, so may be more than the
+time taken by the phase in the parent which waits for them.
+"""
+
+import time
+import json
+from contextlib import contextmanager
+
+enabled = False
+
+# phase name -> [seconds, calls]
+timings = dict()
+# counter name -> count
+counters = dict()
+
+def enable():
+    global enabled
+    enabled = True
+
+def reset():
+    timings.clear()
+    counters.clear()
+
+def add_time(name, seconds, calls=1):
+    if name not in timings:
+        timings[name] = [0.0, 0]
+    timings[name][0] += seconds
+    timings[name][1] += calls
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+@contextmanager
+def phase(name):
+    """Context manager which adds the time spent in its block to phase name."""
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+def timed_iter(name, iterable):
+    """
+    Return an iterator over iterable which adds the time spent getting each
+    item to phase name, e.g. the time spent reading a file lazily.
+    """
+    if not enabled:
+        return iter(iterable)
+    return _timed_iter(name, iterable)
+
+def _timed_iter(name, iterable):
+    it = iter(iterable)
+    clock = time.time
+    total, calls = 0.0, 0
+    try:
+        while True:
+            start = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            total += clock() - start
+            calls += 1
+            yield item
+    finally:
+        add_time(name, total, calls)
+
+def start_worker(enable_worker):
+    """
+    Start recording in a worker process, if enable_worker (the parent's
+    enabled), discarding anything inherited from the parent.
+    """
+    global enabled
+    enabled = enable_worker
+    reset()
+
+def merge(worker_report):
+    """Add the phase times and counters of a worker's report() to these."""
+    for name, t in worker_report['phases'].items():
+        add_time(name, t['seconds'], t['calls'])
+    for name, n in worker_report['counters'].items():
+        counters[name] = counters.get(name, 0) + n
+
+def report():
+    """Return a dict of the phase times and counters recorded so far."""
+    return {'phases': dict((name, {'seconds': t[0], 'calls': t[1]}) for name, t in timings.items()),
+            'counters': dict(counters)}
+
+def format_report():
+    """Return the phase times and counters as a table of text."""
+    lines = ['%-32s %10s %10s' % ('PHASE', 'SECONDS', 'CALLS')]
+    for name in sorted(timings.keys()):
+        lines.append('%-32s %10.3f %10d' % (name, timings[name][0], timings[name][1]))
+    if len(counters) > 0:
+        lines.append('')
+        lines.append('%-32s %10s' % ('COUNTER', 'VALUE'))
+        for name in sorted(counters.keys()):
+            lines.append('%-32s %10d' % (name, counters[name]))
+    return '\n'.join(lines)
+
+def write_json(path):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+        f.write('\n')
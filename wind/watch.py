@@ -0,0 +1,117 @@
+"""
+Watch a directory for new and growing input files, and add their records
+to the database as they are written.
+
+Changes are found with inotify if pyinotify is installed, otherwise the
+directory is polled.  Only files whose size has changed are read, and only
+from the end of what was added before (see Database.update_file), after
+checking that the last bytes read before are unchanged, so the cost of 
+each check does not depend on how much data has been added.
+"""
+
+import os
+import time
+import fnmatch
+import logging
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+log = logging
+
+DEFAULT_PATTERN = '*.csv'
+DEFAULT_INTERVAL = 2.0
+
+class Watcher:
+    def __init__(self, database, directory, pattern=DEFAULT_PATTERN, interval=DEFAULT_INTERVAL):
+        """
+        Create a Watcher for input files in directory matching the glob
+        pattern (case insensitive), adding them to database.  When polling,
+        the directory is checked every interval seconds.  With inotify,
+        interval is the longest wait before a changed file is re-checked.
+        """
+        self._db = database
+        self._directory = directory
+        self._pattern = pattern.lower()
+        self._interval = interval
+        # path -> size when last checked
+        self._sizes = dict()
+
+    def wanted(self, path):
+        return fnmatch.fnmatch(os.path.basename(path).lower(), self._pattern)
+
+    def check(self, path):
+        """Add any new records in path, if its size has changed.  Returns the number added."""
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            log.debug('Watcher.check(%s) %s' % (path, e))
+            self._sizes.pop(path, None)
+            return 0
+        if self._sizes.get(path) == size:
+            return 0
+        self._sizes[path] = size
+        try:
+            count = self._db.update_file(path)
+        except Exception as e:
+            # e.g. the file was removed or truncated while it was read, or
+            # the database is locked by another writer.  Keep watching, and
+            # try the file again when it is next checked.
+            log.error('Failed to add %s, will retry: %s / %s' % (path, type(e).__name__, e))
+            self._db.rollback()
+            self._sizes.pop(path, None)
+            return 0
+        if count > 0:
+            log.info('Added %d records from %s' % (count, path))
+        return count
+
+    def scan(self):
+        """Check every wanted file in the directory.  Returns the number of records added."""
+        count = 0
+        for name in sorted(os.listdir(self._directory)):
+            path = os.path.join(self._directory, name)
+            if self.wanted(path) and os.path.isfile(path):
+                count += self.check(path)
+        return count
+
+    def run(self):
+        """Add files as they change, until interrupted."""
+        log.info('Watching %s for %s files' % (self._directory, self._pattern))
+        self.scan()
+        if pyinotify is not None:
+            self.run_inotify()
+        else:
+            log.debug('pyinotify is not installed, polling every %s seconds' % self._interval)
+            self.run_polling()
+
+    def run_polling(self):
+        while True:
+            time.sleep(self._interval)
+            self.scan()
+
+    def run_inotify(self):
+        changed = set()
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                changed.add(event.pathname)
+
+        mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, Handler(), timeout=int(self._interval * 1000))
+        manager.add_watch(self._directory, mask)
+        try:
+            while True:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                # a logger makes many small writes, so check each changed
+                # file once per wakeup rather than once per event
+                for path in sorted(changed):
+                    if self.wanted(path):
+                        self.check(path)
+                changed.clear()
+        finally:
+            notifier.stop()
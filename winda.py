@@ -3,14 +3,23 @@
 import logging
 import os
 import sys
+import csv
 import wind.database
 import wind.inputfile
+import wind.events
 import wind.filter
+import wind.analysis
+import wind.watch
+import wind.instrument
+import wind.export
+import wind.eventstore
+import wind.cache
 import fileinput
 import fnmatch
 import dateutil.parser
-from wind.database import Database, result_as_dict_array, result_headers
+from wind.database import Database, result_as_dict_array, result_headers, iter_result_chunks
 from wind.filter import Filter
+from wind.analysis import windspeed_ranges, parallel_value_counts, averages, histogram
 
 global args
 global log
@@ -31,27 +40,46 @@ def init_log():
     log.addHandler(handler)
     wind.database.log = log
     wind.inputfile.log = log
+    wind.events.log = log
     wind.filter.log = log
+    wind.analysis.log = log
+    wind.watch.log = log
+    wind.export.log = log
+    wind.eventstore.log = log
+    wind.cache.log = log
 
 def database_reset(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     if confirmation():
         d.reset()
     else:
         log.warning("Database reset ABORTED because confirmation not given")
 
 def database_info(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     info = d.info()
-    for k in ['Database file', 'Size', 'Number of files added', 'Number of records']:
+    for k in ['Database file', 'Size', 'Number of files added', 'Number of records',
+              'Number of raw_data records', 'Unprocessed raw_data records', 'First event', 'Last event']:
         print('%-30s%s' % (k + ':', info[k]))
+    for ref in sorted(info['Refs'].keys()):
+        stats = info['Refs'][ref]
+        print('%-30s%d events, %d raw_data records, %d unprocessed' % (
+              'Ref %s:' % ref, stats['events'], stats['raw_data'], stats['unprocessed']))
     
 def add_files(args):
-    d = Database(args.database_path)
-    d.add(args.files)
+    d = Database(args.database_path, profile=args.db_profile, chunk_size=args.chunk_size)
+    d.add(args.files, jobs=args.jobs)
+
+def watch_directory(args):
+    d = Database(args.database_path, profile=args.db_profile, chunk_size=args.chunk_size)
+    watcher = wind.watch.Watcher(d, args.directory, pattern=args.pattern, interval=args.interval)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        log.info('Stopped watching %s' % args.directory)
 
 def show_files(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
 
     def want(path, patterns):
         if len(patterns) == 0:
@@ -72,166 +100,130 @@ def show_files(args):
                     r['id'], r['path'], r['import_date'][:19], r['records'], r['errors']))
     
 def remove_data(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     c = d._conn.cursor()
     filt = generate_filter(args, c)
 
-    # populate the temp tables tmp_event_rids, tmp_raw_data_rids
-    filt.select_events()
-    filt.select_raw_data()
-
-    c.execute("""SELECT rid FROM tmp_event_rids""")
-    event_rowids = c.fetchall()
-    c.execute("""SELECT rid FROM tmp_raw_data_rids""")
-    raw_data_rowids = c.fetchall()
     if confirmation('Remove %d events and %d raw_date records (y/N)? ' % (
-                    len(event_rowids),
-                    len(raw_data_rowids))):
-        c.execute("""
-                  DELETE FROM       event
-                  WHERE             EXISTS (
-                      SELECT            1
-                      FROM              tmp_event_rids t
-                      WHERE             t.rid = event.rowid
-                  )
-                  """)
-        c.execute("""
-                  DELETE FROM       raw_data
-                  WHERE             EXISTS (
-                      SELECT            1
-                      FROM              tmp_raw_data_rids t
-                      WHERE             t.rid = raw_data.rowid
-                  )
-                  """)
-        c.execute("""
-                  SELECT       id, path
-                  FROM         input_file
-                  WHERE        NOT EXISTS (
-                      SELECT       1
-                      FROM         event e
-                      WHERE        e.file_id = input_file.id
-                  )
-                  AND          NOT EXISTS (
-                      SELECT       1
-                      FROM         raw_data r
-                      WHERE        r.file_id = input_file.id
-                  )""")
-        for r in c.fetchall():
-            print('Removing input file %s as it no longer has events / raw_data' % r[1])
-        c.execute("""
-                  DELETE FROM  input_file
-                  WHERE        NOT EXISTS (
-                      SELECT       1
-                      FROM         event e
-                      WHERE        e.file_id = input_file.id
-                  )
-                  AND          NOT EXISTS (
-                      SELECT       1
-                      FROM         raw_data r
-                      WHERE        r.file_id = input_file.id
-                  )""")
-        d.commit()
+                    filt.count_selected_events(),
+                    filt.count_selected_raw_data())):
+        where, params = filt.event_criteria()
+        raw_where, raw_params = filt.raw_data_criteria()
+        events, raw_data, paths = d.remove_data(where, params, raw_where, raw_params)
+        for path in paths:
+            print('Removing input file %s as it no longer has events / raw_data' % path)
+        log.info('Removed %d events and %d raw_data records' % (events, raw_data))
 
 def export_speeds(args):
-    if args.increment <= 0.0:
-        raise Exception('--increment must be greater than 0.0')
-    d = Database(args.database_path)
-    c = d._conn.cursor()
-    # Create a temp table with the windspeed ranges to analyse
-    c.execute("""DROP TABLE IF EXISTS windspeed_range""")
-    c.execute("""CREATE TEMP TABLE windspeed_range (a FLOAT UNIQUE, b FLOAT UNIQUE)""")
     rng = [float(i) for i in args.range.split('-')]
-    a = rng[0] 
-    while a < rng[1]:
-        b = a+args.increment
-        c.execute("""
-                  INSERT OR IGNORE INTO windspeed_range 
-                  VALUES (?, ?)
-                  """, (a, b))
-        log.debug('adding range: %f to %f' % (a, b))
-        a = b
-    
+    ranges = windspeed_ranges(rng[0], rng[1], args.increment)
+    d = Database(args.database_path, profile=args.db_profile)
+    c = d._conn.cursor()
     filt = generate_filter(args, c)
-    filt.select_events()
+    cache, key = cached_result(args, d, 'speeds', filt, range=rng, increment=args.increment,
+                               anemometer=args.anemometer_no, split=args.split)
+    if cache is None:
+        return
 
     result_csv = []
     if args.split:
-        groups = 'e.wind_direction, r.a, r.b'
         result_csv.append('direction,windspeed_range_begin,windspeed_range_end,probability')
     else:
-        groups = 'r.a, r.b'
         result_csv.append('windspeed_range_begin,windspeed_range_end,probability')
 
-    total = filt.count_selected_events()
-    wind_field = 'windspeed_ms_%d' % args.anemometer_no
-    c.execute("""
-              SELECT          %s, COUNT(1)
-              FROM            event e,
-                              windspeed_range r
-              WHERE           %s >= r.a
-              AND             %s < r.b
-              AND EXISTS (
-                  SELECT        1
-                  FROM          tmp_event_rids t
-                  WHERE         t.rid = e.rowid
-              )
-              GROUP BY        %s
-              """ % (groups, wind_field, wind_field, groups))
+    value_counts = parallel_value_counts(args.database_path, c, filt, args.anemometer_no, args.split, args.jobs,
+                                         store=d.current_event_store())
+    total = sum(vc[2] for vc in value_counts)
     log.debug('total selected events: %d' % total)
-    for r in c.fetchall():
-        if args.split:
-            result_csv.append('%s,%.2f,%.2f,%.4f' % (r[0], r[1], r[2], float(r[3])/float(total)))
-        else:
-            result_csv.append('%.2f,%.2f,%.4f' % (r[0], r[1], float(r[2])/float(total)))
-    print('\n'.join(result_csv))
+    with wind.instrument.phase('speeds.histogram'):
+        bins = histogram(value_counts, ranges)
+    with wind.instrument.phase('output'):
+        for direction, a, b, count in bins:
+            if args.split:
+                result_csv.append('%s,%.2f,%.2f,%.4f' % (direction, a, b, float(count)/float(total)))
+            else:
+                result_csv.append('%.2f,%.2f,%.4f' % (a, b, float(count)/float(total)))
+        output = '\n'.join(result_csv) + '\n'
+        sys.stdout.write(output)
+    cache.put(key, 'speeds', output)
 
 def export_average(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     c = d._conn.cursor()
     filt = generate_filter(args, c)
-    filt.select_events()
+    cache, key = cached_result(args, d, 'average', filt, anemometer=args.anemometer_no, split=args.split)
+    if cache is None:
+        return
+    value_counts = parallel_value_counts(args.database_path, c, filt, args.anemometer_no, args.split, args.jobs,
+                                         store=d.current_event_store())
+    with wind.instrument.phase('average.averages'):
+        results = averages(value_counts)
     wind_field = 'windspeed_ms_%d' % args.anemometer_no
-    if args.split:
-        c.execute("""
-                  SELECT          wind_direction, avg(%s), count(1)
-                  FROM            event e,
-                                  tmp_event_rids t
-                  WHERE           t.rid = e.rowid
-                  GROUP BY        wind_direction
-                  """ % wind_field)
-    else:
-        c.execute("""
-                  SELECT          avg(%s), count(1)
-                  FROM            event e,
-                                  tmp_event_rids t
-                  WHERE           t.rid = e.rowid
-                  """ % wind_field)
-    print(','.join(result_headers(c)))
-    for r in c.fetchall():
-        print(','.join([str(i) for i in list(r)]))
+    with wind.instrument.phase('output'):
+        lines = []
+        if args.split:
+            lines.append('wind_direction,avg(%s),count(1)' % wind_field)
+        else:
+            lines.append('avg(%s),count(1)' % wind_field)
+            # like SQL, an aggregate over no events is still one row
+            results.setdefault(None, (None, 0))
+        for direction in sorted(results.keys(), key=lambda k: (k is not None, k)):
+            average, count = results[direction]
+            if args.split:
+                lines.append('%s,%s,%d' % (direction, average, count))
+            else:
+                lines.append('%s,%d' % (average, count))
+        output = '\n'.join(lines) + '\n'
+        sys.stdout.write(output)
+    cache.put(key, 'average', output)
 
 def export_data(args):
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     c = d._conn.cursor()
     filt = generate_filter(args, c)
-    filt.select_events()
-    result_csv = []
-    c.execute("""
-              SELECT          ref, event_start, event_end, windspeed_ms_1, windspeed_ms_2, wind_direction, irradiance_wm2
-              FROM            event e
-              WHERE           EXISTS (
-                  SELECT        1
-                  FROM          tmp_event_rids t
-                  WHERE         t.rid = e.rowid
-              )
-              """)
-    print(','.join(result_headers(c)))
-    for r in c.fetchall():
-        print(','.join([str(i) for i in list(r)]))
+    where, params = filt.event_criteria()
+    if args.format != 'csv':
+        if args.output is None:
+            log.error('--output is required to export %s files' % args.format)
+            return
+        missing = wind.export.missing_dependency(args.format)
+        if missing is not None:
+            log.error('%s must be installed to export %s files' % (missing, args.format))
+            return
+        wind.export.export_events(c, where, params, args.format, args.output)
+        return
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        cache, key = cached_result(args, d, 'export', filt, out=out)
+        if cache is None:
+            return
+        # Stream the result so memory use does not depend on the number of rows
+        c.execute("""
+                  SELECT          ref, 
+                                  datetime(event_start, 'unixepoch') AS event_start, 
+                                  datetime(event_end, 'unixepoch') AS event_end, 
+                                  windspeed_ms_1, windspeed_ms_2, wind_direction, irradiance_wm2
+                  FROM            event e
+                  WHERE           %s
+                  ORDER BY        e.id
+                  """ % where, params)
+        # a copy is kept for the cache, unless it is too large to cache
+        capture = wind.cache.CapturingStream(out, wind.cache.DEFAULT_MAX_BYTES)
+        writer = csv.writer(capture, lineterminator='\n')
+        writer.writerow(result_headers(c))
+        for rows in wind.instrument.timed_iter('export.fetch', iter_result_chunks(c)):
+            with wind.instrument.phase('output'):
+                writer.writerows(rows)
+            wind.instrument.count('export.rows', len(rows))
+        if capture.captured() is not None:
+            cache.put(key, 'export', capture.captured())
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 def calibrate(args):
     log.debug('calibrate(%s)' % args.ref)
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     c = d._conn.cursor()
     c.execute("""SELECT 1 FROM calibration WHERE ref = ?""", (args.ref,))
     if len(c.fetchall()) > 0:
@@ -268,11 +260,22 @@ def calibrate(args):
                         args.max_windspeed_ms,
                         args.irradiance_factor,
                         args.max_irradiance))
+    d.bump_data_version(c)
     d.commit()
 
+def recalibrate(args):
+    d = Database(args.database_path, profile=args.db_profile)
+    events, files = d.recalibrate(args.ref, full=args.full)
+    log.info('Recalculated %d events, processed %d files again' % (events, files))
+
+def convert(args):
+    d = Database(args.database_path, profile=args.db_profile)
+    count = d.convert_event_store()
+    log.info('Wrote %d events to the event store %s' % (count, wind.database.event_store_path(args.database_path)))
+
 def show_calibration(args):
     log.debug('show_calibration(%s)' % args.ref)
-    d = Database(args.database_path)
+    d = Database(args.database_path, profile=args.db_profile)
     c = d._conn.cursor()
     c.execute("""
               SELECT     ref, anemometer_1_factor, anemometer_2_factor, 
@@ -329,6 +332,32 @@ def add_files_option(parser):
     parser.add_argument('files', metavar='filename', type=str, nargs='*',
                    help='file names or glob pattern')
 
+def cached_result(args, d, command, filt, out=None, **command_args):
+    """
+    Look up the result of command in the query cache.  If it is there it 
+    is written to out (default stdout) and (None, None) is returned.  
+    Otherwise returns the cache and key to store the result with, which 
+    with --no-cache are a cache which stores nothing and None.
+    """
+    if args.no_cache:
+        return NoCache(), None
+    cache = wind.cache.QueryCache(d)
+    key = cache.key(command, filt, **command_args)
+    result = cache.get(key)
+    if result is not None:
+        log.debug('%s result found in the cache' % command)
+        (out or sys.stdout).write(result)
+        return None, None
+    return cache, key
+
+class NoCache:
+    def put(self, key, command, result):
+        pass
+
+def add_jobs_option(parser):
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+        help='Number of worker processes, each calculating the result for part of the selected dates')
+
 def confirmation(msg='Are you sure (y/N)? '):
     """Prompt the user for confirmation of some operation, return True if OK to proceed."""
     if args.assume_yes:
@@ -345,8 +374,12 @@ def confirmation(msg='Are you sure (y/N)? '):
 
 if __name__ == '__main__':
     import argparse
+    import multiprocessing
     global args
 
+    # Needed for worker processes in the frozen win32 build
+    multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(description='Re-Innovation Wind Data Analysis Tool')
     parser.add_argument('--database', dest='database_path', type=str, default='winda.db',
         help='specify the database file path')
@@ -358,6 +391,18 @@ if __name__ == '__main__':
     parser.add_argument('--log-ts', dest='log_timestamps',
         action='store_const', const=True, default=False,
         help='write informational output in the log')
+    parser.add_argument('--db-profile', dest='db_profile', type=str, 
+        choices=sorted(wind.database.DB_PROFILES.keys()), default=wind.database.DEFAULT_DB_PROFILE,
+        help='sqlite settings: safe (sync every commit), fast (write ahead log, larger cache) or '
+             'rollback (as safe, and switch a fast database back to a rollback journal)')
+    parser.add_argument('--profile', dest='profile', action='store_const', const=True, default=False,
+        help='Print the time spent in each phase of the command, and counts of the records handled')
+    parser.add_argument('--profile-json', dest='profile_json', type=str, default=None,
+        help='Write the --profile results to this file as JSON (implies --profile)')
+    parser.add_argument('--cprofile', dest='cprofile', type=str, default=None,
+        help='Write cProfile statistics for the command to this file (see the pstats module)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_const', const=True, default=False,
+        help='Calculate the results of speeds, average and export even if they are in the query cache')
     parser.add_argument('--yes', dest='assume_yes', action='store_const', const=True, 
         default=False, help='Assume the answer to any confirmation prompt is YES')
     subparsers = parser.add_subparsers()
@@ -374,8 +419,25 @@ if __name__ == '__main__':
     parser_add = subparsers.add_parser('add', help='Add data from CSV files into the database')
     parser_add.add_argument('files', metavar='filename', type=str, nargs='+',
                    help='file name or glob pattern to add to database')
+    parser_add.add_argument('--chunk-size', dest='chunk_size', type=int, 
+        default=wind.database.DEFAULT_CHUNK_SIZE, 
+        help='Number of records to read and insert per batch')
+    parser_add.add_argument('--jobs', dest='jobs', type=int, default=1, 
+        help='Number of worker processes used to read files in parallel')
     parser_add.set_defaults(func=add_files)
 
+    # Watch command
+    parser_watch = subparsers.add_parser('watch', help='Add new and appended files in a directory as they are written')
+    parser_watch.add_argument('directory', type=str, help='directory to watch')
+    parser_watch.add_argument('--pattern', dest='pattern', type=str, default=wind.watch.DEFAULT_PATTERN, 
+        help='Only add files matching this glob pattern (case insensitive)')
+    parser_watch.add_argument('--interval', dest='interval', type=float, default=wind.watch.DEFAULT_INTERVAL, 
+        help='Seconds between checks of the directory when inotify is not available')
+    parser_watch.add_argument('--chunk-size', dest='chunk_size', type=int, 
+        default=wind.database.DEFAULT_CHUNK_SIZE, 
+        help='Number of records to read and insert per batch')
+    parser_watch.set_defaults(func=watch_directory)
+
     # Remove command
     parser_remove = subparsers.add_parser('remove', help='Remove data from the database')
     add_data_filters(parser_remove)
@@ -392,6 +454,7 @@ if __name__ == '__main__':
     parser_speeds.add_argument('--2', dest='anemometer_no', action='store_const', const=2, default=1, 
         help='Use data from the second anemometer (the first is the default)')
     add_data_filters(parser_speeds)
+    add_jobs_option(parser_speeds)
     parser_speeds.set_defaults(func=export_speeds)
 
     # Average command
@@ -401,11 +464,16 @@ if __name__ == '__main__':
     parser_average.add_argument('--2', dest='anemometer_no', action='store_const', const=2, default=1, 
         help='Use data from the second anemometer (the first is the default)')
     add_data_filters(parser_average)
+    add_jobs_option(parser_average)
     parser_average.set_defaults(func=export_average)
 
     # Export command
     parser_export = subparsers.add_parser('export', help='Remove data from the database')
     add_data_filters(parser_export)
+    parser_export.add_argument('--format', dest='format', choices=wind.export.FORMATS, default='csv',
+        help='Output format: csv (the default), or parquet or arrow (which need pyarrow) or npz (which needs numpy)')
+    parser_export.add_argument('--output', dest='output', type=str, default=None,
+        help='Write to this file (default: stdout, for csv only)')
     parser_export.set_defaults(func=export_data)
 
     # Calibrate command
@@ -418,6 +486,19 @@ if __name__ == '__main__':
     parser_calibrate.add_argument('max_irradiance', type=float, help='Value of max_irradiance, e.g. "1500"')
     parser_calibrate.set_defaults(func=calibrate)
 
+    # Recalibrate command
+    parser_recalibrate = subparsers.add_parser('recalibrate', 
+        help='Apply the current calibration to events which have already been added')
+    parser_recalibrate.add_argument('ref', nargs='?', default=None, help='Only recalibrate this ref (default: all)')
+    parser_recalibrate.add_argument('--full', dest='full', action='store_const', const=True, default=False,
+        help='Process every file of the ref again from raw_data, also accepting records rejected under old limits')
+    parser_recalibrate.set_defaults(func=recalibrate)
+
+    # Convert command
+    parser_convert = subparsers.add_parser('convert', 
+        help='Build (or rebuild) the columnar event store, which speeds and average then read instead of sqlite')
+    parser_convert.set_defaults(func=convert)
+
     # Show command
     parser_show = subparsers.add_parser('show', help='Show various things')
     show_subparsers = parser_show.add_subparsers()
@@ -438,6 +519,17 @@ if __name__ == '__main__':
     if not hasattr(args, 'func'):
         log.error('No command specified, try using --help')
     else:
-        args.func(args)
+        if args.profile or args.profile_json is not None:
+            wind.instrument.enable()
+        with wind.instrument.phase('command.%s' % args.func.__name__):
+            if args.cprofile is not None:
+                import cProfile
+                cProfile.runctx('args.func(args)', globals(), {'args': args}, args.cprofile)
+            else:
+                args.func(args)
+        if args.profile or args.profile_json is not None:
+            sys.stderr.write(wind.instrument.format_report() + '\n')
+        if args.profile_json is not None:
+            wind.instrument.write_json(args.profile_json)
     log.debug('END')
 